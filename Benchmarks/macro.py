@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+''' macro.py
+
+Macrobenchmarks of the CCS-VA scheme and of an election: encryption of a
+ballot, verification of its proofs, decryption, and the acceptance and tally
+of BALLOTS ballots (with the precomputations of the election).
+
+@author: Richard Mathot
+'''
+
+import json
+import shutil
+import tempfile
+from Benchmarks.runner import benchmark
+from Crypto.ccs_va import ccsva_gen, ccsva_enc, ccsva_extrip, ccs_dec, \
+    ccsva_enc_vector, ccsva_extrip_vector, ccs_tally_vector, ccs_dec_vector, \
+    ccsva_precompute_vector, ccsva_enc_vector_online
+from Election.acceptance import accept_ballot
+from Election.context import ElectionContext
+from Election.storage import create_storage
+from Election.wire import encode_json_ballot, decode_any
+from NumberTheory.pairings import clear_caches
+from Util.compat import to_bytes
+
+# Number of answers of the benchmark election, and of ballots of the
+# acceptance and tally benchmark
+ANSWERS = 3
+BALLOTS = 8
+
+
+def _keys():
+    '''((g, h, g1, h1), x1)'''
+    return ccsva_gen()
+
+
+def _election():
+    '''Context of a single choice election with ANSWERS answers, with its
+    fixed-base tables and decryption precomputations, and its private key'''
+    ((g, h, g1, h1), x1) = _keys()
+    settings = json.dumps({'human' : {'name' : 'benchmark',
+                                      'question' : 'Benchmark?',
+                                      'type' : 'single',
+                                      'answers' : [i.__str__() for i
+                                                   in range(ANSWERS)]},
+                           'crypto' : {'g' : g.json(compressed = True),
+                                       'h' : h.json(compressed = True),
+                                       'g1' : g1.json(compressed = True),
+                                       'h1' : h1.json(compressed = True)}},
+                          indent = 4)
+    context = ElectionContext(settings, precompute = True)
+    context.basis()
+    context.lines()
+    return (context, x1)
+
+
+def _vote(i):
+    votes = [0] * ANSWERS
+    votes[i % ANSWERS] = 1
+    return votes
+
+
+@benchmark("ccs.enc")
+def setup_enc():
+    ((g, h, g1, h1), _) = _keys()
+    return lambda: ccsva_enc(1, g, g1, h, h1)
+
+
+@benchmark("ccs.enc_vector")
+def setup_enc_vector():
+    (context, _) = _election()
+    tables = context.tables()
+    return lambda: ccsva_enc_vector(_vote(0), context.g, context.g1,
+                                    context.h, context.h1, tables)
+
+
+@benchmark("ccs.enc_vector.online")
+def setup_enc_vector_online():
+    (context, _) = _election()
+    precomputation = ccsva_precompute_vector(ANSWERS, context.g, context.g1,
+                                             context.h, context.h1,
+                                             context.tables())
+    # Timing only: a precomputation must not encrypt two real ballots
+    return lambda: ccsva_enc_vector_online(_vote(0), precomputation,
+                                           context.g, context.g1, context.h,
+                                           context.h1)
+
+
+@benchmark("ccs.extrip")
+def setup_extrip():
+    ((g, h, g1, h1), _) = _keys()
+    ((c0, c1, c2), sigmacc, sigmaor) = ccsva_enc(1, g, g1, h, h1)
+    return lambda: ccsva_extrip(c0, c1, c2, sigmacc, sigmaor, g, h, g1, h1)
+
+
+@benchmark("ccs.extrip_vector")
+def setup_extrip_vector():
+    (context, _) = _election()
+    tables = context.tables()
+    (cs, sigmaccs, sigmaors, sigmasum) = \
+        ccsva_enc_vector(_vote(0), context.g, context.g1, context.h,
+                         context.h1, tables)
+    return lambda: ccsva_extrip_vector(cs, sigmaccs, sigmaors, sigmasum,
+                                       context.g, context.h, context.g1,
+                                       context.h1, tables)
+
+
+@benchmark("ccs.dec", repeat = 1)
+def setup_dec():
+    ((g, h, g1, h1), x1) = _keys()
+    ((c0, c1, c2), _, _) = ccsva_enc(1, g, g1, h, h1)
+
+    def dec():
+        clear_caches()
+        return ccs_dec(c0, c1, c2, g, h, h1, x1, bound = 1)
+    return dec
+
+
+@benchmark("ccs.dec.cached")
+def setup_dec_cached():
+    '''Decryption of a ciphertext decrypted before (see
+    NumberTheory/pairings.py)'''
+    ((g, h, g1, h1), x1) = _keys()
+    ((c0, c1, c2), _, _) = ccsva_enc(1, g, g1, h, h1)
+    clear_caches()
+    ccs_dec(c0, c1, c2, g, h, h1, x1, bound = 1)
+    return lambda: ccs_dec(c0, c1, c2, g, h, h1, x1, bound = 1)
+
+
+@benchmark("election.accept_tally", repeat = 1)
+def setup_accept_tally():
+    (context, x1) = _election()
+    ballots = [to_bytes(json.dumps(encode_json_ballot(*ccsva_enc_vector(
+        _vote(i), context.g, context.g1, context.h, context.h1,
+        context.tables()), vector = True), indent = 4))
+               for i in range(BALLOTS)]
+
+    def accept_tally():
+        clear_caches()
+        folder = tempfile.mkdtemp() + "/"
+        try:
+            storage = create_storage(folder)
+            for ballot_raw in ballots:
+                accept_ballot(context, ballot_raw, storage)
+            cs = [decode_any(ballot_raw, context)[1][0]
+                  for (_, ballot_raw) in storage.sb.scan()]
+            storage.close()
+            return ccs_dec_vector(ccs_tally_vector(cs), context.g, context.h,
+                                  context.h1, x1, bound = len(cs),
+                                  basis = context.basis(),
+                                  lines = context.lines())
+        finally:
+            shutil.rmtree(folder)
+    return accept_tally
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+''' micro.py
+
+Microbenchmarks of the arithmetic: fields F_p, F_p^2 and F_p^12, groups G1
+(over F_p) and G2 (over F_p^2), and the pairing.
+
+The .mul_vector benchmarks time VECTOR_LENGTH multiplications at once (see
+NumberTheory/vector_fields.py; they need NumPy), the .sum ones the sum of
+SUM_LENGTH points (sum_points, with the vector formulas if NumPy is
+installed).
+
+@note: F_p^12 has no inversion in this tree (only F_p and F_p^2 do).
+
+@author: Richard Mathot
+'''
+
+from Benchmarks.runner import benchmark, register
+from Crypto.ccs_va import init_curves
+from NumberTheory.bn_curve import p_u_, n_u_
+from NumberTheory import vector_fields
+from NumberTheory.elliptic_curves import FixedBaseTable, sum_points
+from NumberTheory.finite_fields import PF12
+from NumberTheory.pairings import pairing
+from Random.random_sources import randint
+
+VECTOR_LENGTH = 4096
+SUM_LENGTH = 1024
+
+
+def _random_f12():
+    F2 = init_curves()[1]
+    return PF12(p_u_)([F2(None, rand = True) for _ in range(6)])
+
+
+def _field_benchmarks(name, element, inverse = True, vector = True):
+    '''Registers mul, square, inverse, pow (and mul_vector) benchmarks of a
+    field, element drawing a random element of it'''
+    def setup_mul():
+        (a, b) = (element(), element())
+        return lambda: a * b
+
+    def setup_square():
+        a = element()
+        return lambda: a * a
+
+    def setup_inverse():
+        a = element()
+
+        def invert():
+            a.inverse = None # F_p caches the inverse of an element
+            return ~a
+        return invert
+
+    def setup_pow():
+        (a, k) = (element(), randint(n_u_))
+        return lambda: a ** k
+
+    def setup_mul_vector():
+        (a, b) = [vector_fields.vector([element()
+                                        for _ in range(VECTOR_LENGTH)])
+                  for _ in range(2)]
+        return lambda: a * b
+
+    register(name + ".mul", setup_mul)
+    register(name + ".square", setup_square)
+    if inverse:
+        register(name + ".inverse", setup_inverse)
+    register(name + ".pow", setup_pow)
+    if vector and vector_fields.available():
+        register(name + ".mul_vector", setup_mul_vector)
+
+
+def _group_benchmarks(name, point):
+    '''Registers add, double and scalar multiplication benchmarks of a group,
+    point drawing a random point of it'''
+    def setup_add():
+        (P, Q) = (point(), point())
+        return lambda: P + Q
+
+    def setup_add_jacobian():
+        (P, Q) = (point().jacobian(), point().jacobian())
+        return lambda: P + Q
+
+    def setup_double():
+        P = point()
+        return P.__double__
+
+    def setup_mul():
+        (P, k) = (point(), randint(n_u_))
+        return lambda: P * k
+
+    def setup_fixed_base():
+        (table, k) = (FixedBaseTable(point()), randint(n_u_))
+        return lambda: table * k
+
+    def setup_sum():
+        points = [point() for _ in range(SUM_LENGTH)]
+        return lambda: sum_points(points)
+
+    register(name + ".add", setup_add)
+    register(name + ".add_jacobian", setup_add_jacobian)
+    register(name + ".double", setup_double)
+    register(name + ".mul", setup_mul)
+    register(name + ".mul_fixed_base", setup_fixed_base)
+    register(name + ".sum", setup_sum, repeat = 1)
+
+
+_field_benchmarks("field.fp", lambda: init_curves()[0](None, rand = True))
+_field_benchmarks("field.fp2", lambda: init_curves()[1](None, rand = True))
+_field_benchmarks("field.fp12", _random_f12, inverse = False, vector = False)
+_group_benchmarks("curve.g1",
+                  lambda: init_curves()[2](None, random = True))
+_group_benchmarks("curve.g2",
+                  lambda: init_curves()[3](None, random = True))
+
+
+@benchmark("pairing", repeat = 1)
+def setup_pairing():
+    (_, _, C, C2) = init_curves()
+    (P, Q) = (C(None, random = True), C2(None, random = True))
+    return lambda: pairing(P, Q)
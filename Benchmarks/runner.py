@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+''' runner.py
+
+Benchmark registry, timing and comparison with a baseline.
+
+A benchmark is a setup function, registered under a dotted name, that
+prepares its inputs and returns the operation to time (a function without
+arguments). Operations are called in loops of about min_time seconds, and
+the best of repeat loops is kept (the time of one operation). The random
+source is seeded before every setup, so that each run times the same inputs.
+
+Results (and baselines) are JSON files:
+
+    {"python": ..., "platform": ..., "timestamp": ...,
+     "benchmarks": {name: {"seconds": ..., "number": ..., "repeat": ...}}}
+
+With count = True, each result also holds the field and curve operations of
+one call, {"operations": {name: count}} (see NumberTheory/opcount.py).
+
+@author: Richard Mathot
+'''
+
+import json
+import platform
+from timeit import default_timer
+from time import time
+from NumberTheory.opcount import count_operations
+from Random.random_sources import seed
+
+# Registered benchmarks: (name, setup, repeat), in registration order
+BENCHMARKS = []
+
+# Relative slowdown above which a benchmark is reported as a regression
+THRESHOLD = 0.10
+
+
+def register(name, setup, repeat = 3):
+    '''Registers a benchmark (see the module documentation)'''
+    BENCHMARKS.append((name, setup, repeat))
+
+
+def benchmark(name, repeat = 3):
+    '''Decorator registering a setup function'''
+    def decorator(setup):
+        register(name, setup, repeat)
+        return setup
+    return decorator
+
+
+def measure(operation, repeat = 3, min_time = 0.2):
+    '''Time of one call of operation: {'seconds', 'number', 'repeat'}'''
+    start = default_timer()
+    operation()
+    elapsed = default_timer() - start
+    if elapsed >= min_time: # slow operation: the first call is a sample
+        samples = [elapsed]
+        number = 1
+        repeat -= 1
+    else:
+        samples = []
+        number = max(1, int(min_time / max(elapsed, 1e-7)))
+    for _ in range(repeat):
+        start = default_timer()
+        for _ in range(number):
+            operation()
+        samples.append((default_timer() - start) / number)
+    return {'seconds' : min(samples), 'number' : number,
+            'repeat' : len(samples)}
+
+
+def run_benchmarks(prefixes = None, min_time = 0.2, report = None,
+                   count = False):
+    '''Runs the registered benchmarks whose name starts with one of prefixes
+    (all of them by default). report(name, result) is called after each.
+    Returns the results (see the module documentation).'''
+    results = {}
+    for (name, setup, repeat) in BENCHMARKS:
+        if (prefixes is not None) \
+                and not any(name.startswith(prefix) for prefix in prefixes):
+            continue
+        seed(b'benchmark:' + name.encode())
+        operation = setup()
+        seed(None)
+        results[name] = measure(operation, repeat, min_time)
+        if count: # counted apart, not to slow down the timed calls
+            with count_operations() as counts:
+                operation()
+            results[name]['operations'] = dict(counts)
+        if report is not None:
+            report(name, results[name])
+    return {'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'timestamp' : int(time()),
+            'benchmarks' : results}
+
+
+def save_results(results, path):
+    filedes = open(path, 'w')
+    filedes.write(json.dumps(results, indent = 4, sort_keys = True))
+    filedes.close()
+
+
+def load_results(path):
+    filedes = open(path, 'r')
+    results = json.loads(filedes.read())
+    filedes.close()
+    return results
+
+
+def compare(results, baseline, threshold = THRESHOLD):
+    '''Compares results with a baseline. Returns a list of (name,
+    baseline_seconds, seconds, ratio, regressed) for the benchmarks of both,
+    regressed being True if the benchmark is slower than the baseline by more
+    than threshold (relative).'''
+    comparison = []
+    for name in sorted(results['benchmarks']):
+        if name not in baseline['benchmarks']:
+            continue
+        old = baseline['benchmarks'][name]['seconds']
+        new = results['benchmarks'][name]['seconds']
+        ratio = new / old if old > 0 else float('inf')
+        comparison.append((name, old, new, ratio, ratio > 1 + threshold))
+    return comparison
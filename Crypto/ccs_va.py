@@ -8,14 +8,24 @@ with a perfectly hiding commitment.
 @author: Richard Mathot
 '''
 
-from base64 import b64encode
-# pylint: disable=E0611
-from hashlib import sha256
+from Crypto.transcript import Transcript
 from NumberTheory.finite_fields import PF, PF2
-from NumberTheory.pairings import pairing
-from Random.random_sources import randint
+from NumberTheory.pairings import cached_pairing, pairing_lines, \
+    power_table
+from Random.random_sources import randint, randint_batch
 from NumberTheory.bn_curve import p_u_, n_u_
-from NumberTheory.elliptic_curves import EC
+from NumberTheory.elliptic_curves import EC, FixedBaseTable, batch_affine, \
+    sum_points, in_subgroup, multi_scalar, add_checked
+from Util.compat import izip
+
+
+# Order of the curve over F_p^2 (E itself, see in_subgroup): every point the
+# proofs use has an order dividing it
+G2_COFACTOR = 2 * p_u_ + 2 - n_u_
+G2_ORDER = n_u_ * G2_COFACTOR
+
+# Size of the random factors of the batched proof checks (see __holds)
+FACTOR_BITS = 128
 
 
 def init_curves():
@@ -56,8 +66,13 @@ def ccs_enc(m, r, s, g, h, g1, h1):
         - g, h, g1, h1, the public key
     '''
 
-    assert m == 0 | m == 1
+    assert m in (0, 1)
+
+    return __ccs_enc(m, r, s, g, h, g1, h1)
+
 
+def __ccs_enc(m, r, s, g, h, g1, h1):
+    '''CCS encryption without any restriction on m (used by the proofs)'''
     c0 = g * s
     c1 = g * r + g1 * s
     c2 = h * r + h1 * m
@@ -65,16 +80,38 @@ def ccs_enc(m, r, s, g, h, g1, h1):
     return (c0.affine(), c1.affine(), c2.affine())
 
 
-def ccs_dec(c0, c1, c2, g, h, h1, x1):
-    ''' Decryption for CCS Cryptosystem '''
-    basis = pairing(g, h1)
-    ct = pairing(c0 * x1 + ~c1, h) + pairing(g, c2)
-    # Addition ou multiplication entre les deux pairings ?
-    # TODO addition j'espère car sinon faut implémenter * dans F_12 :S
-    m = __dlog(ct, basis)
+def ccs_dec(c0, c1, c2, g, h, h1, x1, bound = None):
+    ''' Decryption for CCS Cryptosystem 
+
+        Returns m in [0, bound] (or None if it could not be found)
+    '''
+    basis = ccs_basis(g, h1)
+    return __ccs_dec_basis(c0, c1, c2, g, h, x1, basis, bound)
+
+
+def ccs_basis(g, h1):
+    '''Decryption basis pairing(g, h1) of a public key'''
+    return cached_pairing(g, h1)
+
+
+def __ccs_dec_basis(c0, c1, c2, g, h, x1, basis, bound, lines = None,
+                    dlog_table = None):
+    '''ccs_dec with a precomputed basis = pairing(g, h1)'''
+    # e(g, c2) / e(c1 - c0 * x1, h) = e(g, h1) ^ m
+    if lines is not None:
+        ct = cached_pairing(c0 * x1 - c1, h) * pairing_lines(lines, c2)
+    else:
+        ct = cached_pairing(c0 * x1 - c1, h) * cached_pairing(g, c2)
+    m = __dlog(ct, basis, bound, dlog_table)
     return m
 
 
+def ccs_add(c, d):
+    '''Homomorphic addition of two CCS ciphertexts (the result encrypts the 
+    sum of the messages)'''
+    return tuple(ci + di for ci, di in izip(c, d))
+
+
 def ccs_extract_c(c0, c1, c2):
     #pylint: disable=W0613
     ''' Extraction of the commitment '''
@@ -88,7 +125,7 @@ def ccs_extract_e(c0, c1, c2):
 
 
 def ccs_open(m, a, c2, g, h, h1):
-    if pairing(a, h) == pairing(g, c2 + ~(h1 * m)):
+    if cached_pairing(a, h) == cached_pairing(g, c2 - h1 * m):
         return m
     else:
         return None
@@ -99,24 +136,66 @@ def elgamal_dec(c0, c1, x1):
     return c1 - (c0 * x1)
 
 
+def response_order(h, h1):
+    '''Modulus of the responses of the proofs: n if the G2 constants h and h1
+    are in the subgroup of order n, G2_ORDER otherwise (h * (z mod n) would
+    not be h * z). Responses are reduced modulo it, and verifiers refuse the
+    ones that are not, so that a proof has a single encoding.'''
+    if in_subgroup(h) and in_subgroup(h1):
+        return n_u_
+    return G2_ORDER
+
+
 def ccsva_gen():
     return ccs_gen()
 
 
 def ccsva_enc(m, g, g1, h, h1):
-    r = randint(n_u_)
-    s = randint(n_u_)
-    c = (c0, c1, c2) = ccs_enc(m, r, s, g, h, g1, h1)
-    sigmacc = (ecc, zm, zr, zs) = __compute_cc_proof(m, r, s, c, g, h, g1, h1)
-    sigmaor = (e0, e1, t0, t1) = __compute_or_proof(m, c2, s, h, g1, h1)
+    return ccsva_enc_online(m, ccsva_precompute(g, g1, h, h1), g, g1, h, h1)
+
+
+def ccsva_precompute(g, g1, h, h1, tables = None):
+    '''Vote-independent part of ccsva_enc (offline phase)
+
+    Draws the randomness of the ciphertext and of both proofs and performs
+    every point multiplication (with the fixed-base tables of ccsva_tables if
+    given). The commitment and the simulated OR-proof branch are computed for
+    both possible votes, so that ccsva_enc_online only has to pick the right
+    values and hash them.
+
+    Returns (r, s, c0, c1, c2s, cc, orp, order) where c2s[m] is the
+    commitment on m, cc = (j, u, v, d), orp = (b, w, e, t, ws) with ws[m] the
+    simulated branch commitment when the vote is m, and order the modulus of
+    the responses (see response_order).'''
+    bases = (G, G1, H, _) = tables if tables is not None else (g, g1, h, h1)
+    (r, s, j, u, v, b, e, t) = randint_batch(n_u_, 8)
+    hr = H * r
+    ht = H * t
+    # Simulated branch 1 - m: h * t - (c2 - h1 * (1 - m)) * e
+    points = batch_affine([G * s, G * r + G1 * s, hr, hr + h1]
+                          + __ccs_commitments(j, u, v, bases)
+                          + [H * b, ht - (hr - h1) * e, ht - (hr + h1) * e])
+    (c0, c1, c2_0, c2_1, d0, d1, d2, w, ws0, ws1) = points
+    return (r, s, c0, c1, (c2_0, c2_1), (j, u, v, (d0, d1, d2)),
+            (b, w, e, t, (ws0, ws1)), response_order(h, h1))
+
+
+def ccsva_enc_online(m, precomputation, g, g1, h, h1):
+    '''Vote-dependent part of ccsva_enc (online phase)
+
+    Only selects precomputed points and hashes them: no point multiplication
+    is performed here. A precomputation must never be used twice.'''
+    assert m in (0, 1)
+    (r, s, c0, c1, c2s, cc, orp, order) = precomputation
+    key = (g, h, g1, h1)
+    c = (c0, c1, c2s[m])
+    sigmacc = __compute_cc_proof(m, r, s, c, cc, key, order)
+    sigmaor = __compute_or_proof(m, c2s[m], r, orp, key, order)
     return (c, sigmacc, sigmaor)
 
 
 def ccsva_dec(c0, c1, c2, sigmacc, sigmaor, g, h, g1, h1, x1):
-    (ecc, zm, zr, zs) = sigmacc
-    (e0, e1, t0, t1) = sigmaor
-    if __check_cc_proof(c0, c1, c2, ecc, zm, zr, zs, g, h, g1, h1) \
-                        & __check_or_proof(e0, e1, t0, t1, c2, h, g1, h1):
+    if ccsva_extrip(c0, c1, c2, sigmacc, sigmaor, g, h, g1, h1):
         return ccs_dec(c0, c1, c2, g, h, h1, x1)
     else:
         return None
@@ -130,107 +209,455 @@ def ccsva_open(m, a, c2, g, h, h1):
     return ccs_open(m, a, c2, g, h, h1)
 
 
-def ccsva_extrip(c0, c1, c2, sigmacc, sigmaor, g, h, g1, h1):
-    (ecc, zm, zr, zs) = sigmacc
-    (e0, e1, t0, t1) = sigmaor
-    if __check_cc_proof(c0, c1, c2, ecc, zm, zr, zs, g, h, g1, h1) \
-                        & __check_or_proof(e0, e1, t0, t1, c2, h, g1, h1):
-        return True
-    else:
-        return None
+def ccsva_extrip(c0, c1, c2, sigmacc, sigmaor, g, h, g1, h1, tables = None):
+    return ccsva_extrip_vector([(c0, c1, c2)], [sigmacc], [sigmaor], None,
+                               g, h, g1, h1, tables, exactly_one = False)
 
 
 def ccsva_extract_c(c0, c1, c2, sigmacc, sigmaor):
     return (ccs_extract_c(c0, c1, c2), sigmaor)
 
 
-def ccsva_strip(c2, sigmaor, h, g1, h1):
-    (e0, e1, t0, t1) = sigmaor
-    if __check_or_proof(e0, e1, t0, t1, c2, h, g1, h1):
+def ccsva_strip(c2, sigmaor, g, h, g1, h1, tables = None):
+    if ccsva_strip_vector([c2], [sigmaor], None, g, h, g1, h1, tables,
+                          exactly_one = False) is not None:
         return c2
     else:
         return None
 
 
-def __dlog(x, y):
+def __dlog(x, y, bound = None, table = None):
     '''Discrete logarithm extraction 
-    If x = y ^ z, performs an exhaustive search to find z'''
-
-    z = 1 #initialisé à 0 ou à 1 ?
-    accy = y
-    notfound = True
-    while notfound:
+    If x = y ^ z, performs an exhaustive search to find z (in [0, bound] if
+    bound is given, otherwise the search does not stop until z is found).
+    table = (lookup, size) gives the logarithms in [0, size) at once (see
+    ElectionContext.dlog_table). Otherwise the powers of y already computed
+    are looked up first (see power_table), the search going on after them.'''
+
+    if table is not None:
+        (lookup, size) = table
+        found = lookup(x)
+        if (found is not None) and (y ** found == x):
+            return found if (bound is None) or (found <= bound) else None
+        z = size
+        accy = y ** size
+    else:
+        powers = power_table(y)
+        found = powers.log(x, bound)
+        if found is not None:
+            return found if (bound is None) or (found <= bound) else None
+        z = powers.size
+        accy = powers.last * y
+    while (bound is None) or (z <= bound):
         if accy == x:
-            notfound = False
-        else:
-            accy = accy * y
-            z = z + 1
-    return z
+            return z
+        accy = accy * y
+        z = z + 1
+    return None
 
 
-def __compute_cc_proof(m, r, s, c, g, h, g1, h1):
-    j = randint(n_u_ - 1)
-    u = randint(n_u_ - 1)
-    v = randint(n_u_ - 1)
+def __cc_challenge(c0, c1, c2, d0, d1, d2, key):
+    '''Fiat-Shamir challenge of the ciphertext consistency proof. key is the
+    public key (g, h, g1, h1), absorbed by every challenge.'''
+    transcript = Transcript("ccs-va/cc")
+    transcript.absorb_points(*key)
+    transcript.absorb_points(c0, c1, c2, d0, d1, d2)
+    return transcript.challenge()
 
-    d = ccs_enc(j, u, v, g, h, g1, h1)
 
-    longstring = g1.__repr__() + h1.__repr__() + c.__repr__() + d.__repr__()
-    ecc = int((sha256(longstring).hexdigest()), 16)
-    # TODO faut il faire modulo n_u_ ?
+def __or_challenge(c2, w0, w1, key):
+    '''Fiat-Shamir challenge of the OR proof (e0 + e1 mod n_u_)'''
+    transcript = Transcript("ccs-va/or")
+    transcript.absorb_points(*key)
+    transcript.absorb_points(c2, w0, w1)
+    return transcript.challenge()
 
-    (zm, zr, zs) = (j + ecc * m, u + ecc * r, v + ecc * s)
 
-    return (ecc, zm, zr, zs)
+def __compute_cc_proof(m, r, s, c, cc, key, order):
+    '''CC proof (d0, d1, d2, zm, zr, zs): commitments and responses'''
+    (j, u, v, d) = cc
+    (c0, c1, c2) = c
+    (d0, d1, d2) = d
 
+    ecc = __cc_challenge(c0, c1, c2, d0, d1, d2, key)
 
-def __compute_or_proof(m, c2, s, h, g1, h1):
-    assert m == 0 | m == 1
+    (zm, zr, zs) = ((j + ecc * m) % order, (u + ecc * r) % order,
+                    (v + ecc * s) % order)
 
-    e0, e1, t0, t1, w0, w1 = None, None, None, None, None, None
-    b = randint(n_u_ - 1)
-
-    if m == 0:
-        e1 = randint(n_u_ - 1)
-        t1 = randint(n_u_ - 1)
-        w0 = h * b
-        w1 = h * t1 + (c2 - (h1 * 1)) * (-e1)
-        longstring = g1.__repr__() + h1.__repr__() + c2.__repr__() + w0.__repr__() + w1.__repr__()
-        e0 = int((sha256(longstring).hexdigest()), 16) - e1
-        # TODO faut il faire modulo n_u_ ?
-        t0 = b + e0 * s
+    return (d0, d1, d2, zm, zr, zs)
 
-    else:
-        e0 = randint(n_u_ - 1)
-        t0 = randint(n_u_ - 1)
-        w1 = h * b
-        w0 = h * t0 + (c2 - (h1 * 0)) * (-e0)
-        longstring = g1.__repr__() + h1.__repr__() + c2.__repr__() + w0.__repr__() + w1.__repr__()
-        e0 = int((sha256(longstring).hexdigest()), 16) - e0
-        # TODO faut il faire modulo n_u_ ?
-        t1 = b + e1 * s
-
-    return (e0, e1, t0, t1)
-
-
-def __check_cc_proof(c0, c1, c2, ecc, zm, zr, zs, g, h, g1, h1):
-    (tmp0, tmp1, tmp2) = ccs_enc(zm, zr, zs, g, h, g1, h1)
-    d = (d0, d1, d2) = (tmp0 * c0 - ecc, tmp1 * c1 - ecc, tmp2 * c2 - ecc)
-    if ecc == b64encode(sha256(g1, h1, (c0, c1, c2), d).digest()):
-        return True
-    else:
-        return None
 
+def __compute_or_proof(m, c2, r, orp, key, order):
+    '''OR proof (w0, w1, e0, t0, t1): commitments, challenge of the branch 0
+    (the one of the branch 1 is the rest of the Fiat-Shamir challenge) and
+    responses'''
+    assert m in (0, 1)
 
-def __check_or_proof(e0, e1, t0, t1, c2, h, g1, h1):
-    w0 = h * t0 + (c2 + ~h1 * 0) * (-e0)
-    w1 = h * t1 + (c2 + ~h1 * 1) * (-e1)
-    w = (w0, w1)
+    (b, w, e, t, ws) = orp
 
-    left = e0 + e1
-    right = b64encode(sha256(g1, h1, c2, w).digest())
+    if m == 0:
+        (w0, w1) = (w, ws[0])
+        e1, t1 = e, t
+        e0 = (__or_challenge(c2, w0, w1, key) - e1) % n_u_
+        t0 = (b + e0 * r) % order
 
-    if left == right:
-        return True
     else:
+        (w0, w1) = (ws[1], w)
+        e0, t0 = e, t
+        e1 = (__or_challenge(c2, w0, w1, key) - e0) % n_u_
+        t1 = (b + e1 * r) % order
+
+    return (w0, w1, e0, t0, t1)
+
+
+def __sum_challenge(c2s, a, key):
+    '''Fiat-Shamir challenge of the proof that the commitments sum to 1'''
+    transcript = Transcript("ccs-va/sum")
+    transcript.absorb_points(*key)
+    transcript.absorb_points(*c2s)
+    transcript.absorb_points(a)
+    return transcript.challenge()
+
+
+##########################################
+# Batched verification of the proofs     #
+##########################################
+# A proof is checked through equations sum(B * k) + sum(P * k) = O, the B
+# being the fixed bases of the group (g and g1 in G1, h and h1 in G2) and the
+# P points of the ballot. An equation is a pair ((k for each base),
+# [(P, k), ...]), the scalars being possibly negative. The proofs carry their
+# commitments, so that the challenges are hashes of values of the ballot and
+# the equations of a group of prime order can be checked at once, with a
+# random linear combination (__holds).
+
+def __cc_equations(c, sigmacc, key, order):
+    '''Equations (G1 equations, G2 equations) of a CC proof, or None if its
+    responses are not in [0, order)'''
+    (c0, c1, c2) = c
+    (d0, d1, d2, zm, zr, zs) = sigmacc
+    if not all(0 <= z < order for z in (zm, zr, zs)):
+        return None
+    ecc = __cc_challenge(c0, c1, c2, d0, d1, d2, key)
+    # g * zs = d0 + c0 * ecc, g * zr + g1 * zs = d1 + c1 * ecc,
+    # h * zr + h1 * zm = d2 + c2 * ecc
+    return ([((zs, 0), [(c0, -ecc), (d0, -1)]),
+             ((zr, zs), [(c1, -ecc), (d1, -1)])],
+            [((zr, zm), [(c2, -ecc), (d2, -1)])])
+
+
+def __public_equations(c2s, sigmaors, sigmasum, key, order, exactly_one):
+    '''G2 equations of the OR proofs and of the sum proof of a ballot, or
+    None if a proof is malformed (values out of range, missing sum proof)'''
+    equations = []
+    for c2, (w0, w1, e0, t0, t1) in izip(c2s, sigmaors):
+        if (not 0 <= e0 < n_u_) | (not 0 <= t0 < order) \
+                | (not 0 <= t1 < order):
+            return None
+        e1 = (__or_challenge(c2, w0, w1, key) - e0) % n_u_
+        # h * t0 = w0 + c2 * e0, h * t1 = w1 + (c2 - h1) * e1
+        equations.append(((t0, 0), [(c2, -e0), (w0, -1)]))
+        equations.append(((t1, e1), [(c2, -e1), (w1, -1)]))
+    if exactly_one:
+        if sigmasum is None:
+            return None
+        (a, z) = sigmasum
+        if not 0 <= z < order:
+            return None
+        esum = __sum_challenge(c2s, a, key)
+        # h * z = a + (sum(c2) - h1) * esum
+        equations.append(((z, esum), [(c2, -esum) for c2 in c2s]
+                          + [(a, -1)]))
+    return equations
+
+
+def __g2_batched(equations, order):
+    '''Whether the G2 equations can be checked at once (see __holds): True if
+    the G2 constants are in the subgroup of order n and so are the points of
+    the equations, None if these points are not while the constants are,
+    False if the constants are not (usual case)'''
+    if order != n_u_:
+        return False
+    if all(in_subgroup(P) for (_, terms) in equations for (P, _) in terms):
+        return True
+    return None
+
+
+def __holds(equations, bases, batched = True):
+    '''Checks a list of equations of the same group. bases are points or
+    FixedBaseTable.
+
+    If batched, each equation is multiplied by a random factor of
+    FACTOR_BITS bits and their sum is computed with a single multi-scalar
+    multiplication, the terms of a point (c2 appears in several equations)
+    and of a fixed base being gathered, every scalar being reduced modulo n.
+    This is only sound in a group of order n, where a false equation makes
+    the sum vanish with probability 2^-FACTOR_BITS: G1, and G2 if its points
+    are in the subgroup of order n. Otherwise the order of G2 has small
+    factors (3 and 118189 divide G2_COFACTOR), and a point of small order
+    added to a commitment would go unnoticed for a fraction of the random
+    factors (multiplying the sum by the cofactor would not help either: the
+    decryption depends on the components it would discard). The equations are
+    then checked one by one, each with its own multi-scalar multiplication
+    and exact scalars.'''
+    if not batched:
+        points = [B.point if isinstance(B, FixedBaseTable) else B
+                  for B in bases]
+        return all(__vanishes([], [(P, k) for (P, k) in izip(points, ks)]
+                              + terms)
+                   for (ks, terms) in equations)
+    if not equations:
+        return True
+    factors = randint_batch(1 << FACTOR_BITS, len(equations))
+    fixed = [0] * len(bases)
+    points = []
+    scalars = []
+    positions = {}
+    for factor, (ks, terms) in izip(factors, equations):
+        for i, k in enumerate(ks):
+            fixed[i] += factor * k
+        for (P, k) in terms:
+            if id(P) not in positions:
+                positions[id(P)] = len(points)
+                points.append(P)
+                scalars.append(0)
+            scalars[positions[id(P)]] += factor * k
+    tables = [(B, k % n_u_) for B, k in izip(bases, fixed)
+              if isinstance(B, FixedBaseTable)]
+    terms = [(B, k) for B, k in izip(bases, fixed)
+             if not isinstance(B, FixedBaseTable)]
+    # P * k = (-P) * (n - k): the points of the proofs have factors of
+    # FACTOR_BITS bits, with a negative sign
+    for P, k in izip(points, scalars):
+        k = k % n_u_
+        terms.append((P, k - n_u_) if k > n_u_ // 2 else (P, k))
+    return __vanishes(tables, terms)
+
+
+def __vanishes(tables, terms):
+    '''Whether sum(B * k for (B, k) in tables) + sum(P * k for (P, k) in
+    terms) is the point at infinity, B being FixedBaseTable, k >= 0 for them,
+    and k of any sign for the points P'''
+    terms = [(-P, -k) if k < 0 else (P, k) for (P, k) in terms]
+    total = multi_scalar([P for (P, _) in terms], [k for (_, k) in terms])
+    for (B, k) in tables:
+        total = add_checked(total, B * k)
+    return total.infinite
+
+
+############################################
+# Multi-candidate ballots (vector of bits) #
+############################################
+
+def ccsva_tables(g, g1, h, h1, window = 4):
+    '''Fixed-base tables for the public key, to be passed as the tables
+    parameter of the vector functions below. Building them costs about as
+    much as a few tens of scalar multiplications, so they should be computed
+    once per election.'''
+    return tuple(FixedBaseTable(P, window) for P in (g, g1, h, h1))
+
+
+def ccsva_enc_vector(ms, g, g1, h, h1, tables = None, exactly_one = True):
+    '''Encrypts a vote vector ms (one bit per answer) in a single pass.
+
+    Each bit gets its own ciphertext, CC proof and OR proof. If exactly_one
+    is True (single choice ballot), an additional proof shows that the
+    commitments sum to 1; otherwise (approval ballot) sigmasum is None.
+
+    Returns (cs, sigmaccs, sigmaors, sigmasum).'''
+    assert all(m in (0, 1) for m in ms)
+    assert (not exactly_one) | (sum(ms) == 1)
+    bases = (G, G1, H, H1) = tables if tables is not None else (g, g1, h, h1)
+
+    order = response_order(h, h1)
+    key = (g, h, g1, h1)
+    k = len(ms)
+    scalars = randint_batch(n_u_, 8 * k + 1)
+    rows = [scalars[8 * i:8 * (i + 1)] for i in range(k)]
+
+    # Every point of the ballot is normalised with a single batch inversion
+    points = []
+    for m, (r, s, j, u, v, b, e, t) in izip(ms, rows):
+        hr = H * r
+        c2 = hr + h1 if m else hr
+        points.extend([G * s, G * r + G1 * s, c2])
+        points.extend(__ccs_commitments(j, u, v, bases))
+        # Simulated branch 1 - m: h * t - (c2 - h1 * (1 - m)) * e
+        points.extend([H * b, H * t - (c2 if m else hr - h1) * e])
+    if exactly_one:
+        points.append(H * scalars[-1])
+    points = batch_affine(points)
+
+    cs, sigmaccs, sigmaors = [], [], []
+    for i, (m, (r, s, j, u, v, b, e, t)) in enumerate(izip(ms, rows)):
+        (c0, c1, c2, d0, d1, d2, w, ws) = points[8 * i:8 * (i + 1)]
+        cs.append((c0, c1, c2))
+        sigmaccs.append(__compute_cc_proof(m, r, s, (c0, c1, c2),
+                                           (j, u, v, (d0, d1, d2)), key,
+                                           order))
+        sigmaors.append(__compute_or_proof(m, c2, r, (b, w, e, t, (ws, ws)),
+                                           key, order))
+
+    sigmasum = None
+    if exactly_one:
+        # sum(c2) - h1 = h * sum(r): proof of knowledge of sum(r)
+        a = points[-1]
+        esum = __sum_challenge([c[2] for c in cs], a, key)
+        sigmasum = (a, (scalars[-1] + esum * sum(row[0] for row in rows))
+                       % order)
+
+    return (cs, sigmaccs, sigmaors, sigmasum)
+
+
+def __ccs_commitments(m, r, s, bases):
+    '''__ccs_enc with fixed bases, without normalisation'''
+    (G, G1, H, H1) = bases
+    return [G * s, G * r + G1 * s, H * r + H1 * m]
+
+
+def ccsva_precompute_vector(k, g, g1, h, h1, tables = None,
+                            exactly_one = True):
+    '''Vote-independent part of ccsva_enc_vector for k answers (offline
+    phase): a ccsva_precompute per answer and, if exactly_one, the
+    commitment of the sum proof (h * a does not depend on the vote). Returns
+    (precomputations, (a, h * a) or None).'''
+    precomputations = [ccsva_precompute(g, g1, h, h1, tables)
+                       for _ in range(k)]
+    if not exactly_one:
+        return (precomputations, None)
+    H = tables[2] if tables is not None else h
+    a = randint(n_u_)
+    return (precomputations, (a, (H * a).affine()))
+
+
+def ccsva_enc_vector_online(ms, precomputation, g, g1, h, h1,
+                            exactly_one = True):
+    '''Vote-dependent part of ccsva_enc_vector (online phase), with the same
+    output: only selects precomputed points and hashes them. A precomputation
+    must never be used twice.'''
+    assert (not exactly_one) | (sum(ms) == 1)
+    (precomputations, sum_precomputation) = precomputation
+    assert len(precomputations) == len(ms)
+    ballots = [ccsva_enc_online(m, pre, g, g1, h, h1)
+               for m, pre in izip(ms, precomputations)]
+    cs = [c for (c, _, _) in ballots]
+    sigmasum = None
+    if exactly_one:
+        (a, A) = sum_precomputation
+        esum = __sum_challenge([c[2] for c in cs], A, (g, h, g1, h1))
+        order = precomputations[0][-1]
+        sigmasum = (A, (a + esum * sum(pre[0] for pre in precomputations))
+                       % order)
+    return (cs, [sigmacc for (_, sigmacc, _) in ballots],
+            [sigmaor for (_, _, sigmaor) in ballots], sigmasum)
+
+
+def ccsva_extrip_vector(cs, sigmaccs, sigmaors, sigmasum, g, h, g1, h1,
+                        tables = None, exactly_one = True):
+    '''Checks every proof of a multi-candidate ballot at once (vector
+    counterpart of ccsva_extrip).
+
+    The proofs carry their commitments: the challenges are hashed from the
+    ballot alone, without recomputing any point, then the equations of all
+    the components are checked with one random linear combination in G1 (a
+    single multi-scalar multiplication). The G2 equations (one for the CC
+    proof and two for the OR proof of each component, plus the sum proof)
+    are only combined the same way if the G2 constants are in the subgroup
+    of order n; with the usual constants they are checked one by one, each
+    with a multi-scalar multiplication of three or four points (see
+    __holds).'''
+    if (len(cs) == 0) | (len(sigmaccs) != len(cs)) | (len(sigmaors) != len(cs)):
+        return None
+    order = response_order(h, h1)
+    key = (g, h, g1, h1)
+    equations = __public_equations([c[2] for c in cs], sigmaors, sigmasum,
+                                   key, order, exactly_one)
+    if equations is None:
         return None
+    equations1 = []
+    for c, sigmacc in izip(cs, sigmaccs):
+        cc = __cc_equations(c, sigmacc, key, order)
+        if cc is None:
+            return None
+        equations1.extend(cc[0])
+        equations.extend(cc[1])
+    batched = __g2_batched(equations, order)
+    if batched is None:
+        return None
+    bases = tables if tables is not None else (g, g1, h, h1)
+    if __holds(equations1, bases[:2]) \
+            and __holds(equations, bases[2:], batched):
+        return True
+    return None
+
+
+def ccsva_strip_vector(c2s, sigmaors, sigmasum, g, h, g1, h1, tables = None,
+                       exactly_one = True):
+    '''Checks the public part (commitments, OR proofs and sum proof) of a
+    multi-candidate ballot (vector counterpart of ccsva_strip)'''
+    return ccsva_strip_batch([(c2s, sigmaors, sigmasum)], g, h, g1, h1,
+                             tables, exactly_one)[0]
+
+
+def ccsva_strip_batch(ballots, g, h, g1, h1, tables = None,
+                      exactly_one = True):
+    '''ccsva_strip_vector for a list of ballots (c2s, sigmaors, sigmasum).
+    If the G2 constants are in the subgroup of order n, the equations of all
+    the ballots are checked with a single random linear combination, and
+    each ballot on its own only if it fails, to find the invalid ones;
+    otherwise every equation is checked on its own (see __holds). Returns
+    the list of the results of ccsva_strip_vector.'''
+    bases = tables[2:] if tables is not None else (h, h1)
+    order = response_order(h, h1)
+    key = (g, h, g1, h1)
+
+    checked = []
+    for (c2s, sigmaors, sigmasum) in ballots:
+        equations = None
+        if (len(c2s) != 0) & (len(sigmaors) == len(c2s)):
+            equations = __public_equations(c2s, sigmaors, sigmasum, key,
+                                           order, exactly_one)
+        if (equations is not None) \
+                and (__g2_batched(equations, order) is None):
+            equations = None
+        checked.append(equations)
+
+    batched = __g2_batched([], order)
+    if (not batched) or not __holds([equation for equations in checked
+                                     if equations is not None
+                                     for equation in equations], bases):
+        checked = [equations if (equations is not None)
+                   and __holds(equations, bases, batched) else None
+                   for equations in checked]
+    return [c2s if equations is not None else None
+            for ((c2s, _, _), equations) in izip(ballots, checked)]
+
+
+def ccs_tally_vector(ballots):
+    '''Homomorphic component-wise sum of the ciphertext vectors of a list of
+    ballots (all with the same number of components). Returns the vector of
+    aggregated ciphertexts, in affine coordinates. Each point of the
+    aggregate is summed by sum_points, with the vector formulas for large
+    tallies.'''
+    ballots = list(ballots)
+    if not ballots:
+        return []
+    k = len(ballots[0])
+    assert all(len(cs) == k for cs in ballots)
+    totals = [tuple(sum_points([cs[i][j] for cs in ballots])
+                    for j in range(3)) for i in range(k)]
+    flat = batch_affine([P for t in totals for P in t])
+    return [tuple(flat[3 * i:3 * (i + 1)]) for i in range(len(totals))]
+
+
+def ccs_dec_vector(cs, g, h, h1, x1, bound = None, basis = None,
+                   lines = None, dlog_table = None):
+    '''Decrypts a vector of (aggregated) ciphertexts. The decryption basis
+    pairing(g, h1) is computed once for all the components (or given, see
+    ccs_basis). The election precomputations may be given as well: the
+    Miller loop lines of g (see miller_lines) and a discrete logarithm table
+    (see __dlog).'''
+    if basis is None:
+        basis = ccs_basis(g, h1)
+    return [__ccs_dec_basis(c0, c1, c2, g, h, x1, basis, bound, lines,
+                            dlog_table)
+            for (c0, c1, c2) in cs]
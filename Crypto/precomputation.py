@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+''' precomputation.py
+
+Offline/online split of the CCS encryption with validity augmentations.
+All the point multiplications of ccsva_enc do not depend on the vote, so they
+can be performed in the background while the voter is still choosing. Once the
+vote is known, encrypting it only consists in selecting precomputed points and
+hashing them. The same goes for the ballots of multi-candidate elections
+(ccsva_precompute_vector), one 0/1 precomputation per answer.
+
+@author: Richard Mathot
+'''
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError: # Python 3
+    from queue import Queue, Empty, Full
+from threading import Event, Thread
+from Crypto.ccs_va import ccsva_precompute, ccsva_enc_online, \
+    ccsva_precompute_vector, ccsva_enc_vector_online
+
+
+class PrecomputationPool(object):
+    '''A bounded pool of vote-independent ccsva_enc precomputations, refilled
+    by a background thread'''
+
+    g = None
+    g1 = None
+    h = None
+    h1 = None
+    answers = None
+    exactly_one = None
+    tables = None
+    queue = None
+
+    def __init__(self, g, g1, h, h1, size = 4, answers = None,
+                 exactly_one = True, tables = None):
+        '''Starts filling a pool of at most size precomputations for the
+        public key (g, g1, h, h1). answers is the number of answers of a
+        multi-candidate election (exactly_one for a single choice one), whose
+        ballots are then precomputed whole, None for a 0/1 election. tables
+        are the fixed-base tables of the key (see ccsva_tables), if any.'''
+        assert size > 0
+        self.g = g
+        self.g1 = g1
+        self.h = h
+        self.h1 = h1
+        self.answers = answers
+        self.exactly_one = exactly_one
+        self.tables = tables
+        self.queue = Queue(size)
+        self._stopped = Event()
+        self._worker = Thread(target = self._fill)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _fill(self):
+        '''Background loop: blocks while the pool is full'''
+        while not self._stopped.is_set():
+            precomputation = self._precompute()
+            while not self._stopped.is_set():
+                try:
+                    self.queue.put(precomputation, timeout = 0.5)
+                    break
+                except Full:
+                    continue
+
+    def available(self):
+        '''Number of precomputations ready to be used'''
+        return self.queue.qsize()
+
+    def take(self, block = True):
+        '''Removes a precomputation from the pool. If the pool is empty and
+        block is False, computes one on the fly.'''
+        try:
+            return self.queue.get(block)
+        except Empty:
+            return self._precompute()
+
+    def _precompute(self):
+        if self.answers is None:
+            return ccsva_precompute(self.g, self.g1, self.h, self.h1,
+                                    self.tables)
+        return ccsva_precompute_vector(self.answers, self.g, self.g1, self.h,
+                                       self.h1, self.tables, self.exactly_one)
+
+    def encrypt(self, m):
+        '''Online encryption of the vote m (0 or 1), same output as ccsva_enc
+        (0/1 elections)'''
+        assert self.answers is None
+        return ccsva_enc_online(m, self.take(), self.g, self.g1, self.h,
+                                self.h1)
+
+    def encrypt_vector(self, ms):
+        '''Online encryption of the vote vector ms, same output as
+        ccsva_enc_vector (multi-candidate elections)'''
+        assert len(ms) == self.answers
+        return ccsva_enc_vector_online(ms, self.take(), self.g, self.g1,
+                                       self.h, self.h1, self.exactly_one)
+
+    def stop(self, wait = False):
+        '''Stops refilling the pool (the background thread finishes the
+        precomputation in progress unless the process exits before)'''
+        self._stopped.set()
+        if wait:
+            self._worker.join()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+''' signature.py
+
+Schnorr signatures over G_1, with the challenge derived from a Fiat-Shamir
+transcript (see transcript.py). Used to sign the roots of the public board.
+
+    key pair:   x in [1, n_u_ - 1], y = g * x
+    sign:       R = g * k, e = H(g, y, R, message), s = k + e.x mod n_u_
+    verify:     e = H(g, y, g * s - y * e, message)
+
+@author: Richard Mathot
+'''
+
+from Crypto.transcript import Transcript
+from NumberTheory.bn_curve import n_u_
+from Random.random_sources import randint
+
+
+def schnorr_gen(g):
+    '''Key pair (y, x) for the generator g'''
+    x = randint(n_u_ - 2) + 1
+    return ((g * x).affine(), x)
+
+
+def schnorr_sign(message, x, g, y):
+    '''Signature (e, s) of the byte string message'''
+    k = randint(n_u_ - 2) + 1
+    e = __challenge(g, y, g * k, message)
+    return (e, (k + e * x) % n_u_)
+
+
+def schnorr_verify(message, signature, g, y):
+    '''True if signature is a valid signature of message for the public key y,
+    None otherwise'''
+    (e, s) = signature
+    if (not 0 <= e < n_u_) | (not 0 <= s < n_u_):
+        return None
+    if e == __challenge(g, y, g * s - y * e, message):
+        return True
+    return None
+
+
+def __challenge(g, y, R, message):
+    transcript = Transcript("schnorr")
+    transcript.absorb_points(g, y, R)
+    transcript.absorb_bytes(message)
+    return transcript.challenge()
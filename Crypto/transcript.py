@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+''' transcript.py
+
+Fiat-Shamir transcript used to derive the challenges of the non-interactive
+proofs. Points are absorbed through their canonical binary encoding (fixed
+length, big-endian, affine coordinates), so that the prover and the verifier
+hash exactly the same bytes whatever the internal representation of their
+points is.
+
+@author: Richard Mathot
+'''
+
+# pylint: disable=E0611
+from hashlib import sha256
+from NumberTheory.bn_curve import n_u_
+from NumberTheory.elliptic_curves import batch_affine
+from NumberTheory.finite_fields import int_to_bytes
+
+
+class Transcript(object):
+    '''An append-only hash transcript producing challenges modulo n_u_'''
+
+    def __init__(self, label):
+        '''Starts a transcript for the proof identified by label (a string
+        used for domain separation)'''
+        self._hash = sha256(int_to_bytes(len(label), 2) + label.encode('ascii'))
+        self._pending = []
+
+    def absorb_points(self, *points):
+        '''Appends points to the transcript. Normalisation to affine
+        coordinates is deferred so that all the pending points share a single
+        field inversion.'''
+        self._pending.extend(points)
+        return self
+
+    def absorb_bytes(self, data):
+        '''Appends a byte string (length-prefixed) to the transcript'''
+        self._flush()
+        self._hash.update(int_to_bytes(len(data), 8) + data)
+        return self
+
+    def _flush(self):
+        if self._pending:
+            for P in batch_affine(self._pending):
+                self._hash.update(P.to_bytes())
+            self._pending = []
+
+    def challenge(self):
+        '''Challenge in [0, n_u_ - 1] derived from everything absorbed so far'''
+        self._flush()
+        return int(self._hash.copy().hexdigest(), 16) % n_u_
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+''' acceptance.py
+
+Ballot acceptance: verification of a ballot (see Election/validation.py) and
+storage of the accepted ballots on the secret and public boards of an
+election (see Election/storage.py).
+
+@author: Richard Mathot
+'''
+
+import json
+from os import remove
+from Election.replay import entry_commitments
+from Election.validation import validate
+from Util.compat import to_bytes
+from Util.tracing import span
+
+
+def verify_ballot(context, ballot_raw, replay = None):
+    '''Verifies a ballot given as the content of its file (JSON or binary
+    encoding). Returns (ballot_fingerprint, public_ballot), public_ballot being
+    None if the ballot is refused.
+    The checks run from the cheapest to the most expensive, the proofs last
+    (see Election/validation.py). If the replay index of the election is
+    given, a ballot that was already accepted (same fingerprint or same
+    commitments) is refused before its proofs are verified.'''
+    (ballot_fingerprint, public_ballot, _) = validate(context, ballot_raw,
+                                                      replay)
+    return (ballot_fingerprint, public_ballot)
+
+
+def store_ballot(storage, ballot_fingerprint, ballot_raw, public_ballot):
+    '''Appends an accepted ballot to the secret board and its public part to
+    the public board (and to its Merkle tree). The write is only durable after
+    storage.commit().
+    Returns False, and stores nothing, if a ballot of the same fingerprint or
+    with the same commitments was already stored.'''
+    with span('accept.store'):
+        if storage.replay is not None:
+            if storage.replay.seen(ballot_fingerprint,
+                                   entry_commitments(public_ballot)):
+                return False
+            storage.replay.add(ballot_fingerprint, public_ballot)
+        storage.sb.append(ballot_fingerprint, ballot_raw)
+        storage.pb.append(ballot_fingerprint,
+                          to_bytes(json.dumps(public_ballot, indent = 4)))
+        if storage.merkle is not None:
+            storage.merkle.append(ballot_fingerprint)
+        return True
+
+
+def accept_ballot(context, ballot_raw, storage, ballot_path = None):
+    '''Verifies and durably stores a ballot (ballot_raw is the content of
+    its file). If ballot_path is given, the file is removed once the ballot is
+    stored (it is moved to the secret board).
+    Returns (ballot_fingerprint, accepted).'''
+    with span('accept'):
+        (ballot_fingerprint, public_ballot) = verify_ballot(context, ballot_raw,
+                                                            storage.replay)
+        if (public_ballot is None) \
+                or not store_ballot(storage, ballot_fingerprint, ballot_raw,
+                                    public_ballot):
+            return (ballot_fingerprint, False)
+        with span('accept.commit'):
+            storage.commit()
+        if ballot_path is not None:
+            with span('accept.remove'):
+                remove(ballot_path)
+        return (ballot_fingerprint, True)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+''' artifact.py
+
+Precomputation artifact of an election (<name>.ctx in the .edata folder).
+The file is memory-mapped read-only, so that every process of the host that
+loads the same election shares its pages, and each section is only checked
+and decoded when it is used for the first time.
+
+Layout (integers are big-endian, sections start on page boundaries):
+
+    header      magic 'UVC' | version (1 byte) | settings fingerprint
+                (32 bytes) | number of sections (uint32)
+    directory   per section: name (4 bytes) | offset (uint64) |
+                length (uint64) | CRC32 of the section (uint32)
+    sections    fixed-width records, see Election/context.py
+
+An artifact written for other settings or by another version is ignored.
+
+@author: Richard Mathot
+'''
+
+import mmap
+import struct
+from bisect import bisect_left
+from os import getpid, rename
+from zlib import crc32
+
+ARTIFACT_MAGIC = b'UVC'
+ARTIFACT_VERSION = 2
+PAGE_SIZE = mmap.ALLOCATIONGRANULARITY
+
+_HEADER = struct.Struct('>3sB32sI')
+_SECTION = struct.Struct('>4sQQI')
+
+
+class ElectionArtifact(object):
+    '''Read-only, memory-mapped view of an artifact'''
+
+    path = None
+
+    def __init__(self, path, fingerprint):
+        '''Maps the artifact at path if it exists and belongs to the settings
+        of (binary) fingerprint; otherwise the artifact is empty'''
+        self.path = path
+        self._map = None
+        self._sections = {}
+        self._checked = set()
+        try:
+            filedes = open(path, 'rb')
+        except IOError:
+            return
+        try:
+            self._map = mmap.mmap(filedes.fileno(), 0,
+                                  access = mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError): # empty file
+            return
+        finally:
+            filedes.close()
+        if len(self._map) < _HEADER.size:
+            return
+        (magic, version, owner, count) = \
+            _HEADER.unpack(self._map[:_HEADER.size])
+        if (magic != ARTIFACT_MAGIC) | (version != ARTIFACT_VERSION) \
+                | (owner != fingerprint) \
+                | (_HEADER.size + count * _SECTION.size > len(self._map)):
+            return
+        for i in range(count):
+            start = _HEADER.size + i * _SECTION.size
+            (name, offset, length, checksum) = \
+                _SECTION.unpack(self._map[start:start + _SECTION.size])
+            if offset + length <= len(self._map):
+                self._sections[name] = (offset, length, checksum)
+
+    def __contains__(self, name):
+        return name in self._sections
+
+    def names(self):
+        return list(self._sections)
+
+    def section(self, name):
+        '''Content of a section (a copy), None if it is missing or corrupted'''
+        if not self._check(name):
+            return None
+        (offset, length, _) = self._sections[name]
+        return self._map[offset:offset + length]
+
+    def view(self, name):
+        '''A section read in place (see SectionView), None if it is missing
+        or corrupted'''
+        if not self._check(name):
+            return None
+        (offset, length, _) = self._sections[name]
+        return SectionView(self._map, offset, length)
+
+    def record_table(self, name, key_size, value_format):
+        '''Sorted fixed-width records of a section, searched in place (see
+        RecordTable); None if the section is missing or corrupted'''
+        if not self._check(name):
+            return None
+        (offset, length, _) = self._sections[name]
+        return RecordTable(self._map, offset, length, key_size, value_format)
+
+    def _check(self, name):
+        '''CRC check of a section, the first time it is used'''
+        if name not in self._sections:
+            return False
+        if name not in self._checked:
+            (offset, length, checksum) = self._sections[name]
+            # Checked by chunks, not to copy a large section at once
+            crc = 0
+            for start in range(offset, offset + length, 1 << 20):
+                crc = crc32(self._map[start:min(start + (1 << 20),
+                                                offset + length)], crc)
+            if crc & 0xffffffff != checksum:
+                del self._sections[name]
+                return False
+            self._checked.add(name)
+        return True
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class SectionView(object):
+    '''A section read in place from a memory map: only the ranges that are
+    read are copied'''
+
+    def __init__(self, data, offset, length):
+        self._data = data
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self, start, length):
+        '''length bytes of the section from start'''
+        start += self._offset
+        return self._data[start:start + length]
+
+
+class RecordTable(object):
+    '''Records (key, values) of fixed width, sorted by key, read in place
+    from a memory map with a binary search'''
+
+    def __init__(self, data, offset, length, key_size, value_format):
+        self._data = data
+        self._offset = offset
+        self._key_size = key_size
+        self._value = struct.Struct(value_format)
+        self._width = key_size + self._value.size
+        self._count = length // self._width
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        '''Key of the i-th record (so that bisect can search the table)'''
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        start = self._offset + i * self._width
+        return self._data[start:start + self._key_size]
+
+    def get(self, key):
+        '''Values of the record of key, None if there is none'''
+        i = bisect_left(self, key)
+        if (i == self._count) or (self[i] != key):
+            return None
+        start = self._offset + i * self._width + self._key_size
+        return self._value.unpack(self._data[start:start + self._value.size])
+
+
+def write_artifact(path, fingerprint, sections):
+    '''Writes an artifact. sections is a list of (name, content). The file is
+    written aside and then renamed, so that readers never see a partial
+    artifact (processes that mapped the previous one keep it).'''
+    offset = _HEADER.size + len(sections) * _SECTION.size
+    directory = []
+    for (name, content) in sections:
+        offset += -offset % PAGE_SIZE
+        directory.append(_SECTION.pack(name, offset, len(content),
+                                       crc32(content) & 0xffffffff))
+        offset += len(content)
+    parts = [_HEADER.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, fingerprint,
+                          len(sections))] + directory
+    position = _HEADER.size + len(sections) * _SECTION.size
+    for (_, content) in sections:
+        parts.append(b'\x00' * (-position % PAGE_SIZE))
+        position += -position % PAGE_SIZE
+        parts.append(content)
+        position += len(content)
+    temporary = path + ".%d.tmp" % getpid()
+    filedes = open(temporary, 'wb')
+    filedes.write(b''.join(parts))
+    filedes.close()
+    rename(temporary, path)
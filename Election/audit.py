@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+''' audit.py
+
+Election audit. Every entry of the public board (commitments c2 and OR proofs)
+is verified again (ccsva_strip, batched over several ballots) and checked
+against the secret board: both boards must hold the same fingerprints, every
+secret ballot must match its fingerprint and carry the same commitments as
+its public entry. The commitments of the valid entries are summed up into the
+running tally of the public board.
+
+Audits are incremental: the fingerprints of the verified entries are appended
+to <edata>/audit.log, and <edata>/audit.json holds the checkpoint:
+
+    position  number of verified entries
+    chain     head of a hash chain over them
+    tally     running tally (sum of their commitments c2, public board)
+    secret    {'count', 'aggregate'}: number of verified entries and sum of
+              the commitments c2 of their secret ballots (the sum
+              compute_tally.py decrypts)
+    bad       {fingerprint: reason} of the entries that failed the audit
+
+A re-audit only decodes and verifies the new entries (the known-bad ones are
+reported again, not verified again), but it recomputes the hash chain over
+the contents of the public board and checks every audited secret ballot
+against its fingerprint, so that an entry modified or removed after it was
+audited is detected (the audit then starts over). Both running sums can then
+be carried over: the audit starts over too if they differ.
+
+    chain_0 = sha256(election fingerprint)
+    chain_i = sha256(chain_(i-1) || fingerprint_i || sha256(entry_i))
+
+@author: Richard Mathot
+'''
+
+import json
+# pylint: disable=E0611
+from binascii import unhexlify
+from hashlib import sha256
+from multiprocessing import Pool
+from os import fsync, rename
+from os.path import exists
+from Crypto.ccs_va import ccsva_strip_batch
+from Election.context import load_context
+from Election.storage import open_storage
+from Election.wire import decode_any, decode_public_ballot, WireError
+from NumberTheory.elliptic_curves import sum_points
+from Util.compat import hexstr
+from Util.tracing import span
+
+CHECKPOINT = "audit.json"
+AUDIT_LOG = "audit.log"
+
+# The election context of a worker process (see _init_worker)
+_worker_context = None
+
+
+def _init_worker(settings_path):
+    '''Loads the election once in each worker process'''
+    #pylint: disable=W0603
+    global _worker_context
+    _worker_context = load_context(settings_path, precompute = True)
+
+
+def _audit_batch(entries):
+    '''Runs in a worker process (see audit_batch)'''
+    return audit_batch(_worker_context, entries)
+
+
+def audit_batch(context, entries):
+    '''Verifies a batch of (fingerprint, public_raw, secret_raw) entries.
+    Returns (problems, tally, secret): problems is a list of (fingerprint,
+    reason), tally the sum of the commitments of the valid entries and secret
+    the sum of those of their secret ballots (compressed JSON points, None if
+    there is no valid entry).'''
+    problems = []
+    decoded = []
+    with span('audit.decode'):
+        for (fingerprint, public_raw, secret_raw) in entries:
+            try:
+                public = decode_public_ballot(json.loads(public_raw), context)
+            except ValueError:
+                problems.append((fingerprint, "unreadable public entry"))
+                continue
+            (reason, secret_c2s) = _check_secret(context, fingerprint,
+                                                 secret_raw, public[0])
+            if reason is not None:
+                problems.append((fingerprint, reason))
+                continue
+            decoded.append((fingerprint, public, secret_c2s))
+
+    with span('audit.verify'):
+        results = ccsva_strip_batch([public for (_, public, _) in decoded],
+                                    context.g, context.h, context.g1,
+                                    context.h1,
+                                    context.tables(),
+                                    context.is_vector()
+                                    and context.is_single())
+    tally = None
+    secret = []
+    for (fingerprint, (c2s, _, _), secret_c2s), result in zip(decoded,
+                                                             results):
+        if result is None:
+            problems.append((fingerprint, "invalid proof"))
+            continue
+        if tally is None:
+            tally = list(c2s)
+        else:
+            tally = [a + b for (a, b) in zip(tally, c2s)]
+        secret.append(secret_c2s)
+    return (problems, encode_tally(tally), secret_tally(secret))
+
+
+def _check_secret(context, fingerprint, secret_raw, c2s):
+    '''(reason, secret_c2s): reason why the secret ballot does not match its
+    public entry (None if it does) and its commitments'''
+    if secret_raw is None:
+        return ("missing on the secret board", None)
+    if sha256(secret_raw).hexdigest() != fingerprint:
+        return ("secret ballot does not match its fingerprint", None)
+    try:
+        (_, (cs, _, _, _)) = decode_any(secret_raw, context)
+    except WireError:
+        return ("unreadable secret ballot", None)
+    secret_c2s = [c[2] for c in cs]
+    if (len(secret_c2s) != len(c2s)) \
+            or not all(a == b for (a, b) in zip(secret_c2s, c2s)):
+        return ("public and secret boards disagree", None)
+    return (None, secret_c2s)
+
+
+def encode_tally(tally):
+    if tally is None:
+        return None
+    return [c2.json(compressed = True) for c2 in tally]
+
+
+def add_tallies(context, tally, other):
+    '''Sum of two encoded tallies'''
+    if tally is None:
+        return other
+    if other is None:
+        return tally
+    return encode_tally([context.decode_point(a, 2)
+                         + context.decode_point(b, 2)
+                         for (a, b) in zip(tally, other)])
+
+
+def secret_tally(c2s):
+    '''Encoded sum of the commitments of the ballots of the secret board
+    (c2s: a list of commitment vectors of the same length), as in the
+    checkpoint'''
+    if not c2s:
+        return None
+    return encode_tally([sum_points([c2[i] for c2 in c2s])
+                         for i in range(len(c2s[0]))])
+
+
+def chain_start(context):
+    return sha256(unhexlify(context.fingerprint)).digest()
+
+
+def chain_step(chain, fingerprint, public_raw):
+    return sha256(chain + unhexlify(fingerprint)
+                  + sha256(public_raw).digest()).digest()
+
+
+class ElectionAudit(object):
+    '''Incremental audit of the boards of an election'''
+
+    def __init__(self, settings_path, election_folder, workers = 2,
+                 batch_size = 16):
+        '''election_folder has to be terminated by /'''
+        self.settings_path = settings_path
+        self.election_folder = election_folder
+        self.workers = workers
+        self.batch_size = batch_size
+        # The artifact is completed first, so that workers only load it
+        self.context = load_context(settings_path, precompute = True)
+
+    def run(self, full = False):
+        '''Audits the election (only the entries added since the last audit
+        unless full is True) and saves the checkpoint. Returns a report:
+        {'audited', 'verified', 'problems', 'chain', 'tally', 'restarted'}'''
+        storage = open_storage(self.election_folder)
+        try:
+            report = self._run(storage, full)
+        finally:
+            storage.close()
+        return report
+
+    def _run(self, storage, full):
+        problems = []
+        (audited, chain, tally, secret, bad) = self._start()
+        restarted = False
+        if not full:
+            with span('audit.resume'):
+                checkpoint = self._resume(storage, problems)
+            if checkpoint is None: # audited entries changed: start over
+                restarted = True
+            else:
+                (audited, chain, tally, secret, bad) = checkpoint
+        # Known-bad entries are reported again, they are not verified again
+        bad = dict((fingerprint, reason) for (fingerprint, reason)
+                   in bad.items() if fingerprint in storage.pb)
+        problems.extend(sorted(bad.items()))
+        known = set(audited)
+        new = [fingerprint for fingerprint in storage.pb.fingerprints()
+               if (fingerprint not in known) and (fingerprint not in bad)]
+
+        verified = []
+        for (batch, (batch_problems, batch_tally, batch_secret)) \
+                in self._verify(storage, new):
+            problems.extend(batch_problems)
+            bad.update(batch_problems)
+            for (fingerprint, public_raw, _) in batch:
+                if fingerprint not in bad:
+                    chain = chain_step(chain, fingerprint, public_raw)
+                    verified.append(fingerprint)
+            tally = add_tallies(self.context, tally, batch_tally)
+            secret = {'count' : len(audited) + len(verified),
+                      'aggregate' : add_tallies(self.context,
+                                                secret['aggregate'],
+                                                batch_secret)}
+
+        public = set(storage.pb.fingerprints())
+        for fingerprint in storage.sb.fingerprints():
+            if fingerprint not in public:
+                problems.append((fingerprint, "missing on the public board"))
+
+        with span('audit.save'):
+            self._save(audited, verified, chain, tally, secret, bad)
+        return {'audited' : len(audited) + len(verified),
+                'verified' : len(verified),
+                'problems' : problems,
+                'chain' : hexstr(chain),
+                'tally' : tally,
+                'restarted' : restarted}
+
+    def _start(self):
+        '''State of an audit that starts from scratch: (audited, chain, tally,
+        secret, bad)'''
+        return ([], chain_start(self.context), None,
+                {'count' : 0, 'aggregate' : None}, {})
+
+    def _verify(self, storage, fingerprints):
+        '''Yields (batch, audit_batch(batch)) for batches of new entries'''
+        batches = ([(fingerprint, storage.pb.get(fingerprint),
+                     storage.sb.get(fingerprint))
+                    for fingerprint in fingerprints[i:i + self.batch_size]]
+                   for i in range(0, len(fingerprints), self.batch_size))
+        if self.workers <= 1:
+            for batch in batches:
+                yield (batch, audit_batch(self.context, batch))
+            return
+        pool = Pool(self.workers, initializer = _init_worker,
+                    initargs = (self.settings_path,))
+        try:
+            batches = list(batches)
+            for (batch, result) in zip(batches,
+                                       pool.imap(_audit_batch, batches)):
+                yield (batch, result)
+        finally:
+            pool.terminate()
+
+    def _resume(self, storage, problems):
+        '''Reads the checkpoint and checks the audited entries against the
+        boards (without decoding them): returns (audited, chain, tally,
+        secret, bad), or None if the audited entries or the running sums
+        changed (problems are then appended to problems)'''
+        path = self.election_folder + CHECKPOINT
+        if not exists(path):
+            return self._start()
+        filedes = open(path, 'r')
+        checkpoint = json.loads(filedes.read())
+        filedes.close()
+        if (checkpoint['election'] != self.context.fingerprint) \
+                or ('secret' not in checkpoint): # older checkpoint format
+            return self._start()
+        audited = []
+        if exists(self.election_folder + AUDIT_LOG):
+            filedes = open(self.election_folder + AUDIT_LOG, 'r')
+            audited = filedes.read().split()[:checkpoint['position']]
+            filedes.close()
+
+        chain = chain_start(self.context)
+        for fingerprint in audited:
+            public_raw = storage.pb.get(fingerprint)
+            if public_raw is None:
+                problems.append((fingerprint,
+                                 "removed from the public board"))
+                continue
+            secret_raw = storage.sb.get(fingerprint)
+            if secret_raw is None:
+                problems.append((fingerprint,
+                                 "removed from the secret board"))
+            elif sha256(secret_raw).hexdigest() != fingerprint:
+                problems.append((fingerprint, "secret ballot changed since "
+                                              "the last audit"))
+            chain = chain_step(chain, fingerprint, public_raw)
+        if (not problems) and (hexstr(chain) != checkpoint['chain']):
+            problems.append((None, "audited entries changed since the last "
+                                   "audit"))
+        # The secret ballots did not change: neither did the sum of their
+        # commitments
+        secret = checkpoint['secret']
+        if (not problems) and ((secret['count'] != len(audited))
+                               or (secret['aggregate']
+                                   != checkpoint['tally'])):
+            problems.append((None, "running tally does not match the secret "
+                                   "board"))
+        if problems:
+            return None
+        return (audited, chain, checkpoint['tally'], secret,
+                checkpoint['bad'])
+
+    def _save(self, audited, verified, chain, tally, secret, bad):
+        '''Appends the newly verified entries to the audit log (after the
+        audited ones), then replaces the checkpoint'''
+        filedes = open(self.election_folder + AUDIT_LOG,
+                       'a' if audited else 'w')
+        filedes.write(''.join(fingerprint + "\n" for fingerprint in verified))
+        filedes.flush()
+        fsync(filedes.fileno())
+        filedes.close()
+        path = self.election_folder + CHECKPOINT
+        filedes = open(path + ".tmp", 'w')
+        filedes.write(json.dumps({'election' : self.context.fingerprint,
+                                  'position' : len(audited) + len(verified),
+                                  'chain' : hexstr(chain),
+                                  'tally' : tally,
+                                  'secret' : secret,
+                                  'bad' : bad}, indent = 4))
+        filedes.flush()
+        fsync(filedes.fileno())
+        filedes.close()
+        rename(path + ".tmp", path)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+''' bulk.py
+
+Non-interactive generation of ballot corpora, to load-test the acceptance and
+tally servers. Votes are drawn from a distribution:
+
+- single choice and 0/1 elections: relative weights of the answers;
+- approval elections: probability that each answer is approved;
+
+(uniform choice, or approval with probability 1/2, by default) and ballots
+are encrypted in parallel by a pool of processes. They are written as
+<fingerprint>.bal.json (or .bal.bin) files in the election folder, as
+generate_ballot.py does, or appended to the bulk log <edata>/bulk.log/ (see
+LogBoard in Election/storage.py).
+
+The plaintext totals of the generated ballots are accumulated in
+<edata>/bulk_totals.json, so that the outcome of compute_tally.py can be
+checked (see its --check option):
+
+    {"election": ..., "count": ..., "totals": [one count per answer]}
+
+They are rewritten after each batch, once its ballots are committed, so that
+they match the ballots written if the generation stops. Totals of another
+election are never overwritten: the generation is refused.
+
+If a seed is given, the corpus is reproducible: batch i is generated with the
+random source seeded with seed:i (see Random/random_sources.py), whatever the
+number of workers. Seeded ballots are NOT secret: only use them for tests.
+
+@author: Richard Mathot
+'''
+
+import json
+# pylint: disable=E0611
+from hashlib import sha256
+from multiprocessing import Pool
+from os import fsync, rename
+from os.path import exists
+from Crypto.ccs_va import ccsva_enc_vector
+from Election.context import load_context
+from Election.storage import FileBoard, LogBoard
+from Election.wire import encode_ballot, encode_json_ballot
+from Random.random_sources import randint, seed as seed_random
+from Util.compat import to_bytes
+from Util.tracing import span
+
+TOTALS = "bulk_totals.json"
+BULK_LOG = "bulk.log/"
+
+# The election context of a worker process (see _init_worker)
+_worker_context = None
+
+
+def _init_worker(settings_path):
+    '''Loads the election once in each worker process'''
+    #pylint: disable=W0603
+    global _worker_context
+    _worker_context = load_context(settings_path, precompute = True)
+
+
+def _generate_batch(task):
+    '''Runs in a worker process (see generate_batch)'''
+    return generate_batch(_worker_context, *task)
+
+
+def _uniform():
+    '''Uniform float in [0, 1['''
+    return randint(1 << 53) / float(1 << 53)
+
+
+def draw_votes(context, weights = None):
+    '''Draws the plaintexts of a ballot: one 0/1 value per answer (a single
+    value for 0/1 elections)'''
+    count = len(context.answers())
+    if context.is_vector() and not context.is_single(): # approval
+        probabilities = weights if weights is not None else [0.5] * count
+        return [1 if _uniform() < p else 0 for p in probabilities]
+    if weights is None:
+        choice = randint(count)
+    else:
+        target = _uniform() * sum(weights)
+        choice = 0
+        while (choice < count - 1) and (target >= weights[choice]):
+            target -= weights[choice]
+            choice += 1
+    if not context.is_vector():
+        return [choice]
+    votes = [0] * count
+    votes[choice] = 1
+    return votes
+
+
+def generate_batch(context, count, weights = None, seed = None,
+                   binary = False):
+    '''Generates count ballots. Returns a list of (fingerprint, content,
+    votes).'''
+    if seed is not None:
+        seed_random(seed)
+    vector = context.is_vector()
+    ballots = []
+    for _ in range(count):
+        votes = draw_votes(context, weights)
+        with span('generate.encrypt'):
+            ballot = ccsva_enc_vector(votes, context.g, context.g1, context.h,
+                                      context.h1, context.tables(),
+                                      vector and context.is_single())
+        with span('generate.encode'):
+            if binary:
+                content = encode_ballot(*ballot, vector = vector)
+            else:
+                content = to_bytes(json.dumps(encode_json_ballot(
+                    *ballot, vector = vector), indent = 4))
+            ballots.append((sha256(content).hexdigest(), content, votes))
+    if seed is not None:
+        seed_random(None)
+    return ballots
+
+
+def answer_totals(context, votes_sum, count):
+    '''Totals per answer (as printed by compute_tally.py) of count ballots
+    whose plaintexts sum to votes_sum'''
+    if context.is_vector():
+        return votes_sum
+    return [count - votes_sum[0], votes_sum[0]]
+
+
+def generate_ballots(settings_path, election_folder, count, weights = None,
+                     seed = None, workers = 2, batch_size = 32, binary = False,
+                     log = False):
+    '''Generates count ballots for the election of settings_path into
+    election_folder (terminated by /) and records their totals.
+    Returns the totals per answer of the generated ballots.'''
+    context = load_context(settings_path, precompute = True)
+    if (weights is not None) and (len(weights) != len(context.answers())):
+        raise ValueError("one weight per answer is expected")
+    (previous_count, previous_totals) = recorded_totals(context,
+                                                        election_folder)
+    if log:
+        outbox = LogBoard(election_folder + BULK_LOG)
+    else:
+        outbox = FileBoard(election_folder,
+                           ".bal.bin" if binary else ".bal.json")
+    prefix = None if seed is None else to_bytes(seed) + b':'
+    tasks = [(min(batch_size, count - start), weights,
+              None if prefix is None else prefix + i.__str__().encode(),
+              binary)
+             for (i, start) in enumerate(range(0, count, batch_size))]
+    votes_sum = [0] * (len(context.answers()) if context.is_vector() else 1)
+    generated = 0
+    if workers <= 1:
+        results = (generate_batch(context, *task) for task in tasks)
+        pool = None
+    else:
+        pool = Pool(workers, initializer = _init_worker,
+                    initargs = (settings_path,))
+        results = pool.imap(_generate_batch, tasks)
+    try:
+        for batch in results:
+            with span('generate.write'):
+                for (fingerprint, content, votes) in batch:
+                    outbox.append(fingerprint, content)
+                    votes_sum = [a + b for (a, b) in zip(votes_sum, votes)]
+                generated += len(batch)
+                outbox.commit()
+                totals = answer_totals(context, votes_sum, generated)
+                record_totals(context, election_folder,
+                              previous_count + generated,
+                              [a + b for (a, b) in zip(previous_totals,
+                                                       totals)])
+    finally:
+        if pool is not None:
+            pool.terminate()
+        outbox.close()
+    return answer_totals(context, votes_sum, generated)
+
+
+def recorded_totals(context, election_folder):
+    '''(count, totals) recorded in <edata>/bulk_totals.json (no ballot if
+    there is no such file). Raises ValueError if they are the totals of
+    another election.'''
+    path = election_folder + TOTALS
+    if not exists(path):
+        return (0, [0] * len(context.answers()))
+    filedes = open(path, 'r')
+    recorded = json.loads(filedes.read())
+    filedes.close()
+    if recorded['election'] != context.fingerprint:
+        raise ValueError(path + " holds the totals of another election")
+    return (recorded['count'], recorded['totals'])
+
+
+def record_totals(context, election_folder, count, totals):
+    '''Replaces <edata>/bulk_totals.json (atomically) with the totals of
+    count generated ballots'''
+    path = election_folder + TOTALS
+    filedes = open(path + ".tmp", 'w')
+    filedes.write(json.dumps({'election' : context.fingerprint,
+                              'count' : count,
+                              'totals' : totals}, indent = 4))
+    filedes.flush()
+    fsync(filedes.fileno())
+    filedes.close()
+    rename(path + ".tmp", path)
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+''' context.py
+
+Decoded public settings of an election. Long-running tools load them once and
+keep the curves, the public key and its fixed-base tables in memory.
+
+Every tool loads the election through load_context. The decoded state is
+kept in the precomputation artifact of the election (<name>.ctx in the .edata
+folder, see Election/artifact.py), so that it is only computed once per
+election. configure_election.py --precompute builds it entirely; otherwise
+it is completed by the tools as they need it. The fixed-base tables, the
+Miller lines and the discrete logarithms are read in place from the map, each
+point (or line) being decoded when it is used, so that the worker processes
+of a host share a single copy of them; only the four constants of 'pnts' and
+the basis are decoded once per process. The constants are checked against the
+settings when they are read, and the whole artifact is rebuilt if they differ.
+Sections (fixed-width records):
+
+    'pnts'  g | g1 | h | h1 (uncompressed points)
+    'tabl'  window (1 byte) | bits (uint16) | the fixed-base tables of
+            g, g1, h, h1, row by row (uncompressed points)
+    'dlgb'  decryption basis pairing(g, h1) (element of F_p^12)
+    'line'  Miller loop lines of g: per line, a flag byte (0 for the
+            constant line 1) and 3 integers (see miller_lines)
+    'dlog'  discrete logarithms in the decryption basis: records
+            (key of basis^z (8 bytes), z (uint32)) sorted by key
+
+@author: Richard Mathot
+'''
+
+import json
+import struct
+# pylint: disable=E0611
+from binascii import unhexlify
+from hashlib import sha256
+from Crypto.ccs_va import init_curves, ccsva_tables, ccs_basis
+from Election.artifact import ElectionArtifact, write_artifact
+from NumberTheory.bn_curve import p_u_
+from NumberTheory.elliptic_curves import from_json, from_bytes, \
+    encoded_length, FixedBaseTable, matches_json
+from NumberTheory.finite_fields import PF12, int_to_bytes, bytes_to_int
+from NumberTheory.pairings import miller_lines
+from Util.compat import to_bytes
+
+# Decoded election constants, shared by every context of the process: settings
+# store compressed points, whose decompression costs a square root each
+_CONSTANTS = {}
+
+# Size of the discrete logarithm table built by build_artifact (the tally of
+# an answer is found by a table lookup up to this number of ballots)
+DLOG_TABLE_SIZE = 1 << 12
+
+_LINE = struct.Struct('>B32s32s32s')
+
+
+def load_context(settings_path, precompute = False, cache = True):
+    '''Reads a <name>.pub.json file and returns its ElectionContext.
+    If cache is True, the decoded state is read from (and saved to) the
+    precomputation artifact of the election.'''
+    filedes = open(settings_path, 'rb')
+    settings_raw = filedes.read()
+    filedes.close()
+    return ElectionContext(settings_raw, precompute,
+                           cache_path(settings_path) if cache else None)
+
+
+def cache_path(settings_path):
+    '''Path of the precomputation artifact of a <name>.pub.json file'''
+    if settings_path.endswith(".pub.json"):
+        return settings_path[:-len(".pub.json")] + ".ctx"
+    return settings_path + ".ctx"
+
+
+class ElectionContext(object):
+    '''The public settings of an election, decoded once'''
+
+    fingerprint = None
+    settings = None
+    curves = None
+    g = None
+    h = None
+    g1 = None
+    h1 = None
+
+    def __init__(self, settings_raw, precompute = False, cache = None):
+        '''settings_raw is the content of the <name>.pub.json file.
+        If precompute is True, fixed-base tables of the public key are made
+        available right away (this only pays off when many ballots are
+        processed). cache is the path of the artifact of the election, if
+        any; its sections are only decoded when they are used.'''
+        self.fingerprint = sha256(to_bytes(settings_raw)).hexdigest()
+        self.settings = json.loads(settings_raw)
+        self.curves = init_curves()
+        self._cache = cache
+        self._artifact = None
+        self._decoded = {}
+        self._mapped = set() # sections of _decoded read in place
+        if cache is not None:
+            self._artifact = ElectionArtifact(cache,
+                                              unhexlify(self.fingerprint))
+        raw = self._section(b'pnts')
+        if raw is not None:
+            (self.g, self.g1, self.h, self.h1) = \
+                _decode_points(raw, (1, 1, 2, 2), self.curves)
+            if not self._constants_match():
+                # Stale or corrupted artifact: every section is derived from
+                # these points, it is rebuilt from the settings
+                self._artifact = None
+                raw = None
+        if raw is None:
+            crypto = self.settings['crypto']
+            self.g = self._decode_constant(crypto['g'], 1)
+            self.h = self._decode_constant(crypto['h'], 2)
+            self.g1 = self._decode_constant(crypto['g1'], 1)
+            self.h1 = self._decode_constant(crypto['h1'], 2)
+            self._decoded[b'pnts'] = (self.g, self.g1, self.h, self.h1)
+        if precompute and not self._has(b'tabl'):
+            self._decoded[b'tabl'] = ccsva_tables(self.g, self.g1, self.h,
+                                                  self.h1)
+            self._save()
+        elif raw is None:
+            self._save()
+
+    def name(self):
+        return self.settings['human']['name']
+
+    def is_vector(self):
+        '''True for multi-candidate elections (one ciphertext per answer),
+        False for 0/1 elections'''
+        return 'answers' in self.settings['human']
+
+    def is_single(self):
+        '''True if exactly one answer must be chosen'''
+        return (not self.is_vector()) \
+               or self.settings['human']['type'] == 'single'
+
+    def answers(self):
+        human = self.settings['human']
+        if self.is_vector():
+            return human['answers']
+        return [human['answer_0'], human['answer_1']]
+
+    def tables(self):
+        '''Fixed-base tables of (g, g1, h, h1), or None if the context was
+        not precomputed (and they are not in the artifact)'''
+        if (b'tabl' not in self._decoded) and self._has(b'tabl'):
+            self._decoded[b'tabl'] = _map_tables(
+                self._view(b'tabl'), (self.g, self.g1, self.h, self.h1),
+                self.curves)
+            self._mapped.add(b'tabl')
+        return self._decoded.get(b'tabl')
+
+    def basis(self):
+        '''Decryption basis pairing(g, h1) (computed once per election)'''
+        if b'dlgb' not in self._decoded:
+            if self._has(b'dlgb'):
+                self._decoded[b'dlgb'] = _decode_basis(
+                    self._section(b'dlgb'), self.curves)
+            else:
+                self._decoded[b'dlgb'] = ccs_basis(self.g, self.h1)
+                self._save()
+        return self._decoded[b'dlgb']
+
+    def lines(self):
+        '''Miller loop lines of g, for the pairings e(g, .) of the
+        decryption (computed once per election)'''
+        if b'line' not in self._decoded:
+            if self._has(b'line'):
+                self._decoded[b'line'] = MappedLines(self._view(b'line'))
+                self._mapped.add(b'line')
+            else:
+                self._decoded[b'line'] = miller_lines(self.g)
+                self._save()
+        return self._decoded[b'line']
+
+    def dlog_table(self):
+        '''Discrete logarithm table of the decryption basis, as
+        (lookup, size) (see ccs_dec_vector), or None if it was not built'''
+        if self._artifact is None:
+            return None
+        records = self._artifact.record_table(b'dlog', 8, '>I')
+        if records is None:
+            return None
+
+        def lookup(element):
+            found = records.get(dlog_key(element))
+            return found[0] if found is not None else None
+        return (lookup, len(records))
+
+    def build_artifact(self, dlog_size = DLOG_TABLE_SIZE):
+        '''Computes every precomputation of the election and saves them'''
+        if self.tables() is None:
+            self._decoded[b'tabl'] = ccsva_tables(self.g, self.g1, self.h,
+                                                  self.h1)
+        self.lines()
+        basis = self.basis()
+        records = []
+        power = PF12(p_u_)(None, one = True)
+        for z in range(dlog_size):
+            records.append(dlog_key(power) + struct.pack('>I', z))
+            power = power * basis
+        records.sort()
+        self._decoded[b'dlog'] = b''.join(records)
+        self._save()
+
+    def _constants_match(self):
+        '''Checks the points read from the artifact against the settings
+        (without the square roots of their decompression)'''
+        (F, F2, C, C2) = self.curves
+        crypto = self.settings['crypto']
+        for (P, name, field, curve) in ((self.g, 'g', F, C),
+                                        (self.g1, 'g1', F, C),
+                                        (self.h, 'h', F2, C2),
+                                        (self.h1, 'h1', F2, C2)):
+            try:
+                if not matches_json(P, crypto[name], curve, field):
+                    return False
+            except (KeyError, TypeError, ValueError):
+                return False
+        return True
+
+    def _decode_constant(self, raw, group):
+        key = (group, json.dumps(raw, sort_keys = True))
+        if key not in _CONSTANTS:
+            _CONSTANTS[key] = self.decode_point(raw, group)
+        return _CONSTANTS[key].copy()
+
+    def decode_point(self, raw, group = 1):
+        '''Decodes a JSON point of G1 (group = 1) or G2 (group = 2), compressed
+        or not. Raises ValueError if it is not a point of the curve.'''
+        (F, F2, C, C2) = self.curves
+        if group == 1:
+            return from_json(raw, C, F)
+        return from_json(raw, C2, F2)
+
+    ############
+    # Artifact #
+    ############
+
+    def _has(self, name):
+        return (name in self._decoded) \
+               or ((self._artifact is not None) and (name in self._artifact))
+
+    def _section(self, name):
+        if self._artifact is None:
+            return None
+        return self._artifact.section(name)
+
+    def _view(self, name):
+        if self._artifact is None:
+            return None
+        return self._artifact.view(name)
+
+    def _save(self):
+        '''Writes the artifact with every section known so far (best effort:
+        the tools still work if the folder is read-only)'''
+        if self._cache is None:
+            return
+        encoders = {b'pnts' : _encode_points, b'tabl' : _encode_tables,
+                    b'dlgb' : _encode_basis, b'line' : _encode_lines,
+                    b'dlog' : lambda records: records}
+        sections = []
+        for name in (b'pnts', b'tabl', b'dlgb', b'line', b'dlog'):
+            raw = self._section(name)
+            if raw is not None:
+                sections.append((name, raw))
+            elif name in self._decoded:
+                sections.append((name, encoders[name](self._decoded[name])))
+        try:
+            write_artifact(self._cache, unhexlify(self.fingerprint), sections)
+        except (IOError, OSError):
+            return
+        # The previous map is not closed: the sections already read in place
+        # (and handed out) keep it, it is unmapped with its last view
+        self._artifact = ElectionArtifact(self._cache,
+                                          unhexlify(self.fingerprint))
+        for name in self._mapped | set([b'dlog']): # now read from the new map
+            self._decoded.pop(name, None)
+        self._mapped = set()
+
+
+def dlog_key(element):
+    '''Key of an element of F_p^12 in the discrete logarithm table'''
+    return sha256(element.to_bytes()).digest()[:8]
+
+
+def _encode_points(points):
+    return b''.join(P.to_bytes() for P in points)
+
+
+def _decode_points(data, groups, curves):
+    (F, F2, C, C2) = curves
+    points = []
+    offset = 0
+    for group in groups:
+        (curve, field) = (C, F) if group == 1 else (C2, F2)
+        length = encoded_length(data[offset:offset + 1], group)
+        points.append(from_bytes(data[offset:offset + length], curve, field,
+                                 group, check = False))
+        offset += length
+    return points
+
+
+def _encode_tables(tables):
+    parts = [struct.pack('>BH', tables[0].window, tables[0].bits)]
+    for table in tables:
+        for row in table.table:
+            parts.append(_encode_points(row))
+    return b''.join(parts)
+
+
+def _map_tables(view, points, curves):
+    '''Fixed-base tables of points, whose rows are read in place from view
+    (see MappedPoints)'''
+    (window, bits) = struct.unpack('>BH', view.read(0, 3))
+    offset = 3
+    tables = []
+    for (P, group) in zip(points, (1, 1, 2, 2)):
+        table = FixedBaseTable(P, window, bits, [])
+        count = 2 ** window - 1
+        length = count * (1 + 2 * group * 32)
+        for _ in range(table.rows()):
+            table.table.append(MappedPoints(view, offset, count, group,
+                                            curves))
+            offset += length
+        tables.append(table)
+    return tuple(tables)
+
+
+class MappedPoints(object):
+    '''count uncompressed points of G1 (group = 1) or G2 (group = 2), read in
+    place from a SectionView from offset: a point is decoded each time it is
+    used (from_bytes without the on-curve test)'''
+
+    def __init__(self, view, offset, count, group, curves):
+        self._view = view
+        self._offset = offset
+        self._count = count
+        self._group = group
+        self._length = 1 + 2 * group * 32
+        (F, F2, C, C2) = curves
+        (self._curve, self._field) = (C, F) if group == 1 else (C2, F2)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return from_bytes(self._view.read(self._offset + i * self._length,
+                                          self._length),
+                          self._curve, self._field, self._group,
+                          check = False)
+
+
+def _encode_basis(basis):
+    return basis.to_bytes()
+
+
+def _decode_basis(data, curves):
+    F2 = curves[1]
+    values = [bytes_to_int(data[32 * i:32 * (i + 1)]) for i in range(12)]
+    return PF12(p_u_)([F2(values[2 * i:2 * i + 2]) for i in range(6)])
+
+
+def _encode_lines(lines):
+    return b''.join(_LINE.pack(0, b'', b'', b'') if line is None
+                    else _LINE.pack(1, *[int_to_bytes(value, 32)
+                                         for value in line])
+                    for line in lines)
+
+
+class MappedLines(object):
+    '''Miller loop lines (see miller_lines) read in place from a
+    SectionView, a line being decoded each time it is used'''
+
+    def __init__(self, view):
+        self._view = view
+        self._count = len(view) // _LINE.size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, k):
+        if not 0 <= k < self._count:
+            raise IndexError(k)
+        (flag, w0, a, b) = _LINE.unpack(self._view.read(k * _LINE.size,
+                                                        _LINE.size))
+        if not flag:
+            return None
+        return (bytes_to_int(w0), bytes_to_int(a), bytes_to_int(b))
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+''' ingestion.py
+
+asyncio ingestion front-end for ballot acceptance, for polling peaks.
+
+Submitted ballots are buffered in a bounded queue. Batchers group them into
+micro-batches (up to batch_size ballots, or whatever arrived within
+batch_window seconds) and verify each batch in a pool of worker processes.
+Each worker holds its own warm ElectionContext. A batch is verified in two
+rounds: the workers first run the cheap stages of the validation, up to the
+decoding of the G2 points (see Election/validation.py), then the commitments
+decoded there are looked up in the replay index, and only the ballots that
+were not replayed get their proofs verified, by the workers again (the
+decoded points are handed back to them, see pack_split). Accepted ballots are
+then stored, and the batch committed, by a single storage thread (so that the
+event loop never waits for a write or an fsync, and the writes of the
+batchers are serialised); every submitter gets its own answer once its batch
+is committed. The replay index is only used by the storage thread: the
+lookups run there too. When the queue is full, submissions are rejected at once with a
+retry-after delay (HTTP 503 + Retry-After) instead of piling up.
+
+HTTP interface (localhost):
+    POST /ballots        body: a ballot, in JSON or binary encoding
+    GET  /metrics        queue depth, batch sizes, latency percentiles,
+                         ballots refused by each validation stage
+
+@note: this module needs Python 3 (asyncio).
+
+@author: Richard Mathot
+'''
+
+import asyncio
+import json
+import math
+import time
+from collections import deque
+from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from Election.acceptance import store_ballot
+from Election.context import load_context
+from Election.storage import open_storage
+from Election.validation import screen, split_commitments, check_proofs, \
+    take_rejections
+from Election.wire import pack_split, unpack_split, MAX_BALLOT_SIZE
+from Util.tracing import percentile
+
+# The election context of a worker process (see _init_worker)
+_worker_context = None
+
+
+def _init_worker(settings_path):
+    '''Loads the election once in each worker process'''
+    #pylint: disable=W0603
+    global _worker_context
+    _worker_context = load_context(settings_path, precompute = True)
+
+
+def _started():
+    '''Runs in a worker process: does nothing (see BallotIngestion.start)'''
+    return True
+
+
+def _screen_batch(ballots_raw):
+    '''Runs in a worker process: the validation stages of a micro-batch of
+    ballots before the commitments lookup. Returns, per ballot,
+    (ballot_fingerprint, vector, packed split, commitments), the last three
+    being None if the ballot is refused, and the refusals of each stage.'''
+    screened = []
+    for ballot_raw in ballots_raw:
+        (fingerprint, result, _) = screen(_worker_context, ballot_raw)
+        if result is None:
+            screened.append((fingerprint, None, None, None))
+        else:
+            (vector, split) = result
+            screened.append((fingerprint, vector, pack_split(split),
+                             split_commitments(split)))
+    return (screened, take_rejections())
+
+
+def _prove_batch(screened):
+    '''Runs in a worker process: verifies the proofs of screened ballots,
+    given as (ballot_fingerprint, vector, packed split). Returns the results
+    (ballot_fingerprint, public_ballot) and the refusals of each stage.'''
+    results = []
+    for (fingerprint, vector, packed) in screened:
+        split = unpack_split(packed, _worker_context)
+        results.append(check_proofs(_worker_context, fingerprint, vector,
+                                    split)[:2])
+    return (results, take_rejections())
+
+
+class Overloaded(Exception):
+    '''The ingestion queue is full: the ballot should be submitted again after
+    retry_after seconds'''
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, "ingestion queue is full")
+        self.retry_after = retry_after
+
+
+class IngestionStats(object):
+    '''Counters and sliding windows of the last batch sizes and latencies'''
+
+    def __init__(self, window = 1024):
+        self.accepted = 0
+        self.refused = 0
+        self.overloaded = 0
+        self.batches = 0
+        self.rejections = {}
+        self.batch_sizes = deque(maxlen = window)
+        self.batch_times = deque(maxlen = window)
+        self.latencies = deque(maxlen = window)
+
+    def report(self, queue_depth):
+        '''Snapshot of the statistics, as a JSON-serialisable dict'''
+        latencies = list(self.latencies)
+        sizes = list(self.batch_sizes)
+        return {'queue_depth' : queue_depth,
+                'accepted' : self.accepted,
+                'refused' : self.refused,
+                'overloaded' : self.overloaded,
+                'batches' : self.batches,
+                'rejections' : self.rejections,
+                'batch_size_mean' : (float(sum(sizes)) / len(sizes)
+                                     if sizes else None),
+                'batch_size_max' : max(sizes) if sizes else None,
+                'latency_p50' : percentile(latencies, 50),
+                'latency_p99' : percentile(latencies, 99)}
+
+
+class BallotIngestion(object):
+    '''Bounded, micro-batching ingestion queue in front of verify_ballot'''
+
+    def __init__(self, settings_path, election_folder, workers = 2,
+                 max_queue = 1024, batch_size = 16, batch_window = 0.05):
+        self.settings_path = settings_path
+        self.election_folder = election_folder
+        self.workers = workers
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.stats = IngestionStats()
+        self._storage = None
+        self._queue = None
+        self._executor = None
+        self._storage_executor = None
+        self._batchers = []
+
+    async def start(self):
+        '''Starts the worker pool and one batcher per worker'''
+        self._storage = open_storage(self.election_folder,
+                                     load_context(self.settings_path),
+                                     bloom = True)
+        self._queue = asyncio.Queue(self.max_queue)
+        self._executor = ProcessPoolExecutor(self.workers,
+                                             initializer = _init_worker,
+                                             initargs = (self.settings_path,))
+        # The workers are forked before the storage thread is started: forked
+        # while it holds a lock, they would wait for it forever
+        await asyncio.get_event_loop().run_in_executor(self._executor,
+                                                       _started)
+        self._storage_executor = ThreadPoolExecutor(1)
+        self._batchers = [asyncio.ensure_future(self._batcher())
+                          for _ in range(self.workers)]
+
+    async def stop(self):
+        for batcher in self._batchers:
+            batcher.cancel()
+        await asyncio.gather(*self._batchers, return_exceptions = True)
+        self._executor.shutdown()
+        self._storage_executor.shutdown()
+        self._storage.close()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def retry_after(self):
+        '''Estimated time (in whole seconds) needed to drain the queue'''
+        times = list(self.stats.batch_times)
+        batch_time = float(sum(times)) / len(times) if times else 1.0
+        rounds = float(self.queue_depth()) / (self.batch_size * self.workers)
+        return max(1, int(math.ceil(rounds * batch_time)))
+
+    async def submit(self, ballot_raw):
+        '''Queues a ballot and waits for its verdict.
+        Returns (ballot_fingerprint, accepted), raises Overloaded if the queue
+        is full. A ballot that was already accepted is refused right away.'''
+        fingerprint = sha256(ballot_raw).hexdigest()
+        seen = await asyncio.get_event_loop().run_in_executor(
+            self._storage_executor, self._storage.replay.seen, fingerprint)
+        if seen:
+            self.stats.refused += 1
+            self._count_rejections({'fingerprint' : 1})
+            return (fingerprint, False)
+        if self._queue.full():
+            self.stats.overloaded += 1
+            raise Overloaded(self.retry_after())
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((ballot_raw, future, time.time()))
+        return await future
+
+    async def _next_batch(self):
+        '''Waits for a first ballot, then gathers more until the batch is full
+        or the batch window has elapsed'''
+        loop = asyncio.get_event_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(),
+                                                    timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _batcher(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            start = time.time()
+            try:
+                results = await self._verify_batch(
+                    [item[0] for item in batch])
+            except Exception as error: #pylint: disable=W0703
+                _fail_batch(batch, error)
+                continue
+            self.stats.batches += 1
+            self.stats.batch_sizes.append(len(batch))
+            self.stats.batch_times.append(time.time() - start)
+
+            try:
+                verdicts = await loop.run_in_executor(
+                    self._storage_executor, self._store_batch,
+                    [item[0] for item in batch], results)
+            except Exception as error: #pylint: disable=W0703
+                _fail_batch(batch, error)
+                continue
+
+            for (_, future, submitted), (fingerprint, _), accepted \
+                    in zip(batch, results, verdicts):
+                if accepted:
+                    self.stats.accepted += 1
+                else:
+                    self.stats.refused += 1
+                self.stats.latencies.append(time.time() - submitted)
+                if not future.done(): # the submitter may have gone away
+                    future.set_result((fingerprint, accepted))
+
+    async def _verify_batch(self, ballots_raw):
+        '''Verifies a micro-batch of ballots (see the module docstring).
+        Returns the results (ballot_fingerprint, public_ballot).'''
+        loop = asyncio.get_event_loop()
+        (screened, rejections) = await loop.run_in_executor(
+            self._executor, _screen_batch, ballots_raw)
+        self._count_rejections(rejections)
+        results = [(fingerprint, None) for (fingerprint, _, _, _) in screened]
+        kept = [i for (i, item) in enumerate(screened) if item[1] is not None]
+        seen = await loop.run_in_executor(
+            self._storage_executor, self._seen_commitments,
+            [screened[i][3] for i in kept])
+        if any(seen):
+            self._count_rejections({'commitments' : sum(seen)})
+        kept = [i for (i, replayed) in zip(kept, seen) if not replayed]
+        if kept:
+            (proved, rejections) = await loop.run_in_executor(
+                self._executor, _prove_batch,
+                [screened[i][:3] for i in kept])
+            self._count_rejections(rejections)
+            for (i, result) in zip(kept, proved):
+                results[i] = result
+        return results
+
+    def _seen_commitments(self, commitments):
+        '''Runs in the storage thread: whether each list of commitments was
+        already accepted'''
+        return [self._storage.replay.seen(c2s = c2s) for c2s in commitments]
+
+    def _count_rejections(self, rejections):
+        for (stage, count) in rejections.items():
+            self.stats.rejections[stage] = \
+                self.stats.rejections.get(stage, 0) + count
+
+    def _store_batch(self, ballots_raw, results):
+        '''Runs in the storage thread: stores the accepted ballots of a batch
+        with one commit (group fsync) for the whole batch. Replays submitted
+        while the ballot was being verified are refused here. Returns the
+        verdicts.'''
+        verdicts = []
+        for ballot_raw, (fingerprint, public_ballot) in zip(ballots_raw,
+                                                            results):
+            verdicts.append((public_ballot is not None)
+                            and store_ballot(self._storage, fingerprint,
+                                             ballot_raw, public_ballot))
+        self._storage.commit()
+        return verdicts
+
+    async def handle_http(self, reader, writer):
+        '''Minimal HTTP/1.0 handler (one request per connection)'''
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                (key, _, value) = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                await _answer(writer, 400, {'error' : 'bad request'})
+            elif (request_line[0] == 'GET') \
+                    & (request_line[1].rstrip('/') == '/metrics'):
+                await _answer(writer, 200,
+                              self.stats.report(self.queue_depth()))
+            elif (request_line[0] == 'POST') \
+                    & (request_line[1].rstrip('/') == '/ballots'):
+                await self._handle_ballot(reader, writer, headers)
+            else:
+                await _answer(writer, 404, {'error' : 'unknown resource'})
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_ballot(self, reader, writer, headers):
+        length = int(headers.get('content-length', 0))
+        if (length <= 0) | (length > MAX_BALLOT_SIZE):
+            await _answer(writer, 413, {'error' : 'invalid ballot size'})
+            return
+        ballot_raw = await reader.readexactly(length)
+        try:
+            (fingerprint, accepted) = await self.submit(ballot_raw)
+        except Overloaded as overloaded:
+            await _answer(writer, 503, {'error' : 'overloaded',
+                                        'retry_after' : overloaded.retry_after},
+                          {'Retry-After' : overloaded.retry_after.__str__()})
+            return
+        except Exception: #pylint: disable=W0703
+            # The batch of the ballot could not be verified or stored (see
+            # _fail_batch)
+            await _answer(writer, 500, {'error' : 'internal error'})
+            return
+        await _answer(writer, 200 if accepted else 422,
+                      {'fingerprint' : fingerprint, 'accepted' : accepted})
+
+
+def _fail_batch(batch, error):
+    '''Passes error to the submitters of a batch that could not be verified
+    or stored'''
+    for (_, future, _) in batch:
+        if not future.done():
+            future.set_exception(error)
+
+
+_REASONS = {200 : 'OK', 400 : 'Bad Request', 404 : 'Not Found',
+            413 : 'Payload Too Large', 422 : 'Unprocessable Entity',
+            500 : 'Internal Server Error', 503 : 'Service Unavailable'}
+
+
+async def _answer(writer, status, content, headers = None):
+    body = json.dumps(content).encode('utf-8')
+    lines = ['HTTP/1.0 %d %s' % (status, _REASONS[status]),
+             'Content-Type: application/json',
+             'Content-Length: %d' % len(body)]
+    for key, value in (headers or {}).items():
+        lines.append(key + ': ' + value)
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+
+
+def serve(settings_path, election_folder, port, **options):
+    '''Runs the ingestion front-end on localhost:port until interrupted.
+    options are passed to BallotIngestion.'''
+    ingestion = BallotIngestion(settings_path, election_folder, **options)
+
+    async def run():
+        await ingestion.start()
+        server = await asyncio.start_server(ingestion.handle_http,
+                                            '127.0.0.1', port)
+        try:
+            await server.serve_forever()
+        finally:
+            server.close()
+            await ingestion.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+''' merkle.py
+
+Append-only Merkle tree over the fingerprints of the accepted ballots (the
+order in which they were accepted), with the hashing and the proofs of
+RFC 6962 (Certificate Transparency):
+
+    leaf hash       sha256(0x00 || fingerprint)
+    node hash       sha256(0x01 || left || right)
+    root of n > 1   node hash of the roots of the first k leaves and of the
+                    n - k others, k being the largest power of 2 below n
+
+An inclusion proof shows that a ballot is in the tree of a given root, and a
+consistency proof that a tree is an extension of an older one; both have
+O(log n) hashes, so voters and auditors can check them without the board.
+
+Every complete subtree is stored (one file per level, 32 bytes per node), so
+that appending a ballot costs O(log n) hashes and no root is ever computed
+from the leaves. Roots are signed with the board key (Schnorr signature, see
+Crypto/signature.py) and published at intervals in the roots file, one JSON
+object per line:
+
+    {"size": ..., "root": ..., "timestamp": ..., "signature": [e, s]}
+
+Files of the merkle/ folder of an election: leaves (fingerprints), level00,
+level01, ... (subtree hashes), roots and board.pub.json (the public key of
+the board, to be published with the election settings). The board key itself
+is created by configure_election.py out of the election folder, which is
+published: in <name>.keys/board.key (readable by its owner only), next to
+<name>.edata/ (see board_key_folder).
+
+@author: Richard Mathot
+'''
+
+import json
+import struct
+# pylint: disable=E0611
+from binascii import unhexlify
+from hashlib import sha256
+from os import fsync, chmod, fdopen, open as os_open, O_WRONLY, O_CREAT, \
+    O_EXCL
+from os.path import exists
+from time import time
+from Crypto.signature import schnorr_gen, schnorr_sign, schnorr_verify
+from Util.compat import hexstr
+from Util.folder import create_dir_ifnexists
+
+HASH_SIZE = 32
+
+
+def leaf_hash(data):
+    return sha256(b'\x00' + data).digest()
+
+
+def node_hash(left, right):
+    return sha256(b'\x01' + left + right).digest()
+
+
+def _split(n):
+    '''Largest power of 2 strictly below n (n > 1)'''
+    return 1 << ((n - 1).bit_length() - 1)
+
+
+def merkle_root(leaves):
+    '''Root of the tree of a (short) list of leaves, computed in memory'''
+    if not leaves:
+        return sha256(b'').digest()
+    if len(leaves) == 1:
+        return leaf_hash(leaves[0])
+    k = _split(len(leaves))
+    return node_hash(merkle_root(leaves[:k]), merkle_root(leaves[k:]))
+
+
+class MerkleLog(object):
+    '''The Merkle tree of a board, stored in folder (terminated by /)'''
+
+    folder = None
+    signer = None
+    publish_interval = None
+    publish_size = None
+
+    def __init__(self, folder, signer = None, publish_interval = 60.0,
+                 publish_size = 1024):
+        '''signer signs root messages (see board_signer). A signed root is
+        published by commit() once publish_interval seconds have elapsed or
+        publish_size ballots were added since the last one.'''
+        create_dir_ifnexists(folder)
+        self.folder = folder
+        self.signer = signer
+        self.publish_interval = publish_interval
+        self.publish_size = publish_size
+        self._leaves = bytearray(_read(folder + "leaves"))
+        if len(self._leaves) % HASH_SIZE: # partially written last leaf
+            del self._leaves[len(self._leaves) - len(self._leaves) % HASH_SIZE:]
+            _write(folder + "leaves", bytes(self._leaves))
+        self._index = {}
+        for i in range(len(self._leaves) // HASH_SIZE):
+            self._index[bytes(self._leaves[HASH_SIZE * i:
+                                           HASH_SIZE * (i + 1)])] = i
+        self._levels = []
+        self._load_levels()
+        self._committed = len(self)
+        self._roots = []
+        if exists(folder + "roots"):
+            filedes = open(folder + "roots", 'r')
+            self._roots = [json.loads(line) for line in filedes
+                           if line.strip()]
+            filedes.close()
+        self._published_at = time()
+
+    def _level_path(self, level):
+        return self.folder + "level%02d" % level
+
+    def _load_levels(self):
+        '''Loads the subtree hashes; a level that does not match the leaves
+        (after a crash: only the leaves are synced) is rebuilt'''
+        count = len(self._leaves) // HASH_SIZE
+        level = 0
+        rebuilt = False
+        while (count > 0) or (level == 0):
+            data = bytearray(_read(self._level_path(level)))
+            if rebuilt or (len(data) != HASH_SIZE * count) \
+                    or not self._check_last(level, data, count):
+                data = self._build_level(level, count)
+                rebuilt = True
+                _write(self._level_path(level), bytes(data))
+            self._levels.append(data)
+            count >>= 1
+            level += 1
+        # Levels of a larger tree (the leaves file was truncated)
+        while exists(self._level_path(level)):
+            _write(self._level_path(level), b'')
+            level += 1
+
+    def _check_last(self, level, data, count):
+        if count == 0:
+            return True
+        last = bytes(data[HASH_SIZE * (count - 1):])
+        if level == 0:
+            expected = leaf_hash(self._leaf(count - 1))
+        else:
+            below = self._levels[level - 1]
+            expected = node_hash(
+                bytes(below[HASH_SIZE * (2 * count - 2):
+                            HASH_SIZE * (2 * count - 1)]),
+                bytes(below[HASH_SIZE * (2 * count - 1):
+                            HASH_SIZE * 2 * count]))
+        return last == expected
+
+    def _build_level(self, level, count):
+        if level == 0:
+            return bytearray(b''.join(leaf_hash(self._leaf(i))
+                                      for i in range(count)))
+        below = self._levels[level - 1]
+        return bytearray(b''.join(
+            node_hash(bytes(below[HASH_SIZE * 2 * i:HASH_SIZE * (2 * i + 1)]),
+                      bytes(below[HASH_SIZE * (2 * i + 1):
+                                  HASH_SIZE * (2 * i + 2)]))
+            for i in range(count)))
+
+    def _leaf(self, i):
+        return bytes(self._leaves[HASH_SIZE * i:HASH_SIZE * (i + 1)])
+
+    def _node(self, level, i):
+        return bytes(self._levels[level][HASH_SIZE * i:HASH_SIZE * (i + 1)])
+
+    def __len__(self):
+        return len(self._leaves) // HASH_SIZE
+
+    def __contains__(self, fingerprint):
+        return unhexlify(fingerprint) in self._index
+
+    def index(self, fingerprint):
+        '''Position of a ballot in the tree, None if it is not in it'''
+        return self._index.get(unhexlify(fingerprint))
+
+    def append(self, fingerprint):
+        '''Adds a ballot (O(log n) hashes); it is only durable after
+        commit(). Returns its position.'''
+        key = unhexlify(fingerprint)
+        if key in self._index:
+            return self._index[key]
+        i = len(self)
+        self._index[key] = i
+        self._leaves.extend(key)
+        node = leaf_hash(key)
+        level = 0
+        while True:
+            if level == len(self._levels):
+                self._levels.append(bytearray())
+            self._levels[level].extend(node)
+            if not i & 1:
+                break
+            # i completes a subtree: its root goes one level up
+            node = node_hash(self._node(level, i - 1), node)
+            i >>= 1
+            level += 1
+        return self._index[key]
+
+    def commit(self):
+        '''Writes the new ballots (only the leaves are synced, see
+        _load_levels) and publishes a signed root if one is due'''
+        if self._committed == len(self):
+            return
+        committed = self._committed
+        filedes = open(self.folder + "leaves", 'ab')
+        filedes.write(bytes(self._leaves[HASH_SIZE * committed:]))
+        filedes.flush()
+        fsync(filedes.fileno())
+        filedes.close()
+        for level in range(len(self._levels)):
+            start = committed >> level
+            filedes = open(self._level_path(level), 'ab')
+            filedes.write(bytes(self._levels[level][HASH_SIZE * start:]))
+            filedes.close()
+        self._committed = len(self)
+        last = self._roots[-1]['size'] if self._roots else 0
+        if (self._committed - last >= self.publish_size) \
+                or (time() - self._published_at >= self.publish_interval):
+            self.publish()
+
+    def root(self, size = None):
+        '''Root of the tree of the first size ballots (of all of them by
+        default)'''
+        if size is None:
+            size = len(self)
+        if not 0 <= size <= len(self):
+            raise ValueError("invalid tree size")
+        if size == 0:
+            return sha256(b'').digest()
+        return self._range_hash(0, size)
+
+    def _range_hash(self, start, end):
+        '''Root of the tree of the ballots in [start, end), end > start'''
+        n = end - start
+        if (n & (n - 1) == 0) and (start % n == 0): # stored subtree
+            level = n.bit_length() - 1
+            return self._node(level, start >> level)
+        k = _split(n)
+        return node_hash(self._range_hash(start, start + k),
+                         self._range_hash(start + k, end))
+
+    def inclusion_proof(self, index, size = None):
+        '''Hashes proving that the ballot at index is in the tree of size
+        ballots (see verify_inclusion)'''
+        if size is None:
+            size = len(self)
+        if not 0 <= index < size <= len(self):
+            raise ValueError("invalid index or tree size")
+        return self._path(index, 0, size)
+
+    def _path(self, m, start, end):
+        n = end - start
+        if n <= 1:
+            return []
+        k = _split(n)
+        if m < k:
+            return self._path(m, start, start + k) \
+                   + [self._range_hash(start + k, end)]
+        return self._path(m - k, start + k, end) \
+               + [self._range_hash(start, start + k)]
+
+    def consistency_proof(self, first, second = None):
+        '''Hashes proving that the tree of first ballots is a prefix of the
+        tree of second ballots (see verify_consistency)'''
+        if second is None:
+            second = len(self)
+        if not 0 < first <= second <= len(self):
+            raise ValueError("invalid tree sizes")
+        if first == second:
+            return []
+        return self._subproof(first, 0, second, True)
+
+    def _subproof(self, m, start, end, complete):
+        n = end - start
+        if m == n:
+            return [] if complete else [self._range_hash(start, end)]
+        k = _split(n)
+        if m <= k:
+            return self._subproof(m, start, start + k, complete) \
+                   + [self._range_hash(start + k, end)]
+        return self._subproof(m - k, start + k, end, False) \
+               + [self._range_hash(start, start + k)]
+
+    def publish(self):
+        '''Appends a (signed) root of the committed ballots to the roots file
+        and returns it'''
+        signed_root = {'size' : self._committed,
+                       'root' : hexstr(self.root(self._committed)),
+                       'timestamp' : int(time())}
+        if self.signer is not None:
+            signed_root['signature'] = self.signer(signed_root)
+        filedes = open(self.folder + "roots", 'a')
+        filedes.write(json.dumps(signed_root, sort_keys = True) + "\n")
+        filedes.flush()
+        fsync(filedes.fileno())
+        filedes.close()
+        self._roots.append(signed_root)
+        self._published_at = time()
+        return signed_root
+
+    def signed_root(self):
+        '''Last published root, None if there is none'''
+        return self._roots[-1] if self._roots else None
+
+    def close(self):
+        self.commit()
+        if (self.signer is not None) and (self._committed > 0) \
+                and ((not self._roots)
+                     or (self._roots[-1]['size'] != self._committed)):
+            self.publish()
+
+
+def _read(path):
+    if not exists(path):
+        return b''
+    filedes = open(path, 'rb')
+    data = filedes.read()
+    filedes.close()
+    return data
+
+
+def _write(path, data):
+    filedes = open(path, 'wb')
+    filedes.write(data)
+    filedes.close()
+
+
+########################
+# Proofs verification #
+########################
+
+def verify_inclusion(fingerprint, index, size, path, root):
+    '''Checks an inclusion proof (RFC 9162, 2.1.3.2). fingerprint is
+    hexadecimal, path and root are raw hashes.'''
+    if not 0 <= index < size:
+        return False
+    (fn, sn) = (index, size - 1)
+    r = leaf_hash(unhexlify(fingerprint))
+    for p in path:
+        if sn == 0:
+            return False
+        if (fn & 1) or (fn == sn):
+            r = node_hash(p, r)
+            while not (fn & 1) and (fn != 0):
+                fn >>= 1
+                sn >>= 1
+        else:
+            r = node_hash(r, p)
+        fn >>= 1
+        sn >>= 1
+    return (sn == 0) and (r == root)
+
+
+def verify_consistency(first, second, first_root, second_root, path):
+    '''Checks a consistency proof (RFC 9162, 2.1.4.2), hashes being raw'''
+    if not 0 < first <= second:
+        return False
+    if first == second:
+        return (path == []) and (first_root == second_root)
+    if not path:
+        return False
+    if first & (first - 1) == 0: # first is a power of 2
+        path = [first_root] + list(path)
+    (fn, sn) = (first - 1, second - 1)
+    while fn & 1:
+        fn >>= 1
+        sn >>= 1
+    fr = sr = path[0]
+    for c in path[1:]:
+        if sn == 0:
+            return False
+        if (fn & 1) or (fn == sn):
+            fr = node_hash(c, fr)
+            sr = node_hash(c, sr)
+            while not (fn & 1) and (fn != 0):
+                fn >>= 1
+                sn >>= 1
+        else:
+            sr = node_hash(sr, c)
+        fn >>= 1
+        sn >>= 1
+    return (fr == first_root) and (sr == second_root) and (sn == 0)
+
+
+###################
+# Signed roots    #
+###################
+
+def root_message(election_fingerprint, signed_root):
+    '''Signed content of a root: election, size, timestamp and root hash'''
+    return unhexlify(election_fingerprint) \
+           + struct.pack('>QQ', signed_root['size'], signed_root['timestamp']) \
+           + unhexlify(signed_root['root'])
+
+
+def board_key_folder(election_folder):
+    '''Folder of the board key of an election: <name>.keys/ for the election
+    folder <name>.edata/ (both terminated by /)'''
+    folder = election_folder.rstrip('/')
+    if folder.endswith(".edata"):
+        folder = folder[:-len(".edata")]
+    return folder + ".keys/"
+
+
+def create_board_key(context, election_folder):
+    '''Creates the board key of a new election, in its key folder (see
+    board_key_folder), and publishes its public key in <edata>/merkle/.
+    Returns the public key y.'''
+    folder = board_key_folder(election_folder)
+    create_dir_ifnexists(folder)
+    chmod(folder, 0o700)
+    create_dir_ifnexists(election_folder + "merkle/")
+    (y, x) = schnorr_gen(context.g)
+    # Fails if there is already a key: it would be lost
+    filedes = fdopen(os_open(folder + "board.key",
+                             O_WRONLY | O_CREAT | O_EXCL, 0o600), 'w')
+    filedes.write(json.dumps({'x' : x.__str__()}))
+    filedes.flush()
+    fsync(filedes.fileno())
+    filedes.close()
+    filedes = open(election_folder + "merkle/board.pub.json", 'w')
+    filedes.write(json.dumps({'y' : y.json(compressed = True)}, indent = 4))
+    filedes.close()
+    return y
+
+
+def board_signer(context, folder):
+    '''Signer of the roots of the board of an election (see MerkleLog), with
+    the board key of folder (see board_key_folder). Returns (signer, y);
+    raises IOError if the election has no board key.'''
+    if not exists(folder + "board.key"):
+        raise IOError("no board key in " + folder
+                      + " (created by configure_election.py)")
+    filedes = open(folder + "board.key", 'r')
+    x = int(json.loads(filedes.read())['x'])
+    filedes.close()
+    y = (context.g * x).affine()
+
+    def signer(signed_root):
+        (e, s) = schnorr_sign(root_message(context.fingerprint, signed_root),
+                              x, context.g, y)
+        return [e.__str__(), s.__str__()]
+    return (signer, y)
+
+
+def verify_signed_root(signed_root, context, y):
+    '''Checks the signature of a published root with the board public key y'''
+    if 'signature' not in signed_root:
+        return None
+    (e, s) = [int(value) for value in signed_root['signature']]
+    return schnorr_verify(root_message(context.fingerprint, signed_root),
+                          (e, s), context.g, y)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+''' replay.py
+
+Index of the accepted ballots, used to refuse replayed ballots before their
+proofs are verified. Two sets of keys are kept (<edata>/index/):
+
+- fingerprints: sha256 of the ballot files, so that a ballot submitted twice
+  is refused without even being decoded;
+- commitments: sha256 of the commitments c2 of a ballot (compressed JSON
+  points, as on the public board), so that a copy of an accepted ballot in
+  another encoding (JSON or binary, compressed or not) is refused as well.
+
+Each set is a sorted file of 32-byte keys, memory-mapped and searched in
+place, plus a journal of the keys added since it was last sorted, held in a
+hash set. The journal is merged into the sorted file when the index is
+closed, once it holds more than COMPACT_FRACTION of the sorted keys (and at
+least COMPACT_MIN keys): a tool that accepts a single ballot only appends to
+the journal instead of rewriting the whole index. An optional Bloom filter
+over the sorted keys (bloom_bits bits per key, sized when the sorted file is
+opened) avoids touching the map for the keys that are not in it (most of the
+lookups). Building it reads every sorted key, so only long-running processes
+(the acceptance services) use it, see open_storage.
+
+@author: Richard Mathot
+'''
+
+import json
+import mmap
+import struct
+# pylint: disable=E0611
+from binascii import unhexlify
+from hashlib import sha256
+from heapq import merge
+from os import fsync, rename
+from os.path import exists
+from Election.artifact import RecordTable
+from Util.compat import to_bytes
+from Util.folder import create_dir_ifnexists
+
+KEY_SIZE = 32
+
+# Journal size (relative to the sorted file, and absolute) above which it is
+# merged into the sorted file when the index is closed
+COMPACT_FRACTION = 0.125
+COMPACT_MIN = 4096
+
+# Bits per key of the Bloom filters of the services (about 1% of false
+# positives with 4 hashes)
+BLOOM_BITS = 10
+
+
+def commitment_key(c2s):
+    '''Key of the commitments of a ballot: c2s is the list of its c2 as
+    compressed JSON points (see encode_public_ballot)'''
+    return sha256(to_bytes(json.dumps(c2s, sort_keys = True))).digest()
+
+
+def entry_commitments(entry):
+    '''Commitments c2 of a public board entry (a dict), as a list'''
+    c2s = entry['c2']
+    return c2s if isinstance(c2s, list) else [c2s]
+
+
+class ReplayIndex(object):
+    '''Fingerprints and commitments of the accepted ballots of an election'''
+
+    fingerprints = None
+    commitments = None
+
+    def __init__(self, folder, bloom_bits = 0):
+        '''folder has to be terminated by /. bloom_bits is the number of bits
+        per key of the Bloom filter of each set (0: no filter).'''
+        create_dir_ifnexists(folder)
+        self.fingerprints = KeyIndex(folder + "fingerprints", bloom_bits)
+        self.commitments = KeyIndex(folder + "commitments", bloom_bits)
+
+    def seen(self, fingerprint = None, c2s = None):
+        '''True if a ballot of this fingerprint, or with these commitments
+        (compressed JSON points), was already accepted'''
+        if (fingerprint is not None) \
+                and (unhexlify(fingerprint) in self.fingerprints):
+            return True
+        return (c2s is not None) and (commitment_key(c2s) in self.commitments)
+
+    def add(self, fingerprint, entry):
+        '''Records an accepted ballot, given its public board entry'''
+        self.fingerprints.add(unhexlify(fingerprint))
+        self.commitments.add(commitment_key(entry_commitments(entry)))
+
+    def commit(self):
+        self.fingerprints.commit()
+        self.commitments.commit()
+
+    def close(self):
+        self.fingerprints.close()
+        self.commitments.close()
+
+
+class KeyIndex(object):
+    '''A set of 32-byte keys: a sorted file (path.idx) and a journal
+    (path.log) of the keys added since it was sorted'''
+
+    path = None
+
+    def __init__(self, path, bloom_bits = 0):
+        self.path = path
+        self._map = None
+        self._records = None
+        self._recent = set()
+        self._pending = []
+        self._bloom_bits = bloom_bits
+        self._bloom = None
+        self._open_sorted()
+        if exists(path + ".log"):
+            filedes = open(path + ".log", 'rb')
+            data = filedes.read()
+            filedes.close()
+            usable = len(data) - len(data) % KEY_SIZE
+            for start in range(0, usable, KEY_SIZE):
+                key = data[start:start + KEY_SIZE]
+                # Already sorted if the last merge did not clear the journal
+                if (self._records is None) or (self._records.get(key) is None):
+                    self._recent.add(key)
+            if usable != len(data): # partially written last key
+                filedes = open(path + ".log", 'r+b')
+                filedes.truncate(usable)
+                filedes.close()
+        self._journal = open(path + ".log", 'ab')
+
+    def _open_sorted(self):
+        if self._map is not None:
+            self._map.close()
+        (self._map, self._records, self._bloom) = (None, None, None)
+        if not exists(self.path + ".idx"):
+            return
+        filedes = open(self.path + ".idx", 'rb')
+        try:
+            self._map = mmap.mmap(filedes.fileno(), 0,
+                                  access = mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError): # empty file
+            return
+        finally:
+            filedes.close()
+        self._records = RecordTable(self._map, 0, len(self._map), KEY_SIZE,
+                                    '')
+        if self._bloom_bits > 0:
+            self._bloom = BloomFilter(self._bloom_bits * len(self._records))
+            for i in range(len(self._records)):
+                self._bloom.add(self._records[i])
+
+    def __contains__(self, key):
+        if key in self._recent:
+            return True
+        if self._records is None:
+            return False
+        if (self._bloom is not None) and (key not in self._bloom):
+            return False
+        return self._records.get(key) is not None
+
+    def __len__(self):
+        return len(self._recent) \
+               + (len(self._records) if self._records is not None else 0)
+
+    def __iter__(self):
+        '''Iterates over the keys in increasing order'''
+        records = self._records
+        if records is None:
+            return iter(sorted(self._recent))
+        return merge((records[i] for i in range(len(records))),
+                     sorted(self._recent))
+
+    def add(self, key):
+        '''Adds a key; it is only durable after commit()'''
+        if key not in self:
+            self._recent.add(key)
+            self._pending.append(key)
+
+    def commit(self):
+        if not self._pending:
+            return
+        self._journal.write(b''.join(self._pending))
+        self._journal.flush()
+        fsync(self._journal.fileno())
+        self._pending = []
+
+    def compact(self):
+        '''Merges the journal into the sorted file'''
+        self.commit()
+        if not self._recent:
+            return
+        keys = sorted(self._recent)
+        if self._records is not None:
+            keys = sorted(keys + [self._records[i]
+                                  for i in range(len(self._records))])
+        filedes = open(self.path + ".idx.tmp", 'wb')
+        filedes.write(b''.join(keys))
+        filedes.flush()
+        fsync(filedes.fileno())
+        filedes.close()
+        rename(self.path + ".idx.tmp", self.path + ".idx")
+        self._journal.close()
+        self._journal = open(self.path + ".log", 'wb')
+        self._recent = set()
+        self._open_sorted()
+
+    def close(self):
+        '''Merges the journal into the sorted file if it is large enough,
+        otherwise only commits it'''
+        sorted_keys = len(self._records) if self._records is not None else 0
+        if len(self._recent) > max(COMPACT_MIN,
+                                   COMPACT_FRACTION * sorted_keys):
+            self.compact()
+        else:
+            self.commit()
+        self._journal.close()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class BloomFilter(object):
+    '''Bloom filter of uniformly distributed keys (hashes): the positions of
+    a key are read from its first bytes'''
+
+    def __init__(self, bits, hashes = 4):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, key):
+        for value in struct.unpack_from('>%dI' % self.hashes, key):
+            yield value % self.bits
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self._array[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
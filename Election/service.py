@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+''' service.py
+
+Long-running ballot acceptance service. The election is loaded once (settings,
+public key and fixed-base tables stay in memory) and ballots are submitted as
+HTTP requests on localhost:
+
+    POST /ballots        body: a ballot, in JSON or binary encoding
+
+The answer is a JSON object {"fingerprint": ..., "accepted": true|false}
+(status 200 if the ballot is accepted, 422 if it is refused). Accepted ballots
+are stored exactly as accept_ballot.py stores them. See Election/wire.py for
+both ballot encodings.
+
+The Merkle tree of the public board (see Election/merkle.py) is also served,
+hashes being hexadecimal:
+
+    GET /root                                       last signed root
+    GET /proof/inclusion?fingerprint=...[&size=n]   {"index", "size", "path"}
+    GET /proof/consistency?first=m[&second=n]       {"first", "second", "path"}
+
+size and second default to the current size of the tree.
+
+    GET /metrics        latency of the pipeline stages (empty unless
+                        tracing is enabled, see Util/tracing.py) and ballots
+                        refused by each validation stage (see
+                        Election/validation.py), in the Prometheus text format
+
+@author: Richard Mathot
+'''
+
+import json
+import logging
+# pylint: disable=E0611
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse, parse_qs
+except ImportError: # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qs
+from Election.acceptance import accept_ballot
+from Election.validation import metrics as rejection_metrics
+from Election.wire import MAX_BALLOT_SIZE
+from Util.compat import hexstr, to_bytes
+from Util.tracing import metrics
+
+
+class BallotRequestHandler(BaseHTTPRequestHandler):
+    '''Handles ballot submissions for the election of the server'''
+
+    def do_POST(self):
+        #pylint: disable=C0103
+        if self.path.rstrip('/') != '/ballots':
+            self._answer(404, {'error' : 'unknown resource'})
+            return
+        length = int(self.headers.get('content-length', 0))
+        if (length <= 0) | (length > MAX_BALLOT_SIZE):
+            self._answer(413, {'error' : 'invalid ballot size'})
+            return
+        ballot_raw = self.rfile.read(length)
+        (fingerprint, accepted) = accept_ballot(self.server.context, ballot_raw,
+                                                self.server.storage)
+        self._answer(200 if accepted else 422, {'fingerprint' : fingerprint,
+                                                'accepted' : accepted})
+
+    def do_GET(self):
+        #pylint: disable=C0103
+        url = urlparse(self.path)
+        query = dict((key, values[0])
+                     for (key, values) in parse_qs(url.query).items())
+        merkle = self.server.storage.merkle
+        if url.path == '/metrics':
+            body = to_bytes(metrics() + rejection_metrics())
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', len(body).__str__())
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        try:
+            if url.path == '/root':
+                signed_root = merkle.signed_root()
+                if signed_root is None:
+                    self._answer(404, {'error' : 'no root published yet'})
+                else:
+                    self._answer(200, signed_root)
+            elif url.path == '/proof/inclusion':
+                index = merkle.index(query['fingerprint'])
+                size = int(query.get('size', len(merkle)))
+                if (index is None) or (index >= size):
+                    self._answer(404, {'error' : 'unknown ballot'})
+                    return
+                self._answer(200, {'index' : index, 'size' : size,
+                                   'path' : [hexstr(node) for node in
+                                             merkle.inclusion_proof(index,
+                                                                    size)]})
+            elif url.path == '/proof/consistency':
+                first = int(query['first'])
+                second = int(query.get('second', len(merkle)))
+                self._answer(200, {'first' : first, 'second' : second,
+                                   'path' : [hexstr(node) for node in
+                                             merkle.consistency_proof(first,
+                                                                      second)]})
+            else:
+                self._answer(404, {'error' : 'unknown resource'})
+        except (KeyError, ValueError, TypeError):
+            self._answer(400, {'error' : 'invalid request'})
+
+    def _answer(self, status, content):
+        body = to_bytes(json.dumps(content))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body).__str__())
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.info(fmt, *args)
+
+
+class BallotServer(HTTPServer):
+    '''HTTP server bound to localhost, holding a warm ElectionContext and the
+    open boards of the election'''
+
+    context = None
+    storage = None
+
+    def __init__(self, context, storage, port,
+                 handler = BallotRequestHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', port), handler)
+        self.context = context
+        self.storage = storage
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+''' sharding.py
+
+Acceptance of the ballots of an election by N independent acceptors.
+
+Ballots are partitioned by the prefix of their fingerprint: acceptor i owns
+the fingerprints whose first 32 bits x satisfy x * N >> 32 == i (N contiguous
+ranges). Each acceptor has its own folder, <edata>/shards/<i>/, with
+everything open_storage expects (boards, Merkle tree, replay index), and the
+running aggregate of the ballots it accepted:
+
+    aggregate.json  {"count": ..., "aggregate": [[c0, c1, c2], ...]}
+
+(the homomorphic sum of their ciphertexts, see ccs_tally_vector). Acceptors
+share no file and no lock, so they can run as separate processes
+(accept_sharded) or hosts. They only share the board key of the election
+(see board_key_folder in Election/merkle.py).
+
+At close, the coordinator (merge_shards) merges the partial aggregates and
+the roots of the shard trees into <edata>/merged.json:
+
+    {"election": ..., "count": ..., "aggregate": [[c0, c1, c2], ...],
+     "shards": [the signed root of each shard], "root": ...,
+     "excluded": [...]}
+
+root is signed with the board key; its hash is the Merkle root (see
+Election/merkle.py) of the shard roots, each leaf being the root of a shard
+followed by its size (8 bytes, big-endian), and its size the number of
+ballots of all the boards.
+
+A ballot re-encoded by an attacker has a new fingerprint, so it may land on
+another shard than the original: a shard only refuses the replays of its own
+ballots. The coordinator therefore looks for commitments accepted by several
+shards (merging their sorted commitment indexes); only the ballot of the
+smallest fingerprint is counted, the others are listed in "excluded" and left
+out of the aggregate.
+
+Each shard folder is an election folder for the other tools, e.g.
+audit_election.py checks one shard at a time.
+
+@author: Richard Mathot
+'''
+
+import json
+import struct
+# pylint: disable=E0611
+from binascii import unhexlify
+from hashlib import sha256
+from heapq import merge
+from multiprocessing import Pool
+from os import fsync, rename
+from os.path import exists
+from time import time
+from Crypto.ccs_va import ccs_tally_vector
+from Election.acceptance import accept_ballot
+from Election.context import load_context
+from Election.merkle import board_signer, board_key_folder, merkle_root
+from Election.replay import commitment_key, entry_commitments
+from Election.storage import create_storage, open_storage
+from Election.wire import decode_any
+from Util.compat import hexstr
+from Util.tracing import span
+
+SHARDS = "shards.json"
+MERGED = "merged.json"
+AGGREGATE = "aggregate.json"
+
+
+def shard_of(fingerprint, count):
+    '''Shard owning a ballot fingerprint (hexadecimal), among count shards'''
+    return (int(fingerprint[:8], 16) * count) >> 32
+
+
+def shard_folder(election_folder, shard):
+    return election_folder + "shards/" + shard.__str__() + "/"
+
+
+def shard_count(election_folder):
+    '''Number of shards of an election, 0 if it is not sharded'''
+    if not exists(election_folder + SHARDS):
+        return 0
+    filedes = open(election_folder + SHARDS, 'r')
+    count = json.loads(filedes.read())['shards']
+    filedes.close()
+    return count
+
+
+def create_shards(context, election_folder, count, log = False):
+    '''Creates the (empty) shards of a new election (its board key must exist
+    already, see create_board_key)'''
+    if count < 1:
+        raise ValueError("at least one shard is expected")
+    board_signer(context, board_key_folder(election_folder)) # fails early
+    for shard in range(count):
+        create_storage(shard_folder(election_folder, shard), log).close()
+    filedes = open(election_folder + SHARDS, 'w')
+    filedes.write(json.dumps({'shards' : count}, indent = 4))
+    filedes.close()
+
+
+def _write_json(path, content):
+    '''Replaces a JSON file (written aside, then renamed)'''
+    filedes = open(path + ".tmp", 'w')
+    filedes.write(json.dumps(content, indent = 4))
+    filedes.flush()
+    fsync(filedes.fileno())
+    filedes.close()
+    rename(path + ".tmp", path)
+
+
+######################
+# Aggregates         #
+######################
+
+def encode_aggregate(aggregate):
+    return [[P.json(compressed = True) for P in c] for c in aggregate]
+
+
+def decode_aggregate(raw, context):
+    return [(context.decode_point(c0, 1), context.decode_point(c1, 1),
+             context.decode_point(c2, 2)) for (c0, c1, c2) in raw]
+
+
+def board_aggregate(context, storage, excluded = ()):
+    '''(count, aggregate) of the ballots of a secret board, but the excluded
+    fingerprints'''
+    ballots = [decode_any(ballot_raw, context)[1][0]
+               for (fingerprint, ballot_raw) in storage.sb.scan()
+               if fingerprint not in excluded]
+    return (len(ballots), ccs_tally_vector(ballots))
+
+
+def shard_aggregate(context, folder, storage):
+    '''(count, aggregate) of a shard. The aggregate is written after the
+    boards: it is computed again from the secret board if an acceptor stopped
+    in between.'''
+    if exists(folder + AGGREGATE):
+        filedes = open(folder + AGGREGATE, 'r')
+        recorded = json.loads(filedes.read())
+        filedes.close()
+        if recorded['count'] == len(storage.sb):
+            return (recorded['count'],
+                    decode_aggregate(recorded['aggregate'], context))
+    (count, aggregate) = board_aggregate(context, storage)
+    _write_json(folder + AGGREGATE, {'count' : count,
+                                     'aggregate' : encode_aggregate(aggregate)})
+    return (count, aggregate)
+
+
+######################
+# Acceptors          #
+######################
+
+class Acceptor(object):
+    '''Acceptor of the ballots of one shard'''
+
+    context = None
+    shard = None
+    shards = None
+    folder = None
+    storage = None
+    count = None
+    aggregate = None
+
+    def __init__(self, context, election_folder, shard):
+        self.context = context
+        self.shard = shard
+        self.shards = shard_count(election_folder)
+        if not 0 <= shard < self.shards:
+            raise ValueError("no shard " + shard.__str__())
+        self.folder = shard_folder(election_folder, shard)
+        self.storage = open_storage(self.folder, context,
+                                    board_key_folder(election_folder))
+        (self.count, self.aggregate) = shard_aggregate(context, self.folder,
+                                                       self.storage)
+
+    def owns(self, fingerprint):
+        return shard_of(fingerprint, self.shards) == self.shard
+
+    def accept(self, ballot_raw, ballot_path = None):
+        '''Verifies and durably stores a ballot of the shard, and adds it to
+        the aggregate (see accept_ballot). Returns (ballot_fingerprint,
+        accepted).'''
+        fingerprint = sha256(ballot_raw).hexdigest()
+        if not self.owns(fingerprint):
+            raise ValueError("ballot " + fingerprint + " belongs to shard "
+                             + shard_of(fingerprint, self.shards).__str__())
+        (fingerprint, accepted) = accept_ballot(self.context, ballot_raw,
+                                                self.storage, ballot_path)
+        if accepted:
+            with span('shard.aggregate'):
+                (_, (cs, _, _, _)) = decode_any(ballot_raw, self.context)
+                if self.count == 0:
+                    self.aggregate = ccs_tally_vector([cs])
+                else:
+                    self.aggregate = ccs_tally_vector([self.aggregate, cs])
+                self.count += 1
+                _write_json(self.folder + AGGREGATE,
+                            {'count' : self.count,
+                             'aggregate' : encode_aggregate(self.aggregate)})
+        return (fingerprint, accepted)
+
+    def close(self):
+        self.storage.close()
+
+
+def _accept_shard(task):
+    '''Runs in a worker process (see accept_sharded)'''
+    (settings_path, election_folder, shard, ballot_paths) = task
+    context = load_context(settings_path, precompute = True)
+    acceptor = Acceptor(context, election_folder, shard)
+    accepted = 0
+    for ballot_path in ballot_paths:
+        filedes = open(ballot_path, 'rb')
+        ballot_raw = filedes.read()
+        filedes.close()
+        accepted += acceptor.accept(ballot_raw, ballot_path)[1]
+    acceptor.close()
+    return (shard, accepted, len(ballot_paths) - accepted)
+
+
+def accept_sharded(settings_path, election_folder, ballot_paths):
+    '''Accepts ballot files with one process per shard (each file being
+    routed to the shard of its fingerprint; accepted files are removed).
+    Returns a list of (shard, accepted, refused).'''
+    count = shard_count(election_folder)
+    routed = [[] for _ in range(count)]
+    with span('shard.route'):
+        for ballot_path in ballot_paths:
+            filedes = open(ballot_path, 'rb')
+            fingerprint = sha256(filedes.read()).hexdigest()
+            filedes.close()
+            routed[shard_of(fingerprint, count)].append(ballot_path)
+    tasks = [(settings_path, election_folder, shard, routed[shard])
+             for shard in range(count) if routed[shard]]
+    if not tasks:
+        return []
+    pool = Pool(len(tasks))
+    try:
+        return pool.map(_accept_shard, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+######################
+# Coordinator        #
+######################
+
+def _shared_commitments(storages):
+    '''Commitment keys accepted by several shards'''
+    shared = set()
+    previous = None
+    for key in merge(*[iter(storage.replay.commitments)
+                       for storage in storages]):
+        if key == previous:
+            shared.add(key)
+        previous = key
+    return shared
+
+
+def _excluded(storages, shared):
+    '''Fingerprints of the ballots whose commitments were accepted by another
+    shard with a smaller fingerprint'''
+    owners = {}
+    excluded = set()
+    if not shared:
+        return excluded
+    for storage in storages:
+        for (fingerprint, entry) in storage.pb.scan():
+            key = commitment_key(entry_commitments(json.loads(entry)))
+            if key not in shared:
+                continue
+            if key in owners:
+                excluded.add(max(fingerprint, owners[key]))
+                owners[key] = min(fingerprint, owners[key])
+            else:
+                owners[key] = fingerprint
+    return excluded
+
+
+def merge_shards(context, election_folder):
+    '''Merges the aggregates and the roots of the shards of an election (no
+    acceptor may be running) into <edata>/merged.json. Returns (merged,
+    aggregate): the content of merged.json and the decoded aggregate.'''
+    #pylint: disable=R0914
+    count = shard_count(election_folder)
+    (signer, _) = board_signer(context, board_key_folder(election_folder))
+    folders = [shard_folder(election_folder, shard) for shard in range(count)]
+    storages = [open_storage(folder, context,
+                             board_key_folder(election_folder))
+                for folder in folders]
+    try:
+        with span('shard.merge.replay'):
+            excluded = _excluded(storages, _shared_commitments(storages))
+        roots = []
+        aggregates = []
+        total = 0
+        with span('shard.merge.aggregate'):
+            for (folder, storage) in zip(folders, storages):
+                merkle = storage.merkle
+                signed_root = merkle.signed_root()
+                if (signed_root is None) \
+                        or (signed_root['size'] != len(merkle)):
+                    signed_root = merkle.publish()
+                roots.append(signed_root)
+                if any(fingerprint in excluded
+                       for fingerprint in storage.pb.fingerprints()):
+                    (shard_total, aggregate) = board_aggregate(context, storage,
+                                                               excluded)
+                else:
+                    (shard_total, aggregate) = shard_aggregate(context, folder,
+                                                               storage)
+                if shard_total > 0:
+                    aggregates.append(aggregate)
+                total += shard_total
+            aggregate = ccs_tally_vector(aggregates)
+    finally:
+        for storage in storages:
+            storage.close()
+
+    root = {'size' : sum(signed_root['size'] for signed_root in roots),
+            'root' : hexstr(merkle_root([unhexlify(signed_root['root'])
+                                         + struct.pack('>Q',
+                                                       signed_root['size'])
+                                         for signed_root in roots])),
+            'timestamp' : int(time())}
+    root['signature'] = signer(root)
+    merged = {'election' : context.fingerprint,
+              'count' : total,
+              'aggregate' : encode_aggregate(aggregate),
+              'shards' : roots,
+              'root' : root,
+              'excluded' : sorted(excluded)}
+    _write_json(election_folder + MERGED, merged)
+    return (merged, aggregate)
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+''' storage.py
+
+Storage of the boards of an election: the secret board (sb, full ballots) and
+the public board (pb, commitments and OR proofs). Every tool reads and writes
+ballots through the same interface, whatever the backend is:
+
+- FileBoard: one <fingerprint>.bal.json file per ballot in a folder (the
+  historical layout, convenient for small elections), plus the list of the
+  committed fingerprints in acceptance order (<folder>/order);
+- LogBoard: append-only segment files plus an offset index keyed by ballot
+  fingerprint, for large elections (no inode per ballot, sequential scans,
+  group-committed writes with one fsync per batch).
+
+An election uses the log backend if its folder contains sb.log/ (created by
+configure_election.py --log), otherwise the file backend.
+
+The fingerprints of the public board are also accumulated in a Merkle tree
+(<edata>/merkle/, see Election/merkle.py), in the order the ballots were
+accepted; ballots accepted before it existed (or while a crash prevented its
+commit) are added when it is opened. So are they to the index of the accepted
+fingerprints and commitments (<edata>/index/, see Election/replay.py). Both
+only fall behind the public board, in acceptance order, so only its tail is
+read again.
+
+@author: Richard Mathot
+'''
+
+import json
+import struct
+from binascii import unhexlify
+from os import fsync, listdir, stat, utime
+from os.path import exists, getsize
+from time import time
+from zlib import crc32
+from Election.merkle import MerkleLog, board_signer, board_key_folder
+from Election.replay import ReplayIndex, BLOOM_BITS
+from Util.compat import hexstr
+from Util.folder import create_dir_ifnexists
+
+BOARDS = ('sb', 'pb')
+
+
+def open_storage(election_folder, context = None, key_folder = None,
+                 bloom = False):
+    '''Opens both boards of an election with the backend it was configured
+    with, and the Merkle tree of the public board. Roots are only signed
+    (with the board key) if the election context is given. The board key is
+    in the key folder of the election (see board_key_folder), or in
+    key_folder if it is given (shards share the key of their election, see
+    Election/sharding.py).
+    If bloom is True, the replay index gets Bloom filters (BLOOM_BITS bits per
+    indexed key): worth it for the services, which look up every submitted
+    ballot, not for the tools that open the storage for a single one.'''
+    if exists(election_folder + "sb.log/"):
+        (sb, pb) = (LogBoard(election_folder + "sb.log/"),
+                    LogBoard(election_folder + "pb.log/"))
+    else:
+        (sb, pb) = (FileBoard(election_folder + "sb/", ordered = True),
+                    FileBoard(election_folder + "pb/", ordered = True))
+    signer = None
+    if context is not None:
+        (signer, _) = board_signer(context, key_folder
+                                   or board_key_folder(election_folder))
+    merkle = MerkleLog(election_folder + "merkle/", signer)
+    if len(merkle) < len(pb):
+        for fingerprint in pb.fingerprints(len(merkle)):
+            merkle.append(fingerprint)
+        merkle.commit()
+    replay = ReplayIndex(election_folder + "index/",
+                         BLOOM_BITS if bloom else 0)
+    if len(replay.fingerprints) < len(pb):
+        for fingerprint in pb.fingerprints(len(replay.fingerprints)):
+            replay.add(fingerprint, json.loads(pb.get(fingerprint)))
+        replay.commit()
+    return ElectionStorage(sb, pb, merkle, replay)
+
+
+def create_storage(election_folder, log = False):
+    '''Creates the (empty) boards of a new election'''
+    for board in BOARDS:
+        create_dir_ifnexists(election_folder + board + (".log/" if log else "/"))
+    return open_storage(election_folder)
+
+
+class ElectionStorage(object):
+    '''The secret and public boards of an election'''
+
+    sb = None
+    pb = None
+    merkle = None
+    replay = None
+
+    def __init__(self, sb, pb, merkle = None, replay = None):
+        self.sb = sb
+        self.pb = pb
+        self.merkle = merkle
+        self.replay = replay
+
+    def commit(self):
+        '''Makes every pending write durable (secret board first, the Merkle
+        tree last)'''
+        self.sb.commit()
+        self.pb.commit()
+        if self.merkle is not None:
+            self.merkle.commit()
+        if self.replay is not None:
+            self.replay.commit()
+
+    def close(self):
+        self.sb.close()
+        self.pb.close()
+        if self.merkle is not None:
+            self.merkle.close()
+        if self.replay is not None:
+            self.replay.close()
+
+
+# Line of the order file of a FileBoard: hex fingerprint (sha256) and \n
+_ORDER_LINE = 65
+
+
+class FileBoard(object):
+    '''A board stored as one <fingerprint>.bal.json file per ballot.
+
+    An ordered board also keeps the fingerprints of its committed ballots in
+    acceptance order, one fixed-width line each, in <folder>/order: its length
+    is the size of that file. The ballots written by a commit that did not
+    complete are added to it when the board is opened, which is only checked
+    for (with a listing of the folder) if the folder was modified after the
+    order file.'''
+
+    SUFFIX = ".bal.json"
+
+    folder = None
+    ordered = False
+
+    def __init__(self, folder, suffix = None, ordered = False):
+        '''folder has to be terminated by /'''
+        self.folder = folder
+        if suffix is not None:
+            self.SUFFIX = suffix
+        self.ordered = ordered
+        self._pending = []
+        self._written = []
+        if ordered:
+            self._resync()
+
+    def _order_path(self):
+        return self.folder + "order"
+
+    def _resync(self):
+        '''Completes the order file with the ballots missing from it (files
+        written before it existed, or before a crash), in name order'''
+        path = self._order_path()
+        if exists(path) \
+                and (stat(self.folder).st_mtime < stat(path).st_mtime):
+            return
+        if exists(path):
+            filedes = open(path, 'r+b')
+            data = filedes.read()
+            # A partially written last line is ignored (and rewritten)
+            usable = len(data) - len(data) % _ORDER_LINE
+            filedes.truncate(usable)
+            filedes.close()
+            known = set(data[start:start + _ORDER_LINE - 1].decode('ascii')
+                        for start in range(0, usable, _ORDER_LINE))
+        else:
+            known = set()
+        missing = [name[:-len(self.SUFFIX)] for name in listdir(self.folder)
+                   if name.endswith(self.SUFFIX)]
+        self._write_order(sorted(fingerprint for fingerprint in missing
+                                 if fingerprint not in known))
+        utime(path, None) # up to date with the folder
+
+    def _write_order(self, fingerprints):
+        filedes = open(self._order_path(), 'ab')
+        filedes.write(b''.join(fingerprint.encode('ascii') + b'\n'
+                               for fingerprint in fingerprints))
+        filedes.flush()
+        fsync(filedes.fileno())
+        filedes.close()
+
+    def path(self, fingerprint):
+        return self.folder + fingerprint + self.SUFFIX
+
+    def append(self, fingerprint, content):
+        '''Writes a ballot (content is the serialised ballot)'''
+        filedes = open(self.path(fingerprint), "wb")
+        filedes.write(content)
+        filedes.flush()
+        self._pending.append(filedes)
+        self._written.append(fingerprint)
+
+    def commit(self):
+        '''fsyncs every file written since the last commit, then records them
+        in the order file (if the board is ordered)'''
+        for filedes in self._pending:
+            fsync(filedes.fileno())
+            filedes.close()
+        if self.ordered and self._written:
+            self._write_order(self._written)
+        self._pending = []
+        self._written = []
+
+    def get(self, fingerprint):
+        '''Content of a ballot, None if it is not on the board'''
+        if not exists(self.path(fingerprint)):
+            return None
+        filedes = open(self.path(fingerprint), 'rb')
+        content = filedes.read()
+        filedes.close()
+        return content
+
+    def __contains__(self, fingerprint):
+        return exists(self.path(fingerprint))
+
+    def fingerprints(self, start = 0):
+        '''Fingerprints of the ballots from the start-th one, in acceptance
+        order if the board is ordered (in name order otherwise)'''
+        if not self.ordered:
+            return sorted(name[:-len(self.SUFFIX)]
+                          for name in listdir(self.folder)
+                          if name.endswith(self.SUFFIX))[start:]
+        filedes = open(self._order_path(), 'rb')
+        filedes.seek(start * _ORDER_LINE)
+        data = filedes.read()
+        filedes.close()
+        return [data[offset:offset + _ORDER_LINE - 1].decode('ascii')
+                for offset in range(0, len(data) - _ORDER_LINE + 1,
+                                    _ORDER_LINE)]
+
+    def __len__(self):
+        if self.ordered:
+            return getsize(self._order_path()) // _ORDER_LINE
+        return len(self.fingerprints())
+
+    def scan(self):
+        '''Iterates over (fingerprint, content) for every ballot'''
+        for fingerprint in self.fingerprints():
+            yield (fingerprint, self.get(fingerprint))
+
+    def close(self):
+        self.commit()
+
+
+# Record: payload length, fingerprint, payload, CRC32 of fingerprint + payload
+_RECORD_HEADER = struct.Struct('>I32s')
+_RECORD_TRAILER = struct.Struct('>I')
+# Index entry: fingerprint, segment number, offset of the record, payload length
+_INDEX_ENTRY = struct.Struct('>32sIQI')
+
+
+class LogBoard(object):
+    '''A board stored as append-only segment files with an offset index.
+
+    Appends are buffered; commit() writes them with one fsync of the segment
+    followed by one fsync of the index. If the process dies between both, the
+    records missing from the index are recovered from the segments when the
+    board is opened again (a partially written record is discarded).'''
+
+    folder = None
+    segment_size = None
+    group_size = None
+    group_interval = None
+
+    def __init__(self, folder, segment_size = 64 << 20, group_size = 64,
+                 group_interval = 0.1):
+        '''Opens (or creates) the log in folder (terminated by /).
+        Pending appends are committed automatically once there are
+        group_size of them or once group_interval seconds have elapsed since
+        the first of them.'''
+        create_dir_ifnexists(folder)
+        self.folder = folder
+        self.segment_size = segment_size
+        self.group_size = group_size
+        self.group_interval = group_interval
+        self._index = {}
+        self._order = []
+        self._pending = []
+        self._pending_since = None
+        self._load_index()
+        self._recover()
+        self._segment = self._last_segment()
+        self._segment_file = _open_append(self._segment_path(self._segment))
+        self._index_file = _open_append(self.folder + "index")
+
+    def _segment_path(self, segment):
+        return self.folder + "%08d.seg" % segment
+
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in listdir(self.folder)
+                      if name.endswith(".seg"))
+
+    def _last_segment(self):
+        segments = self._segments()
+        return segments[-1] if segments else 0
+
+    def _load_index(self):
+        if not exists(self.folder + "index"):
+            return
+        filedes = open(self.folder + "index", 'rb')
+        data = filedes.read()
+        filedes.close()
+        # A partially written last entry is ignored (and rewritten later)
+        usable = len(data) - len(data) % _INDEX_ENTRY.size
+        for start in range(0, usable, _INDEX_ENTRY.size):
+            (key, segment, offset, length) = \
+                _INDEX_ENTRY.unpack_from(data, start)
+            self._add(key, segment, offset, length)
+        if usable != len(data):
+            filedes = open(self.folder + "index", 'r+b')
+            filedes.truncate(usable)
+            filedes.close()
+
+    def _add(self, key, segment, offset, length):
+        if key not in self._index:
+            self._order.append(key)
+        self._index[key] = (segment, offset, length)
+
+    def _recover(self):
+        '''Re-indexes the records written after the last indexed one, in
+        every segment from the one that holds it (a commit may have crossed
+        the end of a segment)'''
+        (first, offset) = (None, 0)
+        if self._order:
+            (first, start, length) = self._index[self._order[-1]]
+            offset = start + _RECORD_HEADER.size + length \
+                     + _RECORD_TRAILER.size
+        recovered = []
+        for segment in self._segments():
+            if (first is not None) and (segment < first):
+                continue
+            if segment != first:
+                offset = 0
+            filedes = open(self._segment_path(segment), 'r+b')
+            for (key, start, length, _) in _read_records(filedes, offset):
+                recovered.append(_INDEX_ENTRY.pack(key, segment, start,
+                                                   length))
+                self._add(key, segment, start, length)
+                offset = start + _RECORD_HEADER.size + length \
+                         + _RECORD_TRAILER.size
+            filedes.truncate(offset) # partially written record
+            filedes.close()
+        if recovered:
+            filedes = open(self.folder + "index", 'ab')
+            filedes.write(b''.join(recovered))
+            filedes.flush()
+            fsync(filedes.fileno())
+            filedes.close()
+
+    def append(self, fingerprint, content):
+        '''Appends a ballot (content is the serialised ballot). The write is
+        only durable after commit(), which may happen automatically.'''
+        if not self._pending:
+            self._pending_since = time()
+        self._pending.append((unhexlify(fingerprint), content))
+        if (len(self._pending) >= self.group_size) \
+                or (time() - self._pending_since >= self.group_interval):
+            self.commit()
+
+    def commit(self):
+        '''Writes the pending appends with a single fsync of the segment and of
+        the index'''
+        if not self._pending:
+            return
+        records = []
+        entries = []
+        offset = self._segment_file.tell()
+        for (key, content) in self._pending:
+            if offset >= self.segment_size:
+                self._flush_segment(records)
+                records = []
+                self._segment += 1
+                self._segment_file.close()
+                self._segment_file = _open_append(
+                    self._segment_path(self._segment))
+                offset = 0
+            records.append(_RECORD_HEADER.pack(len(content), key) + content
+                           + _RECORD_TRAILER.pack(crc32(key + content)
+                                                  & 0xffffffff))
+            entries.append((key, self._segment, offset, len(content)))
+            offset += _RECORD_HEADER.size + len(content) + _RECORD_TRAILER.size
+        self._flush_segment(records)
+
+        self._index_file.write(b''.join(_INDEX_ENTRY.pack(*entry)
+                                        for entry in entries))
+        self._index_file.flush()
+        fsync(self._index_file.fileno())
+        for entry in entries:
+            self._add(*entry)
+        self._pending = []
+
+    def _flush_segment(self, records):
+        self._segment_file.write(b''.join(records))
+        self._segment_file.flush()
+        fsync(self._segment_file.fileno())
+
+    def get(self, fingerprint):
+        '''Content of a ballot, None if it is not on the board'''
+        key = unhexlify(fingerprint)
+        if key not in self._index:
+            for (pending_key, content) in self._pending:
+                if pending_key == key:
+                    return content
+            return None
+        (segment, offset, length) = self._index[key]
+        filedes = open(self._segment_path(segment), 'rb')
+        filedes.seek(offset + _RECORD_HEADER.size)
+        content = filedes.read(length)
+        filedes.close()
+        return content
+
+    def __contains__(self, fingerprint):
+        key = unhexlify(fingerprint)
+        return (key in self._index) \
+               or any(key == pending[0] for pending in self._pending)
+
+    def fingerprints(self, start = 0):
+        '''Fingerprints of the committed ballots from the start-th one, in
+        append order'''
+        return [hexstr(key) for key in self._order[start:]]
+
+    def __len__(self):
+        return len(self._order)
+
+    def scan(self):
+        '''Iterates sequentially over (fingerprint, content) for every
+        committed ballot, in append order'''
+        for segment in self._segments():
+            filedes = open(self._segment_path(segment), 'rb')
+            for (key, _, _, content) in _read_records(filedes, 0):
+                if key in self._index:
+                    yield (hexstr(key), content)
+            filedes.close()
+
+    def close(self):
+        self.commit()
+        self._segment_file.close()
+        self._index_file.close()
+
+
+def _open_append(path):
+    '''Opens a file in binary append mode, positioned at its end'''
+    filedes = open(path, 'ab')
+    filedes.seek(0, 2)
+    return filedes
+
+
+def _read_records(filedes, offset, chunk = 1 << 20):
+    '''Iterates over the complete and valid records of a segment file, from
+    offset: yields (key, offset, length, content)'''
+    filedes.seek(offset)
+    buf = b''
+    start = offset
+    while True:
+        data = filedes.read(chunk)
+        buf += data
+        pos = 0
+        while len(buf) - pos >= _RECORD_HEADER.size:
+            (length, key) = _RECORD_HEADER.unpack_from(buf, pos)
+            end = pos + _RECORD_HEADER.size + length + _RECORD_TRAILER.size
+            if len(buf) < end:
+                break
+            content = buf[pos + _RECORD_HEADER.size:end - _RECORD_TRAILER.size]
+            (checksum,) = _RECORD_TRAILER.unpack_from(buf, end
+                                                      - _RECORD_TRAILER.size)
+            if checksum != crc32(key + content) & 0xffffffff:
+                return
+            yield (key, start, length, content)
+            start += end - pos
+            pos = end
+        buf = buf[pos:]
+        if not data:
+            return
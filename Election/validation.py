@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+''' validation.py
+
+Validation of submitted ballots. The checks run from the cheapest to the most
+expensive, and a ballot is refused by the first one it fails, so that forged
+ballots cost as little CPU as possible:
+
+    size         length of the ballot, before anything is parsed
+    fingerprint  same ballot already accepted (lookup in the replay index)
+    schema       structure: encoding, number of components, proof fields
+    range        coordinates in [0, p), challenges in [0, n), responses
+                 reduced modulo the group order (response_order in ccs_va.py)
+    g1           c0, c1 and the G1 points of the proofs on the curve
+    g2           c2 and the G2 points of the proofs on the curve over F_p^2,
+                 and in the subgroup of order n
+    commitments  same commitments already accepted (replay index)
+    proofs       CC, OR and sum proofs
+
+The fingerprint and commitments stages only run if the replay index of the
+election is given. The G2 points are only required to be in the subgroup of
+order n if the G2 constants of the election (h, h1) are: otherwise those of
+honest ballots are not either.
+
+validate runs every stage; screen and check_proofs run those before and after
+the commitments lookup, for callers that look it up elsewhere (see
+Election/ingestion.py).
+
+Refusals are counted per stage, so that a flood of forged ballots shows where
+it is stopped (rejections(), and metrics() in the Prometheus text format).
+
+@author: Richard Mathot
+'''
+
+# pylint: disable=E0611
+from hashlib import sha256
+from Crypto.ccs_va import ccsva_extrip_vector, response_order
+from NumberTheory.bn_curve import p_u_, n_u_
+from NumberTheory.elliptic_curves import in_subgroup
+from Election.wire import split_any, decode_group, split_points, \
+    point_coordinates, encode_public_ballot, WireError, MAX_BALLOT_SIZE
+from Util.tracing import span
+
+STAGES = ('size', 'fingerprint', 'schema', 'range', 'g1', 'g2', 'commitments',
+          'proofs')
+
+_rejections = dict((stage, 0) for stage in STAGES)
+
+
+def validate(context, ballot_raw, replay = None):
+    '''Checks a ballot (the content of its file, in either encoding) for the
+    election context. Returns (ballot_fingerprint, public_ballot, stage):
+    public_ballot is the entry to publish on the public board, or None if the
+    ballot is refused by stage (None if the ballot is valid). An oversized
+    ballot is refused before it is hashed: its fingerprint is None.'''
+    (ballot_fingerprint, screened, stage) = screen(context, ballot_raw, replay)
+    if screened is None:
+        return (ballot_fingerprint, None, stage)
+    (vector, split) = screened
+    if replay is not None:
+        with span('accept.commitments'):
+            seen = replay.seen(c2s = split_commitments(split))
+        if seen:
+            return _refuse(ballot_fingerprint, 'commitments')
+    return check_proofs(context, ballot_fingerprint, vector, split)
+
+
+def screen(context, ballot_raw, replay = None):
+    '''Runs the stages that precede the commitments lookup (size to g2).
+    Returns (ballot_fingerprint, screened, stage): screened is (vector,
+    split), the points of split being decoded, or None if the ballot is
+    refused by stage.'''
+    #pylint: disable=R0911
+    if len(ballot_raw) > MAX_BALLOT_SIZE:
+        return _refuse(None, 'size')
+    with span('accept.hash'):
+        ballot_fingerprint = sha256(ballot_raw).hexdigest()
+    if replay is not None:
+        with span('accept.fingerprint'):
+            seen = replay.seen(ballot_fingerprint)
+        if seen:
+            return _refuse(ballot_fingerprint, 'fingerprint')
+
+    with span('accept.schema'):
+        split = _check_schema(context, ballot_raw)
+    if split is None:
+        return _refuse(ballot_fingerprint, 'schema')
+    (vector, split) = split
+
+    with span('accept.range'):
+        in_range = _check_ranges(split, response_order(context.h, context.h1))
+    if not in_range:
+        return _refuse(ballot_fingerprint, 'range')
+
+    with span('accept.g1'):
+        split = _decode_g1(context, split)
+    if split is None:
+        return _refuse(ballot_fingerprint, 'g1')
+
+    with span('accept.g2'):
+        split = _decode_g2(context, split)
+    if split is None:
+        return _refuse(ballot_fingerprint, 'g2')
+    return (ballot_fingerprint, (vector, split), None)
+
+
+def split_commitments(split):
+    '''Commitments c2 of a screened ballot, as looked up in the replay index
+    (compressed JSON points)'''
+    return [c[2].json(compressed = True) for c in split[0]]
+
+
+def check_proofs(context, ballot_fingerprint, vector, split):
+    '''Last stage of validate, for a screened ballot (see screen)'''
+    (cs, sigmaccs, sigmaors, sigmasum) = split
+    with span('accept.proofs'):
+        valid = ccsva_extrip_vector(cs, sigmaccs, sigmaors, sigmasum,
+                                    context.g, context.h, context.g1,
+                                    context.h1, context.tables(),
+                                    vector and context.is_single())
+    if valid != True:
+        return _refuse(ballot_fingerprint, 'proofs')
+    return (ballot_fingerprint,
+            encode_public_ballot(cs, sigmaors, sigmasum, vector), None)
+
+
+def _refuse(ballot_fingerprint, stage):
+    _rejections[stage] += 1
+    return (ballot_fingerprint, None, stage)
+
+
+######################
+# Stages             #
+######################
+
+def _check_schema(context, ballot_raw):
+    '''The ballot split by split_any (see Election/wire.py) if its structure
+    is the one expected by the election, None otherwise'''
+    try:
+        (vector, split) = split_any(ballot_raw)
+    except WireError:
+        return None
+    (points, sigmaccs, sigmaors, sigmasum) = split
+    k = len(context.answers()) if vector else 1
+    if (vector != context.is_vector()) | (len(points) != k) \
+            | (len(sigmaccs) != k) | (len(sigmaors) != k):
+        return None
+    # A single choice ballot must prove that its commitments sum to 1
+    if vector and context.is_single() and (sigmasum is None):
+        return None
+    return (vector, split)
+
+
+def _check_ranges(split, order):
+    '''Coordinates of the (still encoded) points and proof values in range:
+    responses are reduced modulo order'''
+    try:
+        for group in (1, 2):
+            for P in split_points(split, group):
+                if not all(0 <= value < p_u_
+                           for value in point_coordinates(P, group)):
+                    return False
+    except WireError:
+        return False
+    (_, sigmaccs, sigmaors, sigmasum) = split
+    challenges = [sigmaor[2] for sigmaor in sigmaors]
+    responses = [z for sigmacc in sigmaccs for z in sigmacc[3:]] \
+                + [t for sigmaor in sigmaors for t in sigmaor[3:]]
+    if sigmasum is not None:
+        responses.append(sigmasum[1])
+    return all(0 <= e < n_u_ for e in challenges) \
+           and all(0 <= z < order for z in responses)
+
+
+def _decode_g1(context, split):
+    '''split, its G1 points decoded, if they are all points of the curve,
+    None otherwise'''
+    try:
+        return decode_group(split, context, 1)
+    except WireError:
+        return None
+
+
+def _decode_g2(context, split):
+    '''split, its G2 points decoded, if they are all points of the curve
+    over F_p^2 (and of the subgroup of order n if the G2 constants are), None
+    otherwise'''
+    try:
+        split = decode_group(split, context, 2)
+    except WireError:
+        return None
+    if in_subgroup(context.h) and in_subgroup(context.h1) \
+            and not all(in_subgroup(P) for P in split_points(split, 2)):
+        return None
+    return split
+
+
+######################
+# Counters           #
+######################
+
+def rejections():
+    '''{stage: number of ballots refused by the stage} in this process'''
+    return dict(_rejections)
+
+
+def take_rejections():
+    '''rejections(), the counters being reset (for worker processes, whose
+    counters are summed by their parent)'''
+    counts = rejections()
+    for stage in STAGES:
+        _rejections[stage] = 0
+    return counts
+
+
+def metrics(counts = None):
+    '''The counters (by default those of this process) in the Prometheus text
+    format'''
+    if counts is None:
+        counts = _rejections
+    lines = ["# HELP ulysses_rejections_total Ballots refused, by validation"
+             " stage",
+             "# TYPE ulysses_rejections_total counter"]
+    for stage in STAGES:
+        lines.append('ulysses_rejections_total{stage="%s"} %d'
+                     % (stage, counts.get(stage, 0)))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+''' wire.py
+
+Ballot serialisation. Two encodings are accepted for the same ballot content:
+
+- JSON (historical format): decimal strings nested under 'ciphertext' (0/1
+  elections) or 'ciphertexts' (multi-candidate elections) and 'proofs',
+  points being compressed or not (see EllipticCurvePoint.json);
+- a compact versioned binary format, decoded in place from a memoryview:
+
+    magic 'UVB' | version (1 byte) | flags (1 byte) | k (uint16)
+    k times:  c0 (G1 point) | c1 (G1 point) | c2 (G2 point)
+    k times:  sigmacc = d0 (G1 point) | d1 (G1 point) | d2 (G2 point)
+              | zm | zr | zs (scalars)
+    k times:  sigmaor = w0 (G2 point) | w1 (G2 point) | e0 | t0 | t1
+    if flags & HAS_SUM: sigmasum = a (G2 point) | z
+
+  The proofs carry their commitments (see ccsva_extrip_vector), laid out as
+  CC_PROOF, OR_PROOF and SUM_PROOF give.
+
+  Points use the encoding of EllipticCurvePoint.to_bytes (tag byte and
+  fixed-width big-endian coordinates, compressed by default); scalars are
+  length-prefixed (uint16) big-endian integers. Integers are big-endian.
+
+Both decoders return the same decoded ballot (cs, sigmaccs, sigmaors,
+sigmasum), a 0/1 ballot being a vector with a single component. Decoding is
+done in two steps: split_any reads the structure of the ballot and leaves its
+points (those of the ciphertexts and of the proofs) encoded, as JSON objects
+or the bytes of their binary encoding, then decode_points does the curve
+arithmetic (square roots, on-curve tests), one group at a time if need be
+(decode_group). The acceptance checks run in between (see
+Election/validation.py). pack_split hands decoded points over to another
+process without decoding them twice.
+
+@author: Richard Mathot
+'''
+
+import json
+import struct
+from NumberTheory.elliptic_curves import from_bytes, encoded_length
+from NumberTheory.finite_fields import int_to_bytes, bytes_to_int
+from Util.compat import INTEGER_TYPES
+
+MAGIC = b'UVB'
+VERSION = 2
+
+# flags
+VECTOR = 1
+HAS_SUM = 2
+
+# Ballots are a few kB, anything much bigger is refused without parsing
+MAX_BALLOT_SIZE = 1 << 20
+
+# Elements of F_p are encoded on 32 bytes
+_FIELD_LENGTH = 32
+
+# Group of each value of a ciphertext and of the proofs: 1 for a point of G1,
+# 2 for a point of G2, 0 for a scalar
+CIPHERTEXT = (1, 1, 2)
+CC_PROOF = (1, 1, 2, 0, 0, 0)
+OR_PROOF = (2, 2, 0, 0, 0)
+SUM_PROOF = (2, 0)
+
+_HEADER = struct.Struct('>3sBBH')
+_SCALAR_LENGTH = struct.Struct('>H')
+
+
+class WireError(ValueError):
+    '''The ballot is not correctly encoded'''
+    pass
+
+
+def is_binary(ballot_raw):
+    return ballot_raw[:len(MAGIC)] == MAGIC
+
+
+def decode_any(ballot_raw, context):
+    '''Decodes a ballot in either encoding. Returns
+    (vector, (cs, sigmaccs, sigmaors, sigmasum)); raises WireError.'''
+    (vector, split) = split_any(ballot_raw)
+    return (vector, decode_points(split, context))
+
+
+def split_any(ballot_raw):
+    '''Structure of a ballot in either encoding, its points being left
+    encoded. Returns (vector, (points, sigmaccs, sigmaors, sigmasum)), points
+    being a list of (c0, c1, c2); raises WireError.'''
+    if is_binary(ballot_raw):
+        return split_ballot(ballot_raw)
+    if len(ballot_raw) > MAX_BALLOT_SIZE:
+        raise WireError("ballot too large")
+    try:
+        ballot = json.loads(ballot_raw)
+    except ValueError as error:
+        raise WireError(error.__str__())
+    return split_json_ballot(ballot)
+
+
+def decode_points(split, context):
+    '''Decodes the points of a ballot split by split_any. Returns
+    (cs, sigmaccs, sigmaors, sigmasum); raises WireError.'''
+    return decode_group(decode_group(split, context, 1), context, 2)
+
+
+def decode_group(split, context, group):
+    '''split (see split_any), its points of G1 (group = 1) or G2 (group = 2)
+    being decoded; raises WireError'''
+    return _map_split(split, lambda value, value_group:
+                      decode_point(value, context, group)
+                      if value_group == group else value)
+
+
+def split_points(split, group):
+    '''The points of G1 (group = 1) or G2 (group = 2) of a split ballot,
+    ciphertexts then proofs'''
+    return [value for (value, value_group) in _split_values(split)
+            if value_group == group]
+
+
+def _split_values(split):
+    '''(value, group) for each value of a split ballot (see CIPHERTEXT)'''
+    (points, sigmaccs, sigmaors, sigmasum) = split
+    for (values_list, layout) in ((points, CIPHERTEXT), (sigmaccs, CC_PROOF),
+                                  (sigmaors, OR_PROOF),
+                                  ([sigmasum] if sigmasum is not None else [],
+                                   SUM_PROOF)):
+        for values in values_list:
+            for pair in zip(values, layout):
+                yield pair
+
+
+def _map_split(split, function):
+    '''split, each of its points P of group g replaced by function(P, g)'''
+    (points, sigmaccs, sigmaors, sigmasum) = split
+    return ([_map_values(c, CIPHERTEXT, function) for c in points],
+            [_map_values(sigma, CC_PROOF, function) for sigma in sigmaccs],
+            [_map_values(sigma, OR_PROOF, function) for sigma in sigmaors],
+            _map_values(sigmasum, SUM_PROOF, function)
+            if sigmasum is not None else None)
+
+
+def _map_values(values, layout, function):
+    return tuple(function(value, group) if group else value
+                 for (value, group) in zip(values, layout))
+
+
+def decode_point(encoded, context, group = 1):
+    '''Decodes a point left encoded by split_any, of G1 (group = 1) or G2
+    (group = 2). Raises WireError if it is not a point of the curve.'''
+    try:
+        if isinstance(encoded, (bytes, memoryview)):
+            (F, F2, C, C2) = context.curves
+            if group == 1:
+                return from_bytes(encoded, C, F, 1)
+            return from_bytes(encoded, C2, F2, 2)
+        return context.decode_point(encoded, group)
+    except (KeyError, IndexError, TypeError, AttributeError,
+            ValueError) as error:
+        raise WireError(error.__str__())
+
+
+def pack_split(split):
+    '''split, its points decoded (and checked), in a form that can be passed
+    to another process: the points are replaced by their uncompressed
+    encoding (see unpack_split)'''
+    return _map_split(split, lambda P, _: P.to_bytes())
+
+
+def unpack_split(packed, context):
+    '''Inverse of pack_split. The points were checked before they were
+    packed: they are not checked again.'''
+    (F, F2, C, C2) = context.curves
+    return _map_split(packed, lambda data, group:
+                      from_bytes(data, C, F, 1, check = False) if group == 1
+                      else from_bytes(data, C2, F2, 2, check = False))
+
+
+def point_coordinates(encoded, group = 1):
+    '''Integer coordinates of a point left encoded by split_any, without
+    reducing them (x only if the point is compressed, nothing for the point at
+    infinity), for range checks. Raises WireError if the point is
+    malformed.'''
+    try:
+        if isinstance(encoded, (bytes, memoryview)):
+            count = (len(encoded) - 1) // _FIELD_LENGTH
+            return [bytes_to_int(encoded[1 + i * _FIELD_LENGTH:
+                                         1 + (i + 1) * _FIELD_LENGTH])
+                    for i in range(count)]
+        if not encoded:
+            return []
+        if 'x' in encoded:
+            if (len(encoded) != 2) or (encoded['sign'] not in (0, 1)):
+                raise WireError("invalid compressed point")
+            elements = [encoded['x']]
+        else:
+            elements = encoded['coord']
+            if (len(encoded) != 2) \
+                    or (len(elements) != {'affine' : 2,
+                                          'jacobian' : 3}[encoded['repr']]):
+                raise WireError("invalid point")
+        coordinates = []
+        for element in elements:
+            if group == 1:
+                element = [element]
+            elif (not isinstance(element, list)) or (len(element) != 2):
+                raise WireError("invalid element of F_p^2")
+            coordinates.extend(int(value) for value in element)
+        return coordinates
+    except (KeyError, TypeError, AttributeError, ValueError) as error:
+        raise WireError(error.__str__())
+
+
+def encode_ballot(cs, sigmaccs, sigmaors, sigmasum, vector = True,
+                  compressed = True):
+    '''Binary encoding of a ballot. vector is False for 0/1 elections (cs
+    then has a single component).'''
+    flags = (VECTOR if vector else 0) | (HAS_SUM if sigmasum is not None else 0)
+    parts = [_HEADER.pack(MAGIC, VERSION, flags, len(cs))]
+    for (value, group) in _split_values((cs, sigmaccs, sigmaors, sigmasum)):
+        parts.append(value.to_bytes(compressed) if group
+                     else _encode_scalar(value))
+    return b''.join(parts)
+
+
+def _encode_scalar(scalar):
+    if scalar < 0:
+        raise WireError("negative scalar")
+    data = int_to_bytes(scalar, (scalar.bit_length() + 7) // 8)
+    return _SCALAR_LENGTH.pack(len(data)) + data
+
+
+def decode_ballot(data, context):
+    '''Decodes a binary ballot (string or memoryview, nothing is copied
+    before the points and scalars are decoded). Returns
+    (vector, (cs, sigmaccs, sigmaors, sigmasum)); raises WireError.'''
+    (vector, split) = split_ballot(data)
+    return (vector, decode_points(split, context))
+
+
+def split_ballot(data):
+    '''Structure of a binary ballot (see split_any), its points being
+    memoryviews of data'''
+    if len(data) > MAX_BALLOT_SIZE:
+        raise WireError("ballot too large")
+    buf = memoryview(data)
+    if len(buf) < _HEADER.size:
+        raise WireError("truncated ballot")
+    (magic, version, flags, k) = _HEADER.unpack_from(buf, 0)
+    if (magic != MAGIC) | (version != VERSION) | (k == 0):
+        raise WireError("unsupported ballot encoding")
+    offset = _HEADER.size
+    layouts = [CIPHERTEXT] * k + [CC_PROOF] * k + [OR_PROOF] * k \
+              + ([SUM_PROOF] if flags & HAS_SUM else [])
+    try:
+        values = []
+        for layout in layouts:
+            (items, offset) = _split_values_at(buf, offset, layout)
+            values.append(items)
+    except (ValueError, IndexError, struct.error) as error:
+        raise WireError(error.__str__())
+    if offset != len(buf):
+        raise WireError("trailing data")
+    sigmasum = values[3 * k] if flags & HAS_SUM else None
+    return (bool(flags & VECTOR), (values[:k], values[k:2 * k],
+                                   values[2 * k:3 * k], sigmasum))
+
+
+def _split_values_at(buf, offset, layout):
+    '''Values of layout (see CIPHERTEXT) encoded at offset, the points
+    being left encoded'''
+    values = []
+    for group in layout:
+        if group:
+            (value, offset) = _split_point(buf, offset, group)
+        else:
+            (value, offset) = _decode_scalar(buf, offset)
+        values.append(value)
+    return (tuple(values), offset)
+
+
+def _split_point(buf, offset, exp):
+    length = encoded_length(buf[offset:offset + 1], exp, _FIELD_LENGTH)
+    if offset + length > len(buf):
+        raise WireError("truncated point")
+    return (buf[offset:offset + length], offset + length)
+
+
+def _decode_scalar(buf, offset):
+    (length,) = _SCALAR_LENGTH.unpack_from(buf, offset)
+    offset += _SCALAR_LENGTH.size
+    if offset + length > len(buf):
+        raise WireError("truncated scalar")
+    return (bytes_to_int(buf[offset:offset + length]), offset + length)
+
+
+def encode_json_ballot(cs, sigmaccs, sigmaors, sigmasum, vector = True,
+                       compressed = True):
+    '''JSON (historical) encoding of a ballot, as a dict'''
+    sigmaccs = [_json_values(sigma, CC_PROOF, compressed)
+                for sigma in sigmaccs]
+    sigmaors = [_json_values(sigma, OR_PROOF, compressed)
+                for sigma in sigmaors]
+    if not vector:
+        (c0, c1, c2) = cs[0]
+        return {'ciphertext' : {'c0' : c0.json(compressed),
+                                'c1' : c1.json(compressed),
+                                'c2' : c2.json(compressed)},
+                'proofs' :{'sigmacc' : sigmaccs[0],
+                           'sigmaor': sigmaors[0]}}
+    return {'ciphertexts' : [{'c0' : c0.json(compressed),
+                              'c1' : c1.json(compressed),
+                              'c2' : c2.json(compressed)}
+                             for (c0, c1, c2) in cs],
+            'proofs' :{'sigmacc' : sigmaccs,
+                       'sigmaor': sigmaors,
+                       'sigmasum': _json_values(sigmasum, SUM_PROOF,
+                                                compressed)
+                                   if sigmasum is not None else None}}
+
+
+def _json_values(values, layout, compressed):
+    return [value.json(compressed) if group else value
+            for (value, group) in zip(values, layout)]
+
+
+def decode_json_ballot(ballot, context):
+    '''Decodes a JSON ballot (already parsed by json.loads). Returns
+    (vector, (cs, sigmaccs, sigmaors, sigmasum)); raises WireError.'''
+    (vector, split) = split_json_ballot(ballot)
+    return (vector, decode_points(split, context))
+
+
+def split_json_ballot(ballot):
+    '''Structure of a JSON ballot (see split_any), its points being the
+    JSON objects of the ballot'''
+    try:
+        proofs = ballot['proofs']
+        if 'ciphertexts' in ballot:
+            cs_raw = ballot['ciphertexts']
+            sigmaccs = proofs['sigmacc']
+            sigmaors = proofs['sigmaor']
+            sigmasum = proofs['sigmasum']
+            vector = True
+        else:
+            cs_raw = [ballot['ciphertext']]
+            sigmaccs = [proofs['sigmacc']]
+            sigmaors = [proofs['sigmaor']]
+            sigmasum = None
+            vector = False
+        points = [(c_raw['c0'], c_raw['c1'], c_raw['c2']) for c_raw in cs_raw]
+        if not all(_is_values(sigma, CC_PROOF) for sigma in sigmaccs) \
+                or not all(_is_values(sigma, OR_PROOF) for sigma in sigmaors) \
+                or not ((sigmasum is None)
+                        or _is_values(sigmasum, SUM_PROOF)):
+            raise WireError("invalid proof")
+    except (KeyError, IndexError, TypeError, AttributeError,
+            ValueError) as error:
+        raise WireError(error.__str__())
+    return (vector, (points, sigmaccs, sigmaors, sigmasum))
+
+
+def encode_public_ballot(cs, sigmaors, sigmasum, vector = True):
+    '''Public board entry of a ballot (commitments and OR proofs), as a dict'''
+    sigmaors = [_json_values(sigma, OR_PROOF, True) for sigma in sigmaors]
+    if not vector:
+        return {'c2' : cs[0][2].json(compressed = True),
+                'sigmaor': sigmaors[0]}
+    return {'c2' : [c[2].json(compressed = True) for c in cs],
+            'sigmaor': sigmaors,
+            'sigmasum': _json_values(sigmasum, SUM_PROOF, True)
+                        if sigmasum is not None else None}
+
+
+def decode_public_ballot(entry, context):
+    '''Decodes a public board entry (already parsed by json.loads). Returns
+    (c2s, sigmaors, sigmasum); raises WireError.'''
+    try:
+        if context.is_vector():
+            c2s = [context.decode_point(raw, 2) for raw in entry['c2']]
+            sigmaors = entry['sigmaor']
+            sigmasum = entry.get('sigmasum')
+        else:
+            c2s = [context.decode_point(entry['c2'], 2)]
+            sigmaors = [entry['sigmaor']]
+            sigmasum = None
+        if not all(_is_values(sigma, OR_PROOF) for sigma in sigmaors) \
+                or not ((sigmasum is None)
+                        or _is_values(sigmasum, SUM_PROOF)):
+            raise WireError("invalid proof")
+        decode = context.decode_point
+        sigmaors = [_map_values(sigma, OR_PROOF, decode)
+                    for sigma in sigmaors]
+        if sigmasum is not None:
+            sigmasum = _map_values(sigmasum, SUM_PROOF, decode)
+    except (KeyError, IndexError, TypeError, AttributeError,
+            ValueError) as error:
+        raise WireError(error.__str__())
+    return (c2s, sigmaors, sigmasum)
+
+
+def _is_values(sigma, layout):
+    '''Whether sigma is a JSON list of values laid out as layout (see
+    CIPHERTEXT), points being JSON objects'''
+    return isinstance(sigma, list) and len(sigma) == len(layout) \
+           and all(isinstance(value, dict) if group
+                   else isinstance(value, INTEGER_TYPES)
+                   for (value, group) in zip(sigma, layout))
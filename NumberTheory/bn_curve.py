@@ -39,5 +39,5 @@ p2_mod_9 = 7
 
 # (p ^ 12 - 1) / n
 #pylint: disable=C0301
-bigexpo = 50172736614696194842029013982495327617150305463126469945489324904910502953623179429155194892533723959065356225474216039455823941924531193194725925072788255771495643056950662551894965382719813953216900716503706225825175761627199663679673686269439156082711210299213000649887858726242737962787725576594910670522523893552965056174594277757189205323949352093436070083305779741868197679764199317451843542536780196069857117038975469102215679531554354896823936709007965642669044105561510295038111849892650974959784006118719927144138265678003694459178626348555595074989534505268860649700242304143212372992896074244139315826299167900596009407840018341938245974628336569757171626749064876747647496674771999283597837290240782405848937408707658003363707180424341463118465170044600935141812246446178806744784648695851505818269750732394166722028654401148572505840L
+bigexpo = 50172736614696194842029013982495327617150305463126469945489324904910502953623179429155194892533723959065356225474216039455823941924531193194725925072788255771495643056950662551894965382719813953216900716503706225825175761627199663679673686269439156082711210299213000649887858726242737962787725576594910670522523893552965056174594277757189205323949352093436070083305779741868197679764199317451843542536780196069857117038975469102215679531554354896823936709007965642669044105561510295038111849892650974959784006118719927144138265678003694459178626348555595074989534505268860649700242304143212372992896074244139315826299167900596009407840018341938245974628336569757171626749064876747647496674771999283597837290240782405848937408707658003363707180424341463118465170044600935141812246446178806744784648695851505818269750732394166722028654401148572505840
 bigexpo_bit_lenght = 2816
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+''' differential.py
+
+Differential testing of the arithmetic: the optimised implementations
+(backends) are run on the same inputs as the reference classes (PrimeField,
+PrimeField2, PrimeField12, EllipticCurvePoint and tate_pairing), and any
+difference between their results is reported.
+
+A backend is registered with a name and a dictionary {operation: function}
+(register_backend); it may implement any subset of OPERATIONS. Its functions
+take and return canonical values, so that they do not depend on any
+representation:
+
+    F_p       an integer in [0, p)
+    F_p^2     (c, d) for c.i + d
+    F_p^12    a tuple of six F_p^2 values
+    G1, G2    None for the point at infinity, affine (x, y) otherwise
+    scalars   integers
+
+A function may raise an exception: its outcome is then an error, and it must
+be an error for the reference too (whatever the exception). Square roots are
+compared up to their sign.
+
+The inputs of a case only depend on its seed, <seed>:<operation>:<index>, so
+that a divergence can be replayed (run_case). The first indices of an
+operation are its edge cases (zero, one, -1, the point at infinity, P == Q,
+P == -Q, the scalars 0, 1, 2, n - 1, n and n + 1), the next ones are random.
+
+check_bilinearity checks e(aP, Q) == e(P, Q)^a == e(P, aQ) and
+e(P, Q) != 1 with the pairing of a backend (the reference included).
+
+The 'optimised' backend holds the fast paths of this tree: fixed-base
+multiplications (FixedBaseTable), batch normalisation (batch_affine) and
+pairings from precomputed Miller lines. The 'vector' backend, registered if
+NumPy is installed, holds the vector arithmetic (vector_fields.py and the
+vector formulas of elliptic_curves.py), run on VECTOR_THRESHOLD copies of the
+inputs.
+
+@author: Richard Mathot
+'''
+
+import operator
+from NumberTheory.bn_curve import p_u_, n_u_
+from NumberTheory import vector_fields
+from NumberTheory.elliptic_curves import EC, EllipticCurvePoint, \
+    FixedBaseTable, batch_affine, add_points, double_points, VECTOR_THRESHOLD
+from NumberTheory.finite_fields import PF, PF2, PF12, PrimeField, PrimeField2, \
+    PrimeField12
+from NumberTheory.pairings import tate_pairing, miller_lines, pairing_lines
+from Random.random_sources import seed, randint
+
+F = PF(p_u_)
+F2 = PF2(p_u_)
+F12 = PF12(p_u_)
+G1 = EC(F, n_u_)
+G2 = EC(F2, n_u_)
+
+# Operations and the kind of their arguments: unary (x), binary (x, y),
+# scalar (x, k) or pairing (P, Q)
+OPERATIONS = [('fp.add', 'binary'), ('fp.sub', 'binary'), ('fp.mul', 'binary'),
+              ('fp.neg', 'unary'), ('fp.inverse', 'unary'),
+              ('fp.sqrt', 'unary'), ('fp.pow', 'scalar'),
+              ('fp2.add', 'binary'), ('fp2.sub', 'binary'),
+              ('fp2.mul', 'binary'), ('fp2.neg', 'unary'),
+              ('fp2.inverse', 'unary'), ('fp2.sqrt', 'unary'),
+              ('fp2.pow', 'scalar'),
+              ('fp12.add', 'binary'), ('fp12.mul', 'binary'),
+              ('fp12.pow', 'scalar'),
+              ('g1.add', 'binary'), ('g1.neg', 'unary'),
+              ('g1.double', 'unary'), ('g1.mul', 'scalar'),
+              ('g2.add', 'binary'), ('g2.neg', 'unary'),
+              ('g2.double', 'unary'), ('g2.mul', 'scalar'),
+              ('pairing', 'pairing')]
+
+# Registered backends: {name: {operation: function}}
+BACKENDS = {}
+
+# Outcome of a function that raised an exception
+ERROR = 'error'
+
+_ZERO2 = (0, 0)
+_ONE2 = (0, 1)
+_SPECIAL = {'fp' : [0, 1, p_u_ - 1],
+            'fp2' : [_ZERO2, _ONE2, (0, p_u_ - 1)],
+            'fp12' : [(_ZERO2,) * 6, (_ONE2,) + (_ZERO2,) * 5],
+            'g1' : [None],
+            'g2' : [None]}
+_SCALARS = (0, 1, 2, n_u_ - 1, n_u_, n_u_ + 1)
+
+
+def register_backend(name, operations):
+    '''Registers a backend: operations is a dictionary {operation: function}
+    (see the module documentation)'''
+    unknown = set(operations) - set(dict(OPERATIONS))
+    if unknown:
+        raise ValueError("unknown operations: " + ", ".join(sorted(unknown)))
+    BACKENDS[name] = operations
+
+
+######################
+# Canonical values   #
+######################
+
+def canonical(x):
+    '''Canonical value of a field element or a point (see the module
+    documentation)'''
+    if x is None:
+        return None
+    if isinstance(x, PrimeField):
+        return x.value
+    if isinstance(x, PrimeField2):
+        return tuple(x.value)
+    if isinstance(x, PrimeField12):
+        return tuple(canonical(coefficient) for coefficient in x.value)
+    if isinstance(x, EllipticCurvePoint):
+        if x.infinite:
+            return None
+        R = x.affine()
+        return (canonical(R.coordinates[0]), canonical(R.coordinates[1]))
+    raise TypeError("no canonical value for " + type(x).__name__)
+
+
+def fp(value):
+    return F(value)
+
+
+def fp2(value):
+    return F2(list(value))
+
+
+def fp12(value):
+    return F12([fp2(coefficient) for coefficient in value])
+
+
+def g1(value):
+    if value is None:
+        return G1(None, infinite = True)
+    return G1([fp(value[0]), fp(value[1])])
+
+
+def g2(value):
+    if value is None:
+        return G2(None, infinite = True)
+    return G2([fp2(value[0]), fp2(value[1])])
+
+
+def negate(family, value):
+    '''Opposite of a canonical value of a field or group'''
+    if value is None:
+        return None
+    if family == 'fp':
+        return (-value) % p_u_
+    if family == 'fp2':
+        return ((-value[0]) % p_u_, (-value[1]) % p_u_)
+    if family in ('g1', 'g2'):
+        return (value[0], negate('fp' if family == 'g1' else 'fp2', value[1]))
+    raise ValueError("no opposite in " + family)
+
+
+def _random(family):
+    if family == 'fp':
+        return randint(p_u_)
+    if family == 'fp2':
+        return (randint(p_u_), randint(p_u_))
+    if family == 'fp12':
+        return tuple(_random('fp2') for _ in range(6))
+    if family == 'g1':
+        return canonical(G1(None, random = True))
+    return canonical(G2(None, random = True))
+
+
+######################
+# Cases              #
+######################
+
+def family_of(operation):
+    '''Field or group of the arguments of an operation'''
+    return operation.split('.')[0]
+
+
+def _edge_cases(operation):
+    '''Edge cases of an operation, as functions of random values (x, y, k)'''
+    family = family_of(operation)
+    kind = dict(OPERATIONS)[operation]
+    if kind == 'pairing':
+        return [lambda x, y, k: (None, y), lambda x, y, k: (x, None)]
+    special = _SPECIAL[family]
+    if kind == 'unary':
+        return [lambda x, y, k, s = s: (s,) for s in special]
+    if kind == 'scalar':
+        return [lambda x, y, k, m = m: (x, m) for m in _SCALARS] \
+               + [lambda x, y, k, s = s: (s, k) for s in special]
+    cases = []
+    for s in special:
+        cases.append(lambda x, y, k, s = s: (s, x))
+        cases.append(lambda x, y, k, s = s: (x, s))
+    cases.append(lambda x, y, k: (x, x))
+    if family != 'fp12': # F_p^12 has no opposite in this tree
+        cases.append(lambda x, y, k: (x, negate(family, x)))
+    return cases
+
+
+def edge_count(operation):
+    return len(_edge_cases(operation))
+
+
+def case_seed(seed_value, operation, index):
+    return seed_value + (':' + operation + ':' + index.__str__()).encode()
+
+
+def case_inputs(operation, index, seed_value):
+    '''Inputs of a case (a tuple of canonical values)'''
+    family = family_of(operation)
+    kind = dict(OPERATIONS)[operation]
+    seed(case_seed(seed_value, operation, index))
+    try:
+        if kind == 'pairing':
+            (x, y) = (_random('g1'), _random('g2'))
+        else:
+            (x, y) = (_random(family), _random(family))
+        k = randint(n_u_)
+    finally:
+        seed(None)
+    edges = _edge_cases(operation)
+    if index < len(edges):
+        return edges[index](x, y, k)
+    return {'unary' : (x,), 'binary' : (x, y), 'scalar' : (x, k),
+            'pairing' : (x, y)}[kind]
+
+
+def outcome(function, operation, inputs):
+    '''Result of function on inputs, ERROR if it raised, and the set of both
+    roots for square roots'''
+    try:
+        result = function(*inputs)
+    except Exception: #pylint: disable=W0703
+        return ERROR
+    if operation.endswith('.sqrt') and (result is not None):
+        return frozenset([result, negate(family_of(operation), result)])
+    return result
+
+
+def run_case(case, backends = None):
+    '''Replays a case given its seed (<seed>:<operation>:<index>).
+    Returns (operation, inputs, {backend: outcome}), the reference included.'''
+    (seed_value, operation, index) = case.rsplit(b':', 2)
+    operation = operation.decode()
+    inputs = case_inputs(operation, int(index), seed_value)
+    outcomes = {}
+    for name in ['reference'] + sorted(backends or BACKENDS):
+        if operation in BACKENDS[name]:
+            outcomes[name] = outcome(BACKENDS[name][operation], operation,
+                                     inputs)
+    return (operation, inputs, outcomes)
+
+
+def run(backends = None, operations = None, cases = 8, pairing_cases = 1,
+        seed_value = b'differential', report = None):
+    #pylint: disable=R0913
+    '''Compares backends (all the registered ones but the reference by
+    default) with the reference, on the operations whose name starts with one
+    of operations (all of them by default): every edge case and cases random
+    cases per operation (pairing_cases for the pairing, much slower).
+    report(operation, count, divergences) is called after each operation.
+    Returns the divergences: (backend, operation, case seed, inputs, expected
+    outcome, outcome).'''
+    if backends is None:
+        backends = [name for name in sorted(BACKENDS) if name != 'reference']
+    reference = BACKENDS['reference']
+    divergences = []
+    for (operation, kind) in OPERATIONS:
+        if (operations is not None) \
+                and not any(operation.startswith(prefix)
+                            for prefix in operations):
+            continue
+        compared = [name for name in backends if operation in BACKENDS[name]]
+        if not compared:
+            continue
+        found = []
+        count = edge_count(operation) \
+                + (pairing_cases if kind == 'pairing' else cases)
+        for index in range(count):
+            inputs = case_inputs(operation, index, seed_value)
+            expected = outcome(reference[operation], operation, inputs)
+            for name in compared:
+                got = outcome(BACKENDS[name][operation], operation, inputs)
+                if got != expected:
+                    found.append((name, operation,
+                                  case_seed(seed_value, operation, index),
+                                  inputs, expected, got))
+        divergences.extend(found)
+        if report is not None:
+            report(operation, count, found)
+    return divergences
+
+
+def check_bilinearity(name, seed_value = b'bilinearity'):
+    '''Checks the pairing of a backend on random points P, Q and scalar a:
+    e(aP, Q) == e(P, Q)^a, e(P, aQ) == e(P, Q)^a and e(P, Q) != 1.
+    Returns the list of the properties that do not hold.'''
+    pairing = BACKENDS[name]['pairing']
+    seed(seed_value)
+    try:
+        (P, Q, a) = (G1(None, random = True), G2(None, random = True),
+                     randint(n_u_))
+    finally:
+        seed(None)
+    e = pairing(canonical(P), canonical(Q))
+    ea = canonical(fp12(e) ** a)
+    failed = []
+    if pairing(canonical(P * a), canonical(Q)) != ea:
+        failed.append("e(aP, Q) == e(P, Q)^a")
+    if pairing(canonical(P), canonical(Q * a)) != ea:
+        failed.append("e(P, aQ) == e(P, Q)^a")
+    if e == _SPECIAL['fp12'][1]:
+        failed.append("e(P, Q) != 1")
+    return failed
+
+
+######################
+# Backends           #
+######################
+
+def _wrap(function, inputs):
+    '''Operation on canonical values from a function on reference objects,
+    inputs converting its arguments'''
+    def wrapper(*args):
+        return canonical(function(*[convert(arg) for (convert, arg)
+                                    in zip(inputs, args)]))
+    return wrapper
+
+
+def _reference_backend():
+    operations = {'pairing' : _wrap(tate_pairing, (g1, g2))}
+    for (family, convert) in (('fp', fp), ('fp2', fp2), ('fp12', fp12)):
+        operations[family + '.add'] = _wrap(operator.add, (convert, convert))
+        operations[family + '.mul'] = _wrap(operator.mul, (convert, convert))
+        operations[family + '.pow'] = _wrap(operator.pow, (convert, int))
+        if family != 'fp12':
+            operations[family + '.sub'] = _wrap(operator.sub,
+                                                (convert, convert))
+            operations[family + '.neg'] = _wrap(operator.neg, (convert,))
+            operations[family + '.inverse'] = _wrap(operator.invert,
+                                                    (convert,))
+            operations[family + '.sqrt'] = _wrap(lambda x: x.sqrt(),
+                                                 (convert,))
+    for (family, convert) in (('g1', g1), ('g2', g2)):
+        operations[family + '.add'] = _wrap(operator.add, (convert, convert))
+        operations[family + '.neg'] = _wrap(
+            lambda P, convert = convert: convert(None) - P, (convert,))
+        operations[family + '.double'] = _wrap(lambda P: P.__double__(),
+                                               (convert,))
+        operations[family + '.mul'] = _wrap(operator.mul, (convert, int))
+    return operations
+
+
+def _optimised_backend():
+    tables = {}
+    lines = {}
+
+    def fixed_base(convert):
+        def mul(P, k):
+            if P not in tables:
+                tables[P] = FixedBaseTable(convert(P))
+            return canonical(tables[P] * k)
+        return mul
+
+    def normalised(function, convert):
+        def wrapper(*points):
+            R = function(*[convert(P).jacobian() for P in points])
+            return canonical(batch_affine([R])[0])
+        return wrapper
+
+    def pairing(P, Q):
+        if P not in lines:
+            lines[P] = miller_lines(g1(P))
+        return canonical(pairing_lines(lines[P], g2(Q)))
+
+    operations = {'pairing' : pairing}
+    for (family, convert) in (('g1', g1), ('g2', g2)):
+        operations[family + '.mul'] = fixed_base(convert)
+        operations[family + '.add'] = normalised(operator.add, convert)
+        operations[family + '.double'] = normalised(lambda P: P.__double__(),
+                                                    convert)
+    return operations
+
+
+def _vector_backend():
+    def agreed(results):
+        '''Canonical value of the lanes, which must all be the same'''
+        values = [canonical(result) for result in results]
+        if any(value != values[0] for value in values):
+            raise ArithmeticError("the lanes disagree")
+        return values[0]
+
+    def field(function, convert):
+        def wrapper(*args):
+            vectors = [vector_fields.vector([convert(arg)] * VECTOR_THRESHOLD)
+                       for arg in args]
+            return agreed(function(*vectors).elements())
+        return wrapper
+
+    def points(function, convert):
+        def wrapper(*args):
+            return agreed(function(*[[convert(P)] * VECTOR_THRESHOLD
+                                     for P in args]))
+        return wrapper
+
+    operations = {}
+    for (family, convert) in (('fp', fp), ('fp2', fp2)):
+        operations[family + '.add'] = field(operator.add, convert)
+        operations[family + '.sub'] = field(operator.sub, convert)
+        operations[family + '.mul'] = field(operator.mul, convert)
+        operations[family + '.neg'] = field(operator.neg, convert)
+    for (family, convert) in (('g1', g1), ('g2', g2)):
+        operations[family + '.add'] = points(add_points, convert)
+        operations[family + '.double'] = points(double_points, convert)
+    return operations
+
+
+register_backend('reference', _reference_backend())
+register_backend('optimised', _optimised_backend())
+if vector_fields.available():
+    register_backend('vector', _vector_backend())
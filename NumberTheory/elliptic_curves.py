@@ -6,6 +6,14 @@ This module contains the implementation of an elliptic curve over a field
 @author: Richard Mathot
 '''
 
+from NumberTheory import vector_fields
+from NumberTheory.finite_fields import bytes_to_int
+
+# Minimum number of lanes for the vector formulas (see add_points): each
+# vector operation has a fixed cost, that fewer lanes do not amortise
+VECTOR_THRESHOLD = 256
+
+
 def EC(field, order):
     '''Wrapper to generate elements of the same curve, over the same field'''
     def __generator(coordinates, representation = 'affine', infinite = False,
@@ -88,8 +96,9 @@ class EllipticCurvePoint(object):
                                          representation = 'affine',
                                          infinite = True)
             else:
-                invZ2 = ~(self.coordinates[2] ** 2)
-                invZ3 = ~(self.coordinates[2] ** 3)
+                invZ = ~self.coordinates[2]
+                invZ2 = invZ ** 2
+                invZ3 = invZ2 * invZ
                 x = self.coordinates[0] * invZ2
                 y = self.coordinates[1] * invZ3
                 return EllipticCurvePoint(self.field, self.order, [x, y],
@@ -144,12 +153,23 @@ class EllipticCurvePoint(object):
                                           representation = 'jacobian'))
 
     def __sub__(self, Q):
+        if Q.infinite:
+            return self.jacobian()
         R = Q.affine()
         minusR = EllipticCurvePoint(self.field, self.order,
                                      [R.coordinates[0], -R.coordinates[1]],
                                      representation = 'affine')
         return self +minusR
 
+    def __neg__(self):
+        '''Opposite of the point, in the same representation'''
+        if self.infinite:
+            return self.copy()
+        coordinates = list(self.coordinates)
+        coordinates[1] = -coordinates[1]
+        return EllipticCurvePoint(self.field, self.order, coordinates,
+                                  representation = self.representation)
+
     def __double__(self):
         #pylint: disable=R0914
         '''
@@ -194,7 +214,11 @@ class EllipticCurvePoint(object):
         This algorithm exploits doubling in order to perform point 
         multiplication ("double-and-add" algorithm).
         '''
-        assert k > 0
+        assert k >= 0
+        if k == 0:
+            return EllipticCurvePoint(self.field, self.order, None,
+                                      representation = 'jacobian',
+                                      infinite = True)
         if k == 1:
             return self.jacobian()
         elif k == 2:
@@ -208,17 +232,21 @@ class EllipticCurvePoint(object):
                 if n % 2:
                     R = R + P
                 P = P.__double__()
-                n = n / 2
+                n = n // 2
             return R
 
     def __eq__(self, b):
         ''''''
         if self.infinite | b.infinite:
             return self.infinite & b.infinite
-        P = self.affine()
-        Q2 = b.affine()
-        return (P.coordinates[0] == Q2.coordinates[0]) \
-               & (P.coordinates[1] == Q2.coordinates[1])
+        P = self.jacobian()
+        Q2 = b.jacobian()
+        # (X1 / Z1^2, Y1 / Z1^3) == (X2 / Z2^2, Y2 / Z2^3) without inversion
+        Z1Z1 = P.coordinates[2] ** 2
+        Z2Z2 = Q2.coordinates[2] ** 2
+        return (P.coordinates[0] * Z2Z2 == Q2.coordinates[0] * Z1Z1) \
+               & (P.coordinates[1] * Z2Z2 * Q2.coordinates[2] \
+                  == Q2.coordinates[1] * Z1Z1 * P.coordinates[2])
 
     def is_infinite(self):
         return self.infinite
@@ -230,13 +258,13 @@ class EllipticCurvePoint(object):
 
             if y.exp == 1: #Prime field F_p
                 a = y ** 2 - self.field(3)
-                x = a ** ((2 * y.order + 1) / 9)
+                x = a ** ((2 * y.order + 1) // 9)
                 check = (y ** 2 == (x ** 3 + self.field(3)))
                 if check:
                     break
             if y.exp == 2: #Extension field F_p^2
                 a = y ** 2 - self.field([0, 3])
-                x = a ** (((y.order ** 2) + 2) / 9)
+                x = a ** (((y.order ** 2) + 2) // 9)
                 check = (y ** 2 == (x ** 3 + self.field([0, 3])))
                 if check:
                     break
@@ -249,11 +277,421 @@ class EllipticCurvePoint(object):
         else:
             return self.coordinates.__repr__() \
 
-    def json(self):
-        ''''''
+    def json(self, compressed = False):
+        '''JSON-serialisable form of the point: {} for the point at infinity,
+        its affine coordinates, or only x and the sign of y if compressed
+        (see from_json)'''
         if self.infinite:
             return {}
         else:
             R = self.affine()
+            if compressed:
+                return {'x' : R.coordinates[0].json(),
+                        'sign' : R.coordinates[1].sign()}
             return {'repr' : R.representation,
                     'coord' : [R.coordinates[0].json(), R.coordinates[1].json()]}
+
+    def to_bytes(self, compressed = False):
+        '''Canonical binary encoding: a tag byte followed by fixed-length 
+        big-endian affine coordinates.
+        - 0x00: point at infinity (no coordinates)
+        - 0x04: x || y
+        - 0x02 / 0x03: x only, the tag giving the sign of y (compressed)'''
+        if self.infinite:
+            return b'\x00'
+        R = self.affine()
+        if compressed:
+            tag = b'\x03' if R.coordinates[1].sign() else b'\x02'
+            return tag + R.coordinates[0].to_bytes()
+        return b'\x04' + R.coordinates[0].to_bytes() \
+               + R.coordinates[1].to_bytes()
+
+    def is_on_curve(self):
+        '''Checks y^2 = x^3 + b'''
+        if self.infinite:
+            return True
+        R = self.affine()
+        (x, y) = R.coordinates
+        return y ** 2 == x ** 3 + _curve_b(x)
+
+
+def in_subgroup(P):
+    '''Checks that P is in the subgroup of order n of its curve.
+    E(F_p) has prime order n. The curve over F_p^2 is E itself (not a twist),
+    of order n * (p + 1 + t), n not dividing p + 1 + t: its subgroup of order
+    n is E(F_p), i.e. the points fixed by the Frobenius endomorphism, whose
+    coordinates are in F_p. No scalar multiplication is needed.'''
+    if P.infinite or (P.coordinates[0].exp == 1):
+        return True
+    R = P.affine()
+    return all(coordinate.value[0] == 0 for coordinate in R.coordinates)
+
+
+def _curve_b(x):
+    '''The constant b = 3 of the curve, in the field of x'''
+    if x.exp == 1: #Prime field F_p
+        return x.__class__(3, x.order)
+    elif x.exp == 2: #Extension field F_p^2
+        return x.__class__([0, 3], x.order)
+    raise Exception("not implemented")
+
+
+def encoded_length(data, exp, length = 32):
+    '''Length of the encoded point at the start of data (see to_bytes), for a
+    curve over F_p^exp, elements of F_p being encoded on length bytes'''
+    tag = bytearray(data[0:1])[0]
+    if tag == 0:
+        return 1
+    if tag == 4:
+        return 1 + 2 * exp * length
+    if tag in (2, 3):
+        return 1 + exp * length
+    raise ValueError("invalid point encoding")
+
+
+def from_bytes(data, curve, field, exp, length = 32, check = True):
+    '''Inverse of EllipticCurvePoint.to_bytes() (data may be a memoryview),
+    for a curve over F_p^exp, elements of F_p being encoded on length bytes.
+    Raises ValueError if data is not the encoding of a point of the curve.
+    check = False skips the on-curve test of uncompressed points (only for
+    trusted data, such as our own caches).'''
+    if len(data) != encoded_length(data, exp, length):
+        raise ValueError("invalid point encoding length")
+    tag = bytearray(data[0:1])[0]
+    if tag == 0:
+        return curve(None, infinite = True)
+    x = _field_from_bytes(data[1:1 + exp * length], field, exp, length)
+    if tag == 4:
+        y = _field_from_bytes(data[1 + exp * length:], field, exp, length)
+        P = curve([x, y], representation = 'affine')
+        if check and not P.is_on_curve():
+            raise ValueError("point is not on the curve")
+        return P
+    return decompress(x, tag - 2, curve)
+
+
+def decompress(x, sign, curve):
+    '''The point (x, y) of the curve, y being the square root of x^3 + b with
+    the given sign. Raises ValueError if x is not the abscissa of a point.'''
+    y = (x ** 3 + _curve_b(x)).sqrt()
+    if y is None:
+        raise ValueError("point is not on the curve")
+    if y.sign() != sign:
+        y = -y
+    return curve([x, y], representation = 'affine')
+
+
+def _field_from_bytes(data, field, exp, length):
+    values = [bytes_to_int(data[i * length:(i + 1) * length])
+              for i in range(exp)]
+    element = field(values[0]) if exp == 1 else field(values)
+    # Non-canonical encodings (coordinates >= p) are refused
+    if (element.value if exp == 2 else [element.value]) != values:
+        raise ValueError("invalid field element")
+    return element
+
+
+def batch_affine(points):
+    '''Converts a list of points to affine coordinates with a single field 
+    inversion per field (Montgomery's simultaneous inversion trick).
+    Returns a new list, in the same order.'''
+    result = list(points)
+    todo = [i for i, P in enumerate(result)
+            if (not P.infinite) and P.representation == 'jacobian']
+    # One batch per field (G1 and G2 points can be mixed)
+    batches = {}
+    for i in todo:
+        batches.setdefault(result[i].coordinates[2].exp, []).append(i)
+    for batch in batches.values():
+        prefix = []
+        acc = None
+        for i in batch:
+            Z = result[i].coordinates[2]
+            acc = Z if acc is None else acc * Z
+            prefix.append(acc)
+        inv = ~acc
+        for k in range(len(batch) - 1, -1, -1):
+            P = result[batch[k]]
+            invZ = inv * prefix[k - 1] if k > 0 else inv
+            inv = inv * P.coordinates[2]
+            invZ2 = invZ ** 2
+            result[batch[k]] = EllipticCurvePoint(
+                P.field, P.order, [P.coordinates[0] * invZ2,
+                                   P.coordinates[1] * invZ2 * invZ],
+                representation = 'affine')
+    return result
+
+
+def from_json(raw, curve, field):
+    '''Inverse of EllipticCurvePoint.json() (compressed or not)
+    curve and field are the generators returned by EC and PF/PF2.
+    Raises ValueError if raw does not describe a point of the curve.'''
+    if not raw:
+        return curve(None, infinite = True)
+    if 'x' in raw:
+        if raw['sign'] not in (0, 1):
+            raise ValueError("invalid sign")
+        return decompress(_field_from_json(raw['x'], field), raw['sign'],
+                          curve)
+    if raw['repr'] not in ('affine', 'jacobian'):
+        raise ValueError("invalid representation")
+    P = curve([_field_from_json(coordinate, field)
+               for coordinate in raw['coord']],
+              representation = raw['repr'])
+    if not P.is_on_curve():
+        raise ValueError("point is not on the curve")
+    return P
+
+
+def matches_json(P, raw, curve, field):
+    '''True if P is the point described by raw (see from_json), without
+    decompressing raw (no square root)'''
+    if (not raw) | P.is_infinite():
+        return (not raw) & P.is_infinite()
+    if not P.is_on_curve():
+        return False
+    if 'x' in raw:
+        R = P.affine()
+        return (R.coordinates[0] == _field_from_json(raw['x'], field)) \
+               & (R.coordinates[1].sign() == raw['sign'])
+    return P == curve([_field_from_json(coordinate, field)
+                       for coordinate in raw['coord']],
+                      representation = raw['repr'])
+
+
+def _field_from_json(raw, field):
+    if isinstance(raw, list):
+        return field([int(i) for i in raw])
+    return field(int(raw))
+
+
+class FixedBaseTable(object):
+    '''Precomputed multiples of a fixed point P, for fast scalar 
+    multiplications P * k (fixed-base windowing method).
+
+    For each window i, the table holds P * (d * 2^(w * i)) for every digit d
+    in [1, 2^w - 1], so that a multiplication costs at most one addition per
+    window of w bits and no doubling.'''
+
+    point = None
+    window = None
+    bits = None
+    table = None
+
+    def __init__(self, P, window = 4, bits = 256, table = None):
+        '''table may be given if it was computed before (see rows())'''
+        self.point = P.affine()
+        self.window = window
+        self.bits = bits
+        if table is not None:
+            self.table = table
+            return
+        self.table = []
+        base = P.jacobian()
+        for _ in range(self.rows()):
+            row = [base]
+            for _ in range(2 ** window - 2):
+                row.append(row[-1] + base)
+            self.table.append(batch_affine(row))
+            base = row[-1] + base
+
+    def rows(self):
+        '''Number of windows of the table'''
+        return (self.bits + self.window - 1) // self.window
+
+    def __mul__(self, k):
+        '''Scalar multiplication P * k'''
+        assert k >= 0
+        if k >> self.bits:
+            return self.point * k
+        R = self.point * 0
+        mask = 2 ** self.window - 1
+        i = 0
+        while k > 0:
+            digit = k & mask
+            if digit:
+                R = R + self.table[i][digit - 1]
+            k >>= self.window
+            i += 1
+        return R
+
+
+def multi_scalar(points, scalars, window = 4):
+    '''Sum of the P * k for (P, k) in zip(points, scalars), points of the
+    same curve, points not empty (Straus' method). The doublings are shared by
+    all the points: each point only costs its table (2^w - 2 additions) and
+    one addition per window of w bits of its scalar. Sums that cancel are
+    flagged as the point at infinity at every step: __add__ returns a point of
+    Jacobian coordinate Z = 0 for P + (-P), which would absorb the rest of the
+    sum.'''
+    pairs = [(P, k) for (P, k) in zip(points, scalars)
+             if (k > 0) and not P.infinite]
+    if not pairs:
+        return points[0] * 0
+    tables = []
+    for (P, _) in pairs:
+        row = [P.jacobian()]
+        for _ in range(2 ** window - 2):
+            row.append(add_checked(row[-1], P))
+        tables.append(row)
+    bits = max(k.bit_length() for (_, k) in pairs)
+    mask = 2 ** window - 1
+    R = pairs[0][0] * 0
+    for shift in range(((bits + window - 1) // window - 1) * window, -1,
+                       -window):
+        for _ in range(window):
+            R = R.__double__()
+        for (row, (_, k)) in zip(tables, pairs):
+            digit = (k >> shift) & mask
+            if digit:
+                R = add_checked(R, row[digit - 1])
+    return R
+
+
+def add_checked(P, Q):
+    '''P + Q, the point at infinity being flagged as such if P = -Q (see
+    multi_scalar)'''
+    R = P + Q
+    if (not R.infinite) and (R.representation == 'jacobian') \
+            and R.coordinates[2].is_zero():
+        return EllipticCurvePoint(P.field, P.order, None,
+                                  representation = 'jacobian', infinite = True)
+    return R
+
+
+######################
+# Vector formulas    #
+######################
+# The Jacobian formulas of __add__ and __double__ on many points at once: the
+# coordinates of the points are held in vectors of field elements (see
+# NumberTheory/vector_fields.py), and every field operation is done on all
+# the lanes at once. They need NumPy; without it, and for fewer than
+# VECTOR_THRESHOLD points, the points are added one by one.
+
+def _vectorised(count):
+    return vector_fields.available() & (count >= VECTOR_THRESHOLD)
+
+
+def _to_vectors(points):
+    '''Jacobian coordinates (X, Y, Z) of (finite) points, as vectors'''
+    points = [P.jacobian() for P in points]
+    return tuple(vector_fields.vector([P.coordinates[i] for P in points])
+                 for i in range(3))
+
+
+def _from_vectors(P, vectors):
+    '''Points (on the curve of P) of Jacobian coordinates vectors'''
+    coordinates = zip(*[V.elements() for V in vectors])
+    return [EllipticCurvePoint(P.field, P.order, list(XYZ),
+                               representation = 'jacobian')
+            for XYZ in coordinates]
+
+
+def _take(vectors, indices):
+    return tuple(V.take(indices) for V in vectors)
+
+
+def _vector_add(P, Q):
+    '''add-2007-bl (see __add__) on every lane. Returns (R, H): lanes where
+    H is zero (P = Q or P = -Q) are not valid.'''
+    (X1, Y1, Z1) = P
+    (X2, Y2, Z2) = Q
+    Z1Z1 = Z1 * Z1
+    Z2Z2 = Z2 * Z2
+    U1 = X1 * Z2Z2
+    U2 = X2 * Z1Z1
+    S1 = Y1 * Z2 * Z2Z2
+    S2 = Y2 * Z1 * Z1Z1
+    H = U2 - U1
+    I = (H + H) * (H + H)
+    J = H * I
+    r = (S2 - S1) + (S2 - S1)
+    V = U1 * I
+    X3 = r * r - J - (V + V)
+    S1J = S1 * J
+    Y3 = r * (V - X3) - (S1J + S1J)
+    Z3 = ((Z1 + Z2) * (Z1 + Z2) - Z1Z1 - Z2Z2) * H
+    return ((X3, Y3, Z3), H)
+
+
+def _vector_double(P):
+    '''dbl-2009-l (see __double__) on every lane'''
+    (X1, Y1, Z1) = P
+    A = X1 * X1
+    B = Y1 * Y1
+    C = B * B
+    D = (X1 + B) * (X1 + B) - A - C
+    D = D + D
+    E = A.scalmul(3)
+    X3 = E * E - (D + D)
+    Y3 = E * (D - X3) - C.scalmul(8)
+    Z3 = Y1 * Z1
+    return (X3, Y3, Z3 + Z3)
+
+
+def add_points(Ps, Qs):
+    '''[P + Q for (P, Q) in zip(Ps, Qs)] (points of the same curve), in
+    Jacobian coordinates, with the vector formulas'''
+    assert len(Ps) == len(Qs)
+    result = [None] * len(Ps)
+    lanes = [i for i in range(len(Ps))
+             if not (Ps[i].infinite | Qs[i].infinite)]
+    if _vectorised(len(lanes)):
+        (R, H) = _vector_add(_to_vectors([Ps[i] for i in lanes]),
+                             _to_vectors([Qs[i] for i in lanes]))
+        for (i, S) in zip(lanes, _from_vectors(Ps[lanes[0]], R)):
+            result[i] = S
+        # P = Q or P = -Q: __add__ doubles or gives infinity
+        for k in H.is_zero().nonzero()[0]:
+            result[lanes[k]] = None
+    return [S if S is not None else P + Q
+            for (S, P, Q) in zip(result, Ps, Qs)]
+
+
+def double_points(Ps):
+    '''[P.__double__() for P in Ps] (points of the same curve), with the
+    vector formulas'''
+    lanes = [i for i in range(len(Ps)) if not Ps[i].infinite]
+    if not _vectorised(len(lanes)):
+        return [P.__double__() for P in Ps]
+    result = [P.jacobian() for P in Ps]
+    vectors = _to_vectors([Ps[i] for i in lanes])
+    doubled = _from_vectors(Ps[lanes[0]], _vector_double(vectors))
+    for (i, R) in zip(lanes, doubled):
+        result[i] = R
+    return result
+
+
+def sum_points(points):
+    '''Sum of a non-empty list of points of the same curve, in Jacobian
+    coordinates. The points are added pairwise, round after round, all the
+    pairs of a round at once with the vector formulas; the rounds with fewer
+    than VECTOR_THRESHOLD pairs (or all of them, without NumPy) are done
+    point by point.'''
+    rest = [P for P in points if P.infinite]
+    finite = [P for P in points if not P.infinite]
+    if _vectorised(len(finite) // 2):
+        vectors = _to_vectors(finite)
+        count = len(finite)
+        while _vectorised(count // 2):
+            half = count // 2
+            if count % 2:
+                rest.extend(_from_vectors(finite[0], _take(vectors,
+                                                           [count - 1])))
+            (R, H) = _vector_add(_take(vectors, slice(0, half)),
+                                 _take(vectors, slice(half, 2 * half)))
+            if H.is_zero().any():
+                # P = Q or P = -Q in a lane: this round is done by __add__
+                left = _from_vectors(finite[0], _take(vectors,
+                                                      slice(0, half)))
+                right = _from_vectors(finite[0], _take(vectors,
+                                                       slice(half, 2 * half)))
+                finite = [P + Q for (P, Q) in zip(left, right)]
+                break
+            (vectors, count) = (R, half)
+        else:
+            finite = _from_vectors(finite[0], vectors)
+    total = None
+    for P in finite + rest:
+        total = P.jacobian() if total is None else total + P
+    return total
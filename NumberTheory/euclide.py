@@ -13,21 +13,38 @@ Commons Attribution-ShareAlike 3.0 License
 '''
 
 
-def modinv(a, m):
-    '''Inverts integer a wrt modulus m, such as a^(-1) = x % m.
-    This algorithm returns x, also known as modular inverse of a.'''
-    g, x, _ = egcd_iter(a, m)
-    if g != 1:
-        return None  # modular inverse does not exist
-    else:
-        return x % m
+def _has_native_inverse():
+    '''pow(a, -1, m) computes modular inverses since Python 3.8'''
+    try:
+        return pow(2, -1, 3) == 2
+    except (TypeError, ValueError):
+        return False
+
+
+if _has_native_inverse():
+    def modinv(a, m):
+        '''Inverts integer a wrt modulus m, such as a^(-1) = x % m.
+        This algorithm returns x, also known as modular inverse of a.'''
+        try:
+            return pow(a, -1, m)
+        except ValueError:
+            return None  # modular inverse does not exist
+else:
+    def modinv(a, m):
+        '''Inverts integer a wrt modulus m, such as a^(-1) = x % m.
+        This algorithm returns x, also known as modular inverse of a.'''
+        g, x, _ = egcd_iter(a, m)
+        if g != 1:
+            return None  # modular inverse does not exist
+        else:
+            return x % m
 
 
 def egcd_iter(a, b):
     '''Computes GCD between a and b, in an iterative way.'''
     x, y, u, v = 0, 1, 1, 0
     while a != 0:
-        q, r = b / a, b % a
+        q, r = b // a, b % a
         m, n = x - u * q, y - v * q
         b, a, x, y, u, v = a, r, u, v, m, n
     return b, x, y
@@ -7,9 +7,48 @@ extended fields (F_p, F_{p^2} and parts of F_{p^12}).
 @author: Richard Mathot
 '''
 
-from itertools import izip
+from binascii import hexlify, unhexlify
 from NumberTheory.euclide import modinv
-from Random.random_sources import get_256_random_bits_os
+from Random.random_sources import randint
+from Util.compat import izip
+
+def byte_length(order):
+    '''Number of bytes needed to encode any element of F_order'''
+    return (order.bit_length() + 7) // 8
+
+
+if hasattr(int, 'from_bytes'): # Python 3: native conversions
+    def int_to_bytes(value, length):
+        '''Big-endian encoding of a non-negative integer on exactly length
+        bytes'''
+        return value.to_bytes(length, 'big')
+
+    def bytes_to_int(data):
+        '''Decodes a big-endian integer (data may be a string or a
+        memoryview)'''
+        return int.from_bytes(data, 'big')
+else:
+    def int_to_bytes(value, length):
+        '''Big-endian encoding of a non-negative integer on exactly length
+        bytes'''
+        return unhexlify('%0*x' % (2 * length, value))
+
+    def bytes_to_int(data):
+        '''Decodes a big-endian integer (data may be a string or a
+        memoryview)'''
+        if len(data) == 0:
+            return 0
+        return int(hexlify(data), 16)
+
+
+def _sqrt_mod(value, p):
+    '''Square root of value modulo p = 3 mod 4, None if there is none'''
+    assert p % 4 == 3
+    root = pow(value, (p + 1) // 4, p)
+    if root * root % p != value % p:
+        return None
+    return root
+
 
 ####################
 # Prime Fields F_p #
@@ -40,7 +79,7 @@ class PrimeField(object):
         '''
         assert order > 1
         if rand:
-            self.value = get_256_random_bits_os() % order
+            self.value = randint(order)
         else:
             self.value = value % order
         self.order = order
@@ -81,7 +120,7 @@ class PrimeField(object):
         @note: This method caches modular inverse, so modifying value of X 
         directly with 'X.value = ...' can lead to incoherent inversion.
         '''
-        if self.inverse == None: # caching inverse value (speed optimization)
+        if self.inverse is None: # caching inverse value (speed optimization)
             self.inverse = PrimeField(modinv(self.value, self.order),
                                       self.order)
         return self.inverse
@@ -93,6 +132,9 @@ class PrimeField(object):
         assert self.order == Q.order
         return self.value == Q.value
 
+    def __int__(self):
+        return self.value
+
     def __long__(self):
         return long(self.value)
 
@@ -111,6 +153,22 @@ class PrimeField(object):
     def json(self):
         return self.value.__str__()
 
+    def to_bytes(self):
+        '''Fixed-length big-endian encoding (length of the order in bytes)'''
+        return int_to_bytes(self.value, byte_length(self.order))
+
+    def sqrt(self):
+        '''A square root of self, None if self is not a quadratic residue
+        @note: only implemented for order = 3 mod 4 (as for BN curves)'''
+        root = _sqrt_mod(self.value, self.order)
+        if root is None:
+            return None
+        return PrimeField(root, self.order)
+
+    def sign(self):
+        '''Parity of the element (used to pick a square root)'''
+        return self.value & 1
+
 ##########################
 # Extension Fields F_p^2 #
 ##########################
@@ -140,8 +198,7 @@ class PrimeField2(object):
         '''
         assert order > 1
         if rand:
-            self.value = [get_256_random_bits_os() % order,
-                          get_256_random_bits_os() % order]
+            self.value = [randint(order), randint(order)]
         else:
             self.value = [value[0] % order, value[1] % order]
         self.order = order
@@ -210,7 +267,7 @@ class PrimeField2(object):
                 if (n % 2):
                     ret = ret * base
                 base = base * base
-                n = n / 2
+                n = n // 2
             return ret
 
     def __neg__(self):
@@ -232,6 +289,48 @@ class PrimeField2(object):
     def json(self):
         return [self.value[0].__str__(), self.value[1].__str__()]
 
+    def to_bytes(self):
+        '''Fixed-length big-endian encoding of both coefficients (cx + d is
+        encoded as c || d)'''
+        length = byte_length(self.order)
+        return int_to_bytes(self.value[0], length) \
+               + int_to_bytes(self.value[1], length)
+
+    def conjugate(self):
+        '''Frobenius map: (cx + d) ^ p = -cx + d'''
+        return PrimeField2([-self.value[0], self.value[1]], self.order)
+
+    def sqrt(self):
+        '''A square root of self, None if self is not a quadratic residue
+        @note: only implemented for order = 3 mod 4, in which case x^2 + 1 is
+        irreducible. Complex method (Scott, "Implementing cryptographic
+        pairings", 2007): with a = d + c.i, a square root x0 + x1.i is given by
+        x0^2 = (d +- sqrt(c^2 + d^2)) / 2 and x1 = c / (2 x0), so it only
+        costs square roots and one inversion in F_p.'''
+        (c, d) = self.value
+        p = self.order
+        if c == 0: # self is in F_p: its root is either in F_p or in F_p.i
+            root = _sqrt_mod(d, p)
+            if root is not None:
+                return PrimeField2([0, root], p)
+            return PrimeField2([_sqrt_mod(-d % p, p), 0], p)
+        alpha = _sqrt_mod((c * c + d * d) % p, p)
+        if alpha is None:
+            return None
+        half = (p + 1) // 2
+        for delta in ((d + alpha) * half % p, (d - alpha) * half % p):
+            x0 = _sqrt_mod(delta, p)
+            if (x0 is not None) and (x0 != 0):
+                return PrimeField2([c * modinv(2 * x0, p), x0], p)
+        return None
+
+    def sign(self):
+        '''Parity of the element (used to pick a square root): parity of d, or
+        of c if d == 0'''
+        if self.value[1] != 0:
+            return self.value[1] & 1
+        return self.value[0] & 1
+
 #===============================================================================
 #    def divide_v(self):
 #        qre = (self.value[1] + self.value[0]) % self.order
@@ -397,7 +496,7 @@ class PrimeField12(object):
                 if (n % 2):
                     ret = ret * base
                 base = base * base
-                n = n / 2
+                n = n // 2
             return ret
 
     #def __invert__(self):
@@ -433,3 +532,7 @@ class PrimeField12(object):
                 (self.value[4].is_zero()) & \
                 (self.value[5].is_zero())
 
+
+    def to_bytes(self):
+        '''Fixed-length big-endian encoding of the 6 coefficients'''
+        return b''.join(coefficient.to_bytes() for coefficient in self.value)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+''' opcount.py
+
+Operation counting, to know how many field and curve operations a call costs
+(wall time does not tell which optimisation matters):
+
+    with count_operations() as counts:
+        ccsva_enc(1, g, g1, h, h1)
+    print(counts.report())
+
+Inside the block, the arithmetic methods of PrimeField, PrimeField2,
+PrimeField12, EllipticCurvePoint and FixedBaseTable, and a few functions
+(modular inversion, batch normalisation, pairing), are replaced by counting
+wrappers; the originals are restored when the last block exits. Outside of
+any block nothing is patched: counting costs nothing when it is not used.
+
+Operations are named <type>.<operation>: F_p, F_p2, F_p12, G1 and G2 (points
+over F_p and F_p^2) and G (the point at infinity). Nested operations are all
+counted (a G1 scalar multiplication also counts its additions, doublings and
+their F_p operations). Integer arithmetic on raw coordinates (Miller loop
+lines, see pairings.py) is not counted.
+
+@author: Richard Mathot
+'''
+
+import sys
+from collections import Counter
+from NumberTheory import elliptic_curves, euclide, pairings
+from NumberTheory.elliptic_curves import EllipticCurvePoint, FixedBaseTable
+from NumberTheory.finite_fields import PrimeField, PrimeField2, PrimeField12
+
+# Counters of the open count_operations blocks
+_active = []
+# Original methods and functions while counting: (owner, attribute, original)
+_patched = []
+
+_FIELD_OPERATIONS = (('__add__', 'add'), ('__sub__', 'sub'), ('__mul__', 'mul'),
+                     ('__pow__', 'pow'), ('__invert__', 'inverse'),
+                     ('scalmul', 'scalmul'), ('sqrt', 'sqrt'))
+_POINT_OPERATIONS = (('__add__', 'add'), ('__sub__', 'sub'),
+                     ('__double__', 'double'), ('__mul__', 'mul'),
+                     ('affine', 'affine'), ('jacobian', 'jacobian'))
+_FUNCTIONS = ((euclide, 'modinv', 'modinv'),
+              (elliptic_curves, 'batch_affine', 'batch_affine'),
+              (pairings, 'tate_pairing', 'pairing'),
+              (pairings, 'miller_lines', 'pairing.miller_lines'),
+              (pairings, 'pairing_lines', 'pairing.pairing_lines'))
+
+
+class OperationCounts(Counter):
+    '''Number of calls per operation'''
+
+    def report(self):
+        '''The counts as text, one operation per line'''
+        width = max([len(name) for name in self] + [0])
+        return "\n".join(name.ljust(width) + " " + self[name].__str__().rjust(10)
+                         for name in sorted(self))
+
+
+class count_operations(object):
+    #pylint: disable=C0103
+    '''Context manager counting the operations run inside it (see the module
+    documentation). Blocks may be nested; each gets its own counts.'''
+
+    def __init__(self):
+        self.counts = OperationCounts()
+
+    def __enter__(self):
+        if not _active:
+            _patch()
+        _active.append(self.counts)
+        return self.counts
+
+    def __exit__(self, *exc_info):
+        _active.remove(self.counts)
+        if not _active:
+            _unpatch()
+        return False
+
+
+def _point_group(point):
+    if point.infinite:
+        return "G"
+    return "G" + point.coordinates[0].exp.__str__()
+
+
+def _table_group(table):
+    return _point_group(table.table[0][0]) if table.table else "G"
+
+
+def _count(name):
+    for counts in _active:
+        counts[name] += 1
+
+
+def _method_wrapper(method, prefix, operation):
+    if callable(prefix): # the name depends on the instance
+        def wrapper(self, *args, **kwargs):
+            _count(prefix(self) + "." + operation)
+            return method(self, *args, **kwargs)
+    else:
+        name = prefix + "." + operation
+
+        def wrapper(self, *args, **kwargs):
+            _count(name)
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _function_wrapper(function, name):
+    def wrapper(*args, **kwargs):
+        _count(name)
+        return function(*args, **kwargs)
+    return wrapper
+
+
+def _patch():
+    targets = [(PrimeField, "F_p", _FIELD_OPERATIONS),
+               (PrimeField2, "F_p2", _FIELD_OPERATIONS),
+               (PrimeField12, "F_p12", _FIELD_OPERATIONS),
+               (EllipticCurvePoint, _point_group, _POINT_OPERATIONS),
+               (FixedBaseTable, _table_group, (('__mul__', 'mul_fixed_base'),))]
+    for (cls, prefix, operations) in targets:
+        for (attribute, operation) in operations:
+            if attribute in cls.__dict__:
+                method = cls.__dict__[attribute]
+                _patched.append((cls, attribute, method))
+                setattr(cls, attribute,
+                        _method_wrapper(method, prefix, operation))
+    # Functions are also replaced where they were imported (from ... import)
+    for (module, attribute, name) in _FUNCTIONS:
+        function = getattr(module, attribute)
+        wrapper = _function_wrapper(function, name)
+        for owner in list(sys.modules.values()):
+            if (owner is not None) \
+                    and (getattr(owner, attribute, None) is function):
+                _patched.append((owner, attribute, function))
+                setattr(owner, attribute, wrapper)
+
+
+def _unpatch():
+    while _patched:
+        (owner, attribute, original) = _patched.pop()
+        setattr(owner, attribute, original)
@@ -1,11 +1,28 @@
 # -*- coding: utf-8 -*-
 '''
 Pairings implementations
+
+Pairings of the same points, and the powers of the same element of G_T, are
+memoised in size-bounded LRU caches (see cached_pairing and power_table):
+repeated decryptions and openings for an election then skip the pairings
+and the F_p^12 multiplications they already did. Points are keyed by their
+canonical (compressed) encodings, elements of G_T by their compressed forms
+(see NumberTheory/torus.py), which are also how cached pairing results are
+kept (decompressed on each hit). cache_stats() gives the hits and misses of
+both caches.
 '''
 
+from collections import OrderedDict
 from NumberTheory.bn_curve import n_u_, p_u_, number_of_bits, bigexpo
 from NumberTheory.finite_fields import PF12, PF2
-import time
+from NumberTheory.torus import compress, decompress
+from Util.tracing import span
+
+# Number of pairing results, and of power tables, kept in the caches
+PAIRING_CACHE_SIZE = 256
+POWER_CACHE_SIZE = 4
+# Number of powers of an element kept in its power table
+MAX_POWERS = 1 << 12
 
 def pairing(P, Q):
     '''Wrapper function that allows the developper to select a pairing without 
@@ -31,45 +48,79 @@ def tate_pairing(P2, Q2):
         good choice!).
     '''
 
-    F12 = PF12(p_u_)
-    one = F12(None, one = True)
+    if((P2.is_infinite() == False) & (Q2.is_infinite() == False)):
 
-    P = P2.affine()
-    Q = Q2.affine()
+        # Timed as the 'pairing' stage when tracing is enabled
+        with span('pairing'):
+            pairing_output = pairing_lines(miller_lines(P2), Q2)
+
+        return pairing_output
+
+    else:
+        raise Exception("You cannot compute a pairing on point at infinity")
 
-    t0 = time.time()
 
-    if((P.is_infinite() == False) & (Q.is_infinite() == False)):
+def miller_lines(P2):
+    '''Coefficients of the lines of the Miller loop of tate_pairing(P2, .),
+    in the order they are used (see line_coefficients). They only depend on
+    P2, so they can be computed once for a fixed first argument and used with
+    pairing_lines for any second argument.'''
+    P = P2.affine()
+    if P.is_infinite():
+        raise Exception("You cannot compute a pairing on point at infinity")
 
-        cord_len = number_of_bits
-        cord_bits = bin(n_u_)[2:]
-        V = P
-        r = one
+    cord_len = number_of_bits
+    cord_bits = bin(n_u_)[2:]
+    V = P
+    lines = []
 
-        i = cord_len - 2
+    i = cord_len - 2
 
-        while(i >= 0): # Miller loop
+    while(i >= 0): # Miller loop
 
-            r = (r ** 2) * gl(V, V, Q)
-            V = V * 2
+        lines.append(line_coefficients(V, V))
+        V = V * 2
 
-            if(cord_bits[-(i + 1)] == '1'):
+        if(cord_bits[-(i + 1)] == '1'):
 
-                r = r * gl(V, P, Q)
-                V = V + P
+            lines.append(line_coefficients(V, P))
+            V = V + P
 
-            i = i - 1
+        i = i - 1
 
-        pairing_output = r ** bigexpo # Final exponentiation
+    return lines
 
-        t1 = time.time()
-        print("DEBUG - Time for pairing:" + (t1 - t0).__str__())
 
-        return pairing_output
+def pairing_lines(lines, Q2):
+    '''tate_pairing(P2, Q2), lines being miller_lines(P2)'''
+    F12 = PF12(p_u_)
+    one = F12(None, one = True)
 
-    else:
+    Q = Q2.affine()
+    if Q.is_infinite():
         raise Exception("You cannot compute a pairing on point at infinity")
 
+    cord_len = number_of_bits
+    cord_bits = bin(n_u_)[2:]
+    r = one
+    k = 0
+
+    i = cord_len - 2
+
+    while(i >= 0): # Miller loop
+
+        r = (r ** 2) * line_value(lines[k], Q)
+        k = k + 1
+
+        if(cord_bits[-(i + 1)] == '1'):
+
+            r = r * line_value(lines[k], Q)
+            k = k + 1
+
+        i = i - 1
+
+    return r ** bigexpo # Final exponentiation
+
 
 def gl(A, B, C):
     '''Auxiliary function for tate_pairing
@@ -77,17 +128,27 @@ def gl(A, B, C):
        V, P and Q have to be expressed in projective coordinates'''
 
     F12 = PF12(p_u_)
-    F2 = PF2(p_u_)
     one = F12(None, one = True)
-    w = [None, None, None, None, None, None]
 
-    V = A.jacobian()
-    P = B.jacobian()
     Q = C.jacobian()
 
-    if (V.is_infinite() | P.is_infinite() | Q.is_infinite()):
+    if Q.is_infinite():
         return one
 
+    return line_value(line_coefficients(A, B), Q)
+
+
+def line_coefficients(A, B):
+    '''The part of gl(A, B, Q) that does not depend on Q: the integers
+    (w0, a, b) such that gl(A, B, Q) = w0 + a.Qx.X^2 + b.Qy.X^3 (None if the
+    line is the constant 1)'''
+
+    V = A.jacobian()
+    P = B.jacobian()
+
+    if (V.is_infinite() | P.is_infinite()):
+        return None
+
     Vz3 = V.coordinates[2] ** 3
 
     if V == P:
@@ -98,13 +159,142 @@ def gl(A, B, C):
         n = P.coordinates[1] * Vz3 - V.coordinates[1]
         d = P.coordinates[0] * Vz3 - (V.coordinates[0] * V.coordinates[2])
 
+    return (((d * V.coordinates[1])
+             - (n * V.coordinates[0] * V.coordinates[2])).value,
+            (n * Vz3).value,
+            (Vz3.scalmul((p_u_ - d.value))).value)
+
+
+def line_value(coefficients, Q):
+    '''Evaluates a line (see line_coefficients) at Q (with z = 1)'''
+
+    F12 = PF12(p_u_)
+    F2 = PF2(p_u_)
+
+    if coefficients is None:
+        return F12(None, one = True)
+
+    (w0, a, b) = coefficients
+    w = [None, None, None, None, None, None]
+
     w[1] = w[4] = w[5] = F2([0, 0])
-    w[0] = F2([0, ((d * V.coordinates[1]) - (n * V.coordinates[0] * V.coordinates[2])).value])
-    w[2] = Q.coordinates[0].scalmul((n * Vz3).value)
-    w[3] = Q.coordinates[1].scalmul((Vz3.scalmul((p_u_ - d.value))).value)
+    w[0] = F2([0, w0])
+    w[2] = Q.coordinates[0].scalmul(a)
+    w[3] = Q.coordinates[1].scalmul(b)
 
     return F12(w)
 
 
 #def optimal_ate_pairing(P, Q):
 #    pass                        #Not Yet Implemented
+
+
+######################
+# Memoisation        #
+######################
+
+class LRUCache(object):
+    '''Mapping of at most capacity entries, the least recently used one being
+    evicted first, which counts its hits and misses'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        '''The value of key (None if it is not in the cache)'''
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            del self._entries[key]
+        elif len(self._entries) >= self.capacity:
+            self._entries.popitem(last = False)
+        self._entries[key] = value
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'hits' : self.hits, 'misses' : self.misses,
+                'size' : len(self._entries), 'capacity' : self.capacity}
+
+
+_pairings = LRUCache(PAIRING_CACHE_SIZE)
+_powers = LRUCache(POWER_CACHE_SIZE)
+
+
+def cached_pairing(P, Q):
+    '''pairing(P, Q), computed once for the last PAIRING_CACHE_SIZE pairs of
+    points'''
+    key = P.to_bytes(compressed = True) + Q.to_bytes(compressed = True)
+    compressed = _pairings.get(key)
+    if compressed is None:
+        result = pairing(P, Q)
+        _pairings.put(key, compress(result))
+        return result
+    return decompress(compressed)
+
+
+class PowerTable(object):
+    '''Powers basis^0, ..., basis^(size - 1) of an element of G_T computed so
+    far, by compressed form'''
+
+    basis = None
+    last = None
+    size = None
+    exponents = None
+
+    def __init__(self, basis):
+        self.basis = basis
+        self.last = PF12(p_u_)(None, one = True)
+        self.size = 1
+        self.exponents = {compress(self.last) : 0}
+
+    def log(self, x, bound = None):
+        '''z such that x = basis^z, the table being extended up to
+        basis^bound (at most MAX_POWERS powers) to find it. Returns None if x
+        is not one of the powers of the table.'''
+        key = compress(x)
+        limit = MAX_POWERS if bound is None else min(bound + 1, MAX_POWERS)
+        while (key not in self.exponents) and (self.size < limit):
+            self.last = self.last * self.basis
+            self.exponents[compress(self.last)] = self.size
+            self.size += 1
+        return self.exponents.get(key)
+
+
+def power_table(basis):
+    '''The PowerTable of basis, shared by the last POWER_CACHE_SIZE elements
+    it was asked for'''
+    key = compress(basis)
+    table = _powers.get(key)
+    if table is None:
+        table = PowerTable(basis)
+        _powers.put(key, table)
+    return table
+
+
+def cache_stats():
+    '''{'pairings': ..., 'powers': ...}, each {'hits', 'misses', 'size',
+    'capacity'}'''
+    return {'pairings' : _pairings.stats(), 'powers' : _powers.stats()}
+
+
+def clear_caches():
+    '''Empties both caches (benchmarks of the uncached operations)'''
+    _pairings.clear()
+    _powers.clear()
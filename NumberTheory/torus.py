@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+''' torus.py
+
+Compressed representation of the elements of G_T (pairing outputs), in the
+algebraic torus T_2(F_p^6).
+
+F_p^12 = F_p^2[X] / (X^6 - xi) (see PrimeField12) is a quadratic extension
+of F_p^6 = F_p^2[V] / (V^3 - xi), V = X^2: an element is g = g0 + g1.X, g0
+and g1 in F_p^6 (its coefficients of even and odd degrees). Pairing outputs
+are in the cyclotomic subgroup, whose elements have norm g0^2 - V.g1^2 = 1,
+and are then given by the single element of F_p^6
+
+    c = (1 + g0) / g1,      g = (c + X) / (c - X)
+
+c = 0 (which would be -1, not in G_T) stands for 1. The compressed form is c
+as 6 fixed-width big-endian integers (COMPRESSED_LENGTH bytes, half of
+PrimeField12.to_bytes); it is canonical, so that compressed elements can be
+compared and used as keys without being decompressed.
+
+@author: Richard Mathot
+'''
+
+from NumberTheory.bn_curve import p_u_
+from NumberTheory.finite_fields import PF2, PF12, bytes_to_int
+
+# Elements of F_p are encoded on 32 bytes
+COMPRESSED_LENGTH = 6 * 32
+
+# xi = X^6 in F_p^2, by order of F_p (see _xi)
+_XIS = {}
+
+
+def compress(element):
+    '''Compressed form of an element of the cyclotomic subgroup of F_p^12.
+    Raises ValueError if element is not in it.'''
+    F2 = PF2(element.order)
+    xi = _xi(element.order)
+    a = element.value
+    (g0, g1) = ([a[0], a[2], a[4]], [a[1], a[3], a[5]])
+    one = _one(F2)
+    if _f6_sub(_f6_square(g0, xi), _f6_times_v(_f6_square(g1, xi), xi)) \
+            != one:
+        raise ValueError("not an element of the cyclotomic subgroup")
+    if all(coefficient.is_zero() for coefficient in g1):
+        return b'\x00' * COMPRESSED_LENGTH # 1 (g0 = -1 is not in G_T)
+    c = _f6_mul(_f6_add(one, g0), _f6_inverse(g1, xi), xi)
+    return b''.join(coefficient.to_bytes() for coefficient in c)
+
+
+def decompress(data, order = p_u_):
+    '''Inverse of compress (data may be a memoryview). Raises ValueError if
+    data is not a compressed form.'''
+    if len(data) != COMPRESSED_LENGTH:
+        raise ValueError("invalid compressed element length")
+    values = [bytes_to_int(data[32 * i:32 * (i + 1)]) for i in range(6)]
+    if not all(value < order for value in values):
+        raise ValueError("invalid compressed element")
+    F2 = PF2(order)
+    if not any(values):
+        return PF12(order)(None, one = True)
+    xi = _xi(order)
+    c = [F2(values[2 * i:2 * i + 2]) for i in range(3)]
+    # g = (c + X)^2 / (c^2 - V) = (c^2 + V + 2c.X) / (c^2 - V)
+    c2 = _f6_square(c, xi)
+    v = [F2([0, 0]), F2([0, 1]), F2([0, 0])]
+    inverse = _f6_inverse(_f6_sub(c2, v), xi)
+    g0 = _f6_mul(_f6_add(c2, v), inverse, xi)
+    g1 = _f6_mul([coefficient.scalmul(2) for coefficient in c], inverse, xi)
+    return PF12(order)([g0[0], g1[0], g0[1], g1[1], g0[2], g1[2]])
+
+
+######################
+# F_p^6 arithmetic   #
+######################
+# Elements of F_p^6 are lists [a0, a1, a2] of elements of F_p^2, for
+# a0 + a1.V + a2.V^2 (V^3 = xi).
+
+def _xi(order):
+    '''X^6, as computed by PrimeField12 (which defines the tower)'''
+    if order not in _XIS:
+        F2 = PF2(order)
+        (zero, one) = (F2([0, 0]), F2([0, 1]))
+        X3 = PF12(order)([zero, zero, zero, one, zero, zero])
+        _XIS[order] = (X3 * X3).value[0].value
+    return PF2(order)(_XIS[order])
+
+
+def _one(F2):
+    return [F2([0, 1]), F2([0, 0]), F2([0, 0])]
+
+
+def _f6_add(a, b):
+    return [a[0] + b[0], a[1] + b[1], a[2] + b[2]]
+
+
+def _f6_sub(a, b):
+    return [a[0] - b[0], a[1] - b[1], a[2] - b[2]]
+
+
+def _f6_mul(a, b, xi):
+    return [a[0] * b[0] + xi * (a[1] * b[2] + a[2] * b[1]),
+            a[0] * b[1] + a[1] * b[0] + xi * (a[2] * b[2]),
+            a[0] * b[2] + a[1] * b[1] + a[2] * b[0]]
+
+
+def _f6_square(a, xi):
+    return _f6_mul(a, a, xi)
+
+
+def _f6_times_v(a, xi):
+    return [xi * a[2], a[0], a[1]]
+
+
+def _f6_inverse(a, xi):
+    '''Inverse of a (non-zero) element of F_p^6'''
+    A = a[0] * a[0] - xi * (a[1] * a[2])
+    B = xi * (a[2] * a[2]) - a[0] * a[1]
+    C = a[1] * a[1] - a[0] * a[2]
+    F = a[0] * A + xi * (a[2] * B + a[1] * C)
+    invF = ~F
+    return [A * invF, B * invF, C * invF]
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+''' vector_fields.py
+
+Vectors of elements of F_p and F_p^2, for bulk operations (thousands of
+independent field operations, e.g. the additions of points of a tally, see
+sum_points in elliptic_curves.py). A VectorField holds N elements of F_p as
+a NumPy array of LIMBS rows of N 32-bit limbs (row i holding limb i of every
+element, so that each step works on contiguous memory), in uint64 words: the
+64-bit limb products are split in halves, whose sums do not overflow. The
+elements are in Montgomery form (x.R mod p, R = 2^(32.LIMBS)).
+Multiplications (Montgomery), additions and subtractions are done on all the
+elements at once, one limb at a time; a VectorField2 is a pair of
+VectorField (c, d) for c.i + d.
+
+    X = vector([F(1), F(2), F(3)])
+    Y = X * X + X
+    Y.elements()      # [F(2), F(6), F(12)]
+
+NumPy is an optional dependency: available() tells if it is installed, and
+the callers fall back to the scalar classes of finite_fields.py otherwise.
+
+@author: Richard Mathot
+'''
+
+from NumberTheory.finite_fields import PF, PF2, PrimeField, int_to_bytes, \
+    bytes_to_int
+
+try:
+    import numpy
+except ImportError: # optional dependency
+    numpy = None
+
+LIMB_BITS = 32
+_MASK = (1 << LIMB_BITS) - 1
+
+# Montgomery constants, by order (see _constants)
+_CONSTANTS = {}
+
+
+def available():
+    '''True if NumPy is installed (vector arithmetic can be used)'''
+    return numpy is not None
+
+
+class _Montgomery(object):
+    '''Montgomery constants of a prime order p'''
+
+    def __init__(self, order):
+        self.order = order
+        self.limbs = (order.bit_length() + LIMB_BITS - 1) // LIMB_BITS
+        self.r = (1 << (LIMB_BITS * self.limbs)) % order
+        self.r_inverse = pow(1 << (LIMB_BITS * self.limbs), order - 2, order)
+        # -p^-1 mod 2^LIMB_BITS
+        self.n0 = (-pow(order, (1 << (LIMB_BITS - 1)) - 1,
+                        1 << LIMB_BITS)) & _MASK
+        self.p = _to_limbs([order], self)
+
+
+def _constants(order):
+    if numpy is None:
+        raise ImportError("vector arithmetic needs NumPy")
+    if order not in _CONSTANTS:
+        _CONSTANTS[order] = _Montgomery(order)
+    return _CONSTANTS[order]
+
+
+def _to_limbs(values, constants):
+    '''(limbs, N) array of the integers values (in [0, 2^(32.limbs)))'''
+    length = 4 * constants.limbs
+    data = b''.join(int_to_bytes(value, length) for value in values)
+    limbs = numpy.frombuffer(data, dtype = '>u4').reshape(len(values),
+                                                           constants.limbs)
+    return numpy.ascontiguousarray(limbs[:, ::-1].T, dtype = numpy.uint64)
+
+
+def _from_limbs(limbs, constants):
+    '''Inverse of _to_limbs'''
+    length = 4 * constants.limbs
+    data = limbs[::-1].T.astype('>u4').tobytes()
+    return [bytes_to_int(data[i:i + length])
+            for i in range(0, len(data), length)]
+
+
+def vector(elements):
+    '''VectorField (or VectorField2) of a non-empty list of PrimeField (or
+    PrimeField2) elements of the same field'''
+    if isinstance(elements[0], PrimeField):
+        return VectorField.from_integers([x.value for x in elements],
+                                         elements[0].order)
+    return VectorField2(
+        VectorField.from_integers([x.value[0] for x in elements],
+                                  elements[0].order),
+        VectorField.from_integers([x.value[1] for x in elements],
+                                  elements[0].order))
+
+
+class VectorField(object):
+    '''N elements of F_p, in Montgomery form'''
+
+    limbs = None
+    constants = None
+    exp = 1
+
+    def __init__(self, limbs, constants):
+        self.limbs = limbs
+        self.constants = constants
+
+    @staticmethod
+    def from_integers(values, order):
+        '''Vector of the (reduced) integers values, elements of F_order'''
+        constants = _constants(order)
+        return VectorField(_to_limbs([value * constants.r % order
+                                      for value in values], constants),
+                           constants)
+
+    def integers(self):
+        '''Values of the elements, as integers in [0, p)'''
+        constants = self.constants
+        return [value * constants.r_inverse % constants.order
+                for value in _from_limbs(self.limbs, constants)]
+
+    def elements(self):
+        '''Elements of the vector, as PrimeField elements'''
+        F = PF(self.constants.order)
+        return [F(value) for value in self.integers()]
+
+    def __len__(self):
+        return self.limbs.shape[1]
+
+    def __add__(self, b):
+        return VectorField(_reduce(_carry(self.limbs + b.limbs, 1),
+                                   self.constants), self.constants)
+
+    def __sub__(self, b):
+        return VectorField(_subtract(self.limbs, b.limbs, self.constants),
+                           self.constants)
+
+    def __neg__(self):
+        return VectorField(_subtract(numpy.zeros_like(self.limbs), self.limbs,
+                                     self.constants), self.constants)
+
+    def __mul__(self, b):
+        '''Montgomery multiplication of all the elements at once'''
+        return VectorField(_montgomery(self.limbs, b.limbs, self.constants),
+                           self.constants)
+
+    def scalmul(self, k):
+        '''Multiplication of every element by a small integer k > 0'''
+        result = self
+        for bit in bin(k)[3:]:
+            result = result + result
+            if bit == '1':
+                result = result + self
+        return result
+
+    def is_zero(self):
+        '''Boolean array: which elements are zero'''
+        return ~self.limbs.any(axis = 0)
+
+    def take(self, indices):
+        '''The sub-vector of the elements at indices'''
+        return VectorField(self.limbs[:, indices], self.constants)
+
+
+class VectorField2(object):
+    '''N elements c.i + d of F_p^2 (i^2 = -1), as a pair of VectorField'''
+
+    c = None
+    d = None
+    exp = 2
+
+    def __init__(self, c, d):
+        self.c = c
+        self.d = d
+
+    def elements(self):
+        '''Elements of the vector, as PrimeField2 elements'''
+        F2 = PF2(self.c.constants.order)
+        return [F2([c, d]) for (c, d) in zip(self.c.integers(),
+                                             self.d.integers())]
+
+    def __len__(self):
+        return len(self.c)
+
+    def __add__(self, b):
+        return VectorField2(self.c + b.c, self.d + b.d)
+
+    def __sub__(self, b):
+        return VectorField2(self.c - b.c, self.d - b.d)
+
+    def __neg__(self):
+        return VectorField2(-self.c, -self.d)
+
+    def __mul__(self, b):
+        '''(a.i + b)(c.i + d) = (ad + bc).i + (bd - ac), with 3
+        multiplications (Karatsuba)'''
+        ac = self.c * b.c
+        bd = self.d * b.d
+        return VectorField2((self.c + self.d) * (b.c + b.d) - ac - bd,
+                            bd - ac)
+
+    def scalmul(self, k):
+        return VectorField2(self.c.scalmul(k), self.d.scalmul(k))
+
+    def is_zero(self):
+        return self.c.is_zero() & self.d.is_zero()
+
+    def take(self, indices):
+        return VectorField2(self.c.take(indices), self.d.take(indices))
+
+
+######################
+# Limb arithmetic    #
+######################
+
+def _carry(limbs, extra):
+    '''limbs with their carries propagated, on extra more limbs'''
+    (width, count) = limbs.shape
+    result = numpy.zeros((width + extra, count), dtype = numpy.uint64)
+    result[:width] = limbs
+    for i in range(width + extra - 1):
+        result[i + 1] += result[i] >> LIMB_BITS
+        result[i] &= _MASK
+    return result
+
+
+def _reduce(limbs, constants):
+    '''limbs (normalised, < 2p, on limbs + 1 limbs) minus p if they are not
+    smaller than p, on limbs limbs'''
+    width = limbs.shape[0]
+    signed = limbs.astype(numpy.int64)
+    signed[:constants.limbs] -= constants.p.astype(numpy.int64)
+    borrow = numpy.zeros(limbs.shape[1], dtype = numpy.int64)
+    for i in range(width):
+        signed[i] -= borrow
+        borrow = signed[i] >> 63 # -1 if negative, 0 otherwise
+        signed[i] &= _MASK
+        borrow = -borrow
+    # Where limbs < p, the subtraction borrowed out of the top limb
+    return numpy.where(borrow.astype(bool), limbs[:constants.limbs],
+                       signed[:constants.limbs].astype(numpy.uint64))
+
+
+def _subtract(a, b, constants):
+    '''a - b mod p (both reduced)'''
+    signed = a.astype(numpy.int64) - b.astype(numpy.int64)
+    borrow = numpy.zeros(a.shape[1], dtype = numpy.int64)
+    for i in range(constants.limbs):
+        signed[i] -= borrow
+        borrow = -(signed[i] >> 63)
+        signed[i] &= _MASK
+    # a < b: p is added back (the carry out of the top limb cancels the
+    # borrow)
+    corrected = signed.astype(numpy.uint64) + constants.p * borrow.astype(
+        numpy.uint64)
+    return _carry(corrected, 1)[:constants.limbs]
+
+
+def _accumulate(t, offset, a, b):
+    '''t[offset:] += a * b, a being a row of limbs and b limbs: the products
+    are added in halves, the high ones to the next limbs'''
+    products = a * b
+    width = b.shape[0]
+    t[offset:offset + width] += products & _MASK
+    t[offset + 1:offset + width + 1] += products >> LIMB_BITS
+
+
+def _montgomery(a, b, constants):
+    '''a.b.R^-1 mod p (REDC), limb by limb on every element at once'''
+    limbs = constants.limbs
+    t = numpy.zeros((2 * limbs + 1, a.shape[1]), dtype = numpy.uint64)
+    for i in range(limbs):
+        _accumulate(t, i, a[i], b)
+    for i in range(limbs):
+        m = ((t[i] & _MASK) * constants.n0) & _MASK
+        _accumulate(t, i, m, constants.p)
+        t[i + 1] += t[i] >> LIMB_BITS
+    return _reduce(_carry(t[limbs:], 0), constants)
@@ -3,20 +3,139 @@
 
 This module wraps ways of getting some randomness.
 
+Random bytes are read from the system source by blocks and served from a
+buffer, so that drawing the scalars of a ballot costs one system call instead
+of one per scalar. Integers are drawn by rejection sampling: a draw of the bit
+length of the bound is discarded if it is not below the bound, so that every
+integer is equally likely (unlike a 256-bit draw reduced modulo the bound).
+
+For reproducible runs (benchmarks, test vectors), seed(value) replaces the
+system source by a deterministic generator (SHA-256 in counter mode, keyed
+with the seed) until seed(None) is called. Never seed the source of a tool
+that produces real ballots or keys.
+
+Processes forked from a process that holds buffered bytes (worker pools) do
+not reuse them: the buffer is discarded when the process id changes, and a
+seeded generator is re-keyed with the process id of the child. Worker pools
+that must be reproducible seed each worker themselves.
+
+A source is shared by the threads of a process (the precomputation thread of
+a PrecomputationPool, the executors of the front-end): reads are serialised
+by a lock, so that two threads never get the same bytes.
+
 @author: Richard Mathot
 '''
 
+import struct
 # pylint: disable=E0611
-from os import urandom
+from binascii import hexlify
+from hashlib import sha256
+from os import getpid, urandom
+from threading import Lock
+
+# Number of bytes read from the system source at once (128 scalars of 256 bits)
+BLOCK_SIZE = 4096
+
+
+if hasattr(int, 'from_bytes'):
+    def _to_int(data):
+        '''Big-endian decoding of a byte string'''
+        return int.from_bytes(data, 'big')
+else:
+    def _to_int(data):
+        '''Big-endian decoding of a byte string'''
+        return int(hexlify(data), 16) if data else 0
+
+
+class RandomSource(object):
+    '''Buffered source of random bytes (the system source, or a deterministic
+    generator if a seed is given)'''
+
+    def __init__(self, seed = None, block_size = BLOCK_SIZE):
+        self.block_size = block_size
+        self._key = None
+        self._counter = 0
+        if seed is not None:
+            self._key = sha256(b'seed' + seed).digest()
+        self._buffer = b''
+        self._pid = getpid()
+        self._lock = Lock()
+
+    def is_deterministic(self):
+        return self._key is not None
+
+    def read(self, n):
+        '''n random bytes'''
+        if self._pid != getpid(): # forked: the lock may be held by a thread
+            self._lock = Lock()   # that does not exist in this process
+        with self._lock:
+            if self._pid != getpid(): # never share bytes with the parent
+                self._buffer = b''
+                self._pid = getpid()
+                if self._key is not None:
+                    self._key = sha256(self._key
+                                       + struct.pack('>Q', self._pid)).digest()
+                    self._counter = 0
+            if len(self._buffer) < n:
+                self._buffer += self._block(max(n - len(self._buffer),
+                                                self.block_size))
+            (data, self._buffer) = (self._buffer[:n], self._buffer[n:])
+            return data
+
+    def _block(self, n):
+        if self._key is None:
+            return urandom(n)
+        blocks = []
+        for _ in range((n + 31) // 32):
+            blocks.append(sha256(self._key
+                                 + struct.pack('>Q', self._counter)).digest())
+            self._counter += 1
+        return b''.join(blocks)
+
+    def randint_batch(self, q, k):
+        '''k uniform integers in [0, q[ (rejection sampling)'''
+        assert q > 0
+        bits = (q - 1).bit_length()
+        length = (bits + 7) // 8
+        mask = (1 << bits) - 1
+        values = []
+        while len(values) < k:
+            # A draw is accepted with probability q / 2^bits > 1/2
+            missing = k - len(values)
+            block = self.read(length * missing)
+            for i in range(missing):
+                value = _to_int(block[length * i:length * (i + 1)]) & mask
+                if value < q:
+                    values.append(value)
+        return values
+
+
+_source = RandomSource()
+
+
+def seed(value = None):
+    '''Makes the module deterministic, seeded with the byte string value, or
+    back to the system source if value is None'''
+    #pylint: disable=W0603
+    global _source
+    _source = RandomSource(value)
+
+
+def random_bytes(n):
+    return _source.read(n)
 
 
 def randint(q):
-    '''Returns an integer between 0 and q (q should be < 2^256)'''
-    assert q < 2 ** 256
-    return get_256_random_bits_os() % q
+    '''Returns a uniform integer between 0 and q - 1'''
+    return _source.randint_batch(q, 1)[0]
+
+
+def randint_batch(q, k):
+    '''Returns a list of k uniform integers between 0 and q - 1'''
+    return _source.randint_batch(q, k)
 
 
 def get_256_random_bits_os():
     '''Generates a random integer whose length is 256 bits (32 bytes),
        by using system pseudorandom bytes source'''
-    return int(urandom(32).encode('hex'), 16)
+    return _to_int(_source.read(32))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+''' compat.py
+
+What differs between Python 2 and Python 3 and is used in more than one
+module. Text (fingerprints, JSON documents) is a native str on both; hashes,
+keys and files are bytes:
+
+    hexstr(data)    hexadecimal form of bytes, as a native str
+    to_bytes(text)  a native str as bytes (UTF-8 on Python 3)
+
+Moved standard modules (Queue, BaseHTTPServer, urlparse) are imported where
+they are used.
+
+@author: Richard Mathot
+'''
+
+from binascii import hexlify
+
+try:
+    from itertools import izip
+except ImportError: # Python 3
+    izip = zip
+
+try:
+    raw_input = raw_input #pylint: disable=C0103,W0622
+except NameError: # Python 3
+    raw_input = input #pylint: disable=C0103,W0622
+
+try:
+    INTEGER_TYPES = (int, long)
+except NameError: # Python 3
+    INTEGER_TYPES = (int,)
+
+
+if bytes is str: # Python 2
+    def hexstr(data):
+        return hexlify(data)
+
+    def to_bytes(text):
+        if isinstance(text, str):
+            return text
+        return text.encode('utf-8')
+else:
+    def hexstr(data):
+        return hexlify(data).decode('ascii')
+
+    def to_bytes(text):
+        if isinstance(text, bytes):
+            return text
+        return text.encode('utf-8')
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+''' tracing.py
+
+Timing spans around the stages of the ballot pipeline (acceptance,
+generation, tally, audit) and around pairings:
+
+    with span('accept.proofs'):
+        ...
+
+Tracing is off by default, and a span then costs a single test. Once it is
+enabled (enable(), or the environment variables below, read when the module
+is first imported), every span feeds the latency histogram of its stage and,
+if a trace file is given, is appended to it as one JSON object per line:
+
+    {"stage": ..., "start": ..., "duration": ..., "pid": ...}
+
+Histograms are exported in the Prometheus text format (write_metrics), with
+cumulative buckets and the p50, p95 and p99 of the last samples:
+
+    ULYSSES_TRACE=<file>    JSON-lines trace (appended, shared by the worker
+                            processes of a tool)
+    ULYSSES_METRICS=<file>  metrics of the process, written when it exits
+
+@author: Richard Mathot
+'''
+
+import atexit
+import json
+import math
+from collections import deque
+from os import environ, getpid
+from timeit import default_timer
+from time import time
+
+# Upper bounds of the histogram buckets (seconds)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0)
+# Number of recent samples per stage kept for the percentiles
+WINDOW = 4096
+
+_enabled = False
+_trace = None
+_histograms = {}
+
+
+def percentile(samples, q):
+    '''q-th percentile (0 <= q <= 100) of a list of numbers, None if empty'''
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = int(math.ceil(q / 100.0 * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+class Histogram(object):
+    '''Latencies of a stage: cumulative buckets and a window of samples'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen = WINDOW)
+
+    def add(self, duration):
+        i = 0
+        while (i < len(BUCKETS)) and (duration > BUCKETS[i]):
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += duration
+        self.samples.append(duration)
+
+    def summary(self):
+        samples = list(self.samples)
+        return {'count' : self.count, 'sum' : self.total,
+                'p50' : percentile(samples, 50),
+                'p95' : percentile(samples, 95),
+                'p99' : percentile(samples, 99)}
+
+
+class _Span(object):
+    '''An enabled span'''
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.stage, default_timer() - self.start)
+        return False
+
+
+class _NullSpan(object):
+    '''The span of disabled tracing'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(stage):
+    '''Context manager timing a stage (nothing if tracing is disabled)'''
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(stage)
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable(trace = None):
+    '''Enables tracing; spans are also appended to the trace file if a path
+    is given'''
+    #pylint: disable=W0603
+    global _enabled, _trace
+    if trace is not None:
+        _trace = open(trace, 'a')
+    _enabled = True
+
+
+def disable():
+    #pylint: disable=W0603
+    global _enabled, _trace
+    _enabled = False
+    if _trace is not None:
+        _trace.close()
+        _trace = None
+
+
+def record(stage, duration):
+    '''Records a stage timed elsewhere (duration in seconds)'''
+    if not _enabled:
+        return
+    if stage not in _histograms:
+        _histograms[stage] = Histogram()
+    _histograms[stage].add(duration)
+    if _trace is not None:
+        _trace.write(json.dumps({'stage' : stage,
+                                 'start' : time() - duration,
+                                 'duration' : duration,
+                                 'pid' : getpid()}) + "\n")
+        _trace.flush()
+
+
+def summary():
+    '''{stage: {'count', 'sum', 'p50', 'p95', 'p99'}}'''
+    return dict((stage, histogram.summary())
+                for (stage, histogram) in _histograms.items())
+
+
+def metrics():
+    '''The histograms in the Prometheus text format'''
+    lines = ["# HELP ulysses_stage_seconds Latency of the pipeline stages",
+             "# TYPE ulysses_stage_seconds histogram"]
+    for stage in sorted(_histograms):
+        histogram = _histograms[stage]
+        cumulative = 0
+        for (bound, count) in zip(BUCKETS + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append('ulysses_stage_seconds_bucket{stage="%s",le="%s"} %d'
+                         % (stage, bound, cumulative))
+        lines.append('ulysses_stage_seconds_sum{stage="%s"} %r'
+                     % (stage, histogram.total))
+        lines.append('ulysses_stage_seconds_count{stage="%s"} %d'
+                     % (stage, histogram.count))
+    lines.extend(["# HELP ulysses_stage_quantile_seconds Latency percentiles"
+                  " of the last samples of the pipeline stages",
+                  "# TYPE ulysses_stage_quantile_seconds gauge"])
+    for stage in sorted(_histograms):
+        stage_summary = _histograms[stage].summary()
+        for (quantile, key) in (('0.5', 'p50'), ('0.95', 'p95'),
+                                ('0.99', 'p99')):
+            lines.append('ulysses_stage_quantile_seconds{stage="%s",'
+                         'quantile="%s"} %r'
+                         % (stage, quantile, stage_summary[key]))
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path):
+    filedes = open(path, 'w')
+    filedes.write(metrics())
+    filedes.close()
+
+
+if ('ULYSSES_TRACE' in environ) or ('ULYSSES_METRICS' in environ):
+    enable(environ.get('ULYSSES_TRACE'))
+    if 'ULYSSES_METRICS' in environ:
+        atexit.register(write_metrics, environ['ULYSSES_METRICS'])
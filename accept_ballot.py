@@ -2,98 +2,166 @@
 # -*- coding: utf-8 -*-
 
 '''
-This tool is part of UlyssesVoting and can be used to check if a ballot is 
+This tool is part of UlyssesVoting and can be used to check if a ballot is
 valid or not for an election.
 
+It can also run as a service (--serve), accepting ballots as HTTP requests on
+localhost with the election kept in memory (see Election/service.py), or as a
+micro-batching front-end backed by a pool of verification processes
+(--ingest, Python 3 only, see Election/ingestion.py).
+
+Ballots of a sharded election (configure_election.py --shards) are accepted
+by the shard of their fingerprint: --sharded accepts every ballot of a folder
+with one process per shard, and --merge merges the shards when the election
+is closed (see Election/sharding.py).
+
 @author: Richard Mathot
 '''
 
-import json
+import logging
 import sys
-#pylint: disable=E0611
 from hashlib import sha256
-from shutil import move
-from Crypto.ccs_va import init_curves, ccsva_extrip, ccsva_extract_c
-
-#pylint: disable=R0914,R0915
-def main(settings, ballot, election_folder):
+from os import listdir
+from Election.acceptance import accept_ballot
+from Election.context import load_context
+from Election.service import BallotServer
+from Election.sharding import Acceptor, accept_sharded, merge_shards, \
+    shard_count, shard_of
+from Election.storage import open_storage
+from Util.tracing import span
+
+def main(settings_path, ballot_path, election_folder):
     '''Launch single ballot validation'''
     print("Welcome into the Ballot Verification Tool")
 
-    filedes = open(settings, 'r')
-    settings_raw = filedes.read()
-    filedes.close()
-
-    filedes2 = open(ballot, 'r')
-    ballot_raw = filedes2.read()
-    filedes2.close()
-
-    election_fingerprint = sha256(settings_raw).hexdigest()
-    ballot_fingerprint = sha256(ballot_raw).hexdigest()
-
-    print("Election hash (sha256): " + election_fingerprint)
-    print("Ballot hash (sha256): " + ballot_fingerprint)
-
-    settings = json.loads(settings_raw)
-    ballot = json.loads(ballot_raw)
-    print("Election name: " + settings['human']['name'])
-
-
-    (F, F2, C, C2) = init_curves()
-    g_raw = settings['crypto']['g']
-    h_raw = settings['crypto']['h']
-    g1_raw = settings['crypto']['g1']
-    h1_raw = settings['crypto']['h1']
-    g_coord = [F(g_raw['coord'][0]), F(g_raw['coord'][1])]
-    h_coord = [F2(h_raw['coord'][0]), F2(h_raw['coord'][1])]
-    g1_coord = [F(g1_raw['coord'][0]), F(g1_raw['coord'][1])]
-    h1_coord = [F2(h1_raw['coord'][0]), F2(h1_raw['coord'][1])]
-    g = C(g_coord, representation = g_raw['repr'])
-    g1 = C(g1_coord, representation = g1_raw['repr'])
-    h = C2(h_coord, representation = h_raw['repr'])
-    h1 = C2(h1_coord, representation = h1_raw['repr'])
-
-    c0_raw = ballot['ciphertext']['c0']
-    c1_raw = ballot['ciphertext']['c1']
-    c2_raw = ballot['ciphertext']['c2']
-    c0_coord = [F(c0_raw['coord'][0]), F(c0_raw['coord'][1])]
-    c1_coord = [F(c1_raw['coord'][0]), F(c1_raw['coord'][1])]
-    c2_coord = [F2(c2_raw['coord'][0]), F2(c2_raw['coord'][1])]
-    c0 = C(c0_coord, representation = c0_raw['repr'])
-    c1 = C(c1_coord, representation = c1_raw['repr'])
-    c2 = C2(c2_coord, representation = c2_raw['repr'])
-
-    sigmacc_raw = ballot['proofs']['sigmacc']
-    sigmaor_raw = ballot['proofs']['sigmaor']
-    #FIXME check la conversion de sigma cc et sigma or
-    sigmacc = sigmacc_raw
-    sigmaor = sigmaor_raw
-
-    if (ccsva_extrip(c0, c1, c2, sigmacc, sigmaor, g, h, g1, h1) == True):
-
-        #moves the full ballot to SB
-        move(ballot, election_folder + "sb/" + ballot_fingerprint + ".bal.json")
-
-        #appends the public commitment on PB
-        #(c2b, sigmaorb) = ccsva_extract_c(c0, c1, c2, sigmacc, sigmaor)
-        public_ballot = json.dumps({'c2' : c2_raw, #c2b.json(),
-                                    'sigmaor': sigmaor_raw}, #sigmaorb.json()},
-                                   indent = 4)
-        filedes = open(election_folder + "pb/" + ballot_fingerprint \
-                       + ".bal.json", "w")
-        filedes.write(public_ballot)
-        filedes.close()
-
+    with span('accept.load'):
+        context = load_context(settings_path, precompute = True)
+
+    with span('accept.read'):
+        filedes2 = open(ballot_path, 'rb')
+        ballot_raw = filedes2.read()
+        filedes2.close()
+
+    print("Election hash (sha256): " + context.fingerprint)
+    print("Election name: " + context.name())
+
+    shards = shard_count(election_folder)
+    if shards > 0:
+        shard = shard_of(sha256(ballot_raw).hexdigest(), shards)
+        print("Shard: " + shard.__str__())
+        acceptor = Acceptor(context, election_folder, shard)
+        (ballot_fingerprint, accepted) = acceptor.accept(ballot_raw,
+                                                         ballot_path)
+        acceptor.close()
+    else:
+        storage = open_storage(election_folder, context)
+        (ballot_fingerprint, accepted) = accept_ballot(context, ballot_raw,
+                                                       storage, ballot_path)
+        storage.close()
+    if ballot_fingerprint is not None: # not hashed if oversized
+        print("Ballot hash (sha256): " + ballot_fingerprint)
+
+    if accepted:
         print("Ballot accepted and stored!")
     else:
         print("Refused ballot!")
         exit(1)
     exit(0)
 
+
+def sharded(settings_path, election_folder, inbox):
+    '''Launch the acceptance of the ballot files of inbox by the shards'''
+    print("Welcome into the Ballot Verification Tool")
+    paths = [inbox + name for name in sorted(listdir(inbox))
+             if name.endswith(".bal.json") or name.endswith(".bal.bin")]
+    print("Accepting " + len(paths).__str__() + " ballots with "
+          + shard_count(election_folder).__str__() + " shards...")
+    refused = 0
+    for (shard, accepted, shard_refused) in \
+            accept_sharded(settings_path, election_folder, paths):
+        print("Shard " + shard.__str__() + ": " + accepted.__str__()
+              + " accepted, " + shard_refused.__str__() + " refused")
+        refused += shard_refused
+    exit(1 if refused else 0)
+
+
+def merge(settings_path, election_folder):
+    '''Launch the merge of the shards of a closed election'''
+    print("Welcome into the Ballot Verification Tool")
+    context = load_context(settings_path)
+    (merged, _) = merge_shards(context, election_folder)
+    print("Number of ballots: " + merged['count'].__str__())
+    for fingerprint in merged['excluded']:
+        print("Excluded (commitments accepted twice): " + fingerprint)
+    print("Root of the boards: " + merged['root']['root'] + " ("
+          + merged['root']['size'].__str__() + " ballots)")
+    print("Merged shards are in " + election_folder + "merged.json")
+    exit(0)
+
+
+def _refuse_sharded(election_folder):
+    if shard_count(election_folder) > 0:
+        print("Sharded elections are accepted with --sharded (or one ballot "
+              "at a time)")
+        exit(1)
+
+
+def serve(settings_path, election_folder, port):
+    '''Launch the ballot acceptance service'''
+    _refuse_sharded(election_folder)
+    print("Welcome into the Ballot Verification Service")
+    print("Loading election and precomputing tables...")
+    context = load_context(settings_path, precompute = True)
+    print("Election hash (sha256): " + context.fingerprint)
+    print("Election name: " + context.name())
+
+    storage = open_storage(election_folder, context, bloom = True)
+    server = BallotServer(context, storage, port)
+    print("Accepting ballots on http://127.0.0.1:" + port.__str__() \
+          + "/ballots")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        storage.close()
+    exit(0)
+
+def ingest(settings_path, election_folder, port, workers):
+    '''Launch the asyncio ingestion front-end'''
+    _refuse_sharded(election_folder)
+    # asyncio is only available on Python 3
+    from Election.ingestion import serve as serve_ingestion
+    print("Welcome into the Ballot Ingestion Service")
+    print("Accepting ballots on http://127.0.0.1:" + port.__str__() \
+          + "/ballots with " + workers.__str__() + " workers")
+    try:
+        serve_ingestion(settings_path, election_folder, port,
+                        workers = workers)
+    except KeyboardInterrupt:
+        pass
+    exit(0)
+
 if __name__ == '__main__':
+    logging.basicConfig(level = logging.ERROR)
+    if (sys.argv.__len__() == 5) and (sys.argv[1] == '--serve'):
+        serve(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    if (sys.argv.__len__() == 6) and (sys.argv[1] == '--ingest'):
+        ingest(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+    if (sys.argv.__len__() == 5) and (sys.argv[1] == '--sharded'):
+        sharded(sys.argv[2], sys.argv[3], sys.argv[4])
+    if (sys.argv.__len__() == 4) and (sys.argv[1] == '--merge'):
+        merge(sys.argv[2], sys.argv[3])
     if(sys.argv.__len__() != 4):
         print("Incorrect argument number! \n    \
-        USAGE: ./accept_ballot.py <settings.pub.json> <ballot.bal.json> \
-        <election_folder.edata")
+        USAGE: ./accept_ballot.py <settings.pub.json> <ballot.bal.json|.bal.bin> \
+        <election_folder.edata> \n    \
+        or:    ./accept_ballot.py --serve <settings.pub.json> \
+        <election_folder.edata> <port> \n    \
+        or:    ./accept_ballot.py --ingest <settings.pub.json> \
+        <election_folder.edata> <port> <workers> \n    \
+        or:    ./accept_ballot.py --sharded <settings.pub.json> \
+        <election_folder.edata> <ballots_folder> \n    \
+        or:    ./accept_ballot.py --merge <settings.pub.json> \
+        <election_folder.edata>")
         exit(1)
     main(sys.argv[1], sys.argv[2], sys.argv[3])
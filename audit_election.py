@@ -1,7 +1,52 @@
 #!/usr/bin/python -OO
 # -*- coding: utf-8 -*-
 '''
-Created on 16 août 2012
+This tool is part of UlyssesVoting and can be used to audit the boards of an
+election: every public entry is verified again and checked against the secret
+board (see Election/audit.py).
 
-@author: richard
+Audits are incremental: only the ballots accepted since the last audit are
+verified, unless --full is given.
+
+@author: Richard Mathot
 '''
+
+import logging
+import sys
+from Election.audit import ElectionAudit
+
+def main(settings_path, election_folder, workers = 2, full = False):
+    '''Launch the audit of an election'''
+    print("Welcome into the Election Audit Tool")
+
+    audit = ElectionAudit(settings_path, election_folder, workers)
+    print("Election hash (sha256): " + audit.context.fingerprint)
+    print("Election name: " + audit.context.name())
+
+    report = audit.run(full)
+    if report['restarted']:
+        print("The boards changed since the last audit, audit started over")
+    print("Entries verified: " + report['verified'].__str__())
+    print("Entries audited: " + report['audited'].__str__())
+    print("Audit chain: " + report['chain'])
+
+    if report['problems']:
+        for (fingerprint, reason) in report['problems']:
+            print("PROBLEM: " + (fingerprint or "-") + ": " + reason)
+        exit(1)
+    print("Both boards are consistent and every proof is valid!")
+    exit(0)
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.ERROR)
+    arguments = [argument for argument in sys.argv[1:] if argument != '--full']
+    workers = 2
+    if (len(arguments) == 4) and (arguments[2] == '--workers'):
+        workers = int(arguments[3])
+        arguments = arguments[:2]
+    if(arguments.__len__() != 2):
+        print("Incorrect argument number! \n    \
+        USAGE: ./audit_election.py <settings.pub.json> <election_folder.edata> \
+        [--full] [--workers <number>]")
+        exit(1)
+    main(arguments[0], arguments[1], workers, '--full' in sys.argv)
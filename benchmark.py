@@ -0,0 +1,88 @@
+#!/usr/bin/python -OO
+# -*- coding: utf-8 -*-
+
+'''
+This tool is part of UlyssesVoting and can be used to measure the performance
+of the arithmetic, of the CCS-VA scheme and of the acceptance and tally of
+ballots (see Benchmarks/).
+
+Results are compared to a baseline (Benchmarks/baseline.json by default,
+written by --save-baseline); the tool fails if a benchmark is slower than the
+baseline by more than the threshold (10% by default). With --count, the field
+and curve operations of each benchmark are counted as well.
+
+@author: Richard Mathot
+'''
+
+import sys
+from os.path import exists
+from Benchmarks import micro, macro #pylint: disable=W0611
+from Benchmarks.runner import run_benchmarks, save_results, load_results, \
+    compare, THRESHOLD
+
+BASELINE = "Benchmarks/baseline.json"
+
+USAGE = "USAGE: ./benchmark.py [--only <prefix>,...] [--output <results.json>]\
+ [--baseline <baseline.json>] [--threshold <ratio>] [--save-baseline]\
+ [--count]"
+
+
+def report(name, result):
+    print(name.ljust(32) + ("%.6f s" % result['seconds']).rjust(16) \
+          + (" (" + result['number'].__str__() + " x "
+             + result['repeat'].__str__() + ")"))
+    for operation in sorted(result.get('operations', {})):
+        print("    " + operation.ljust(28)
+              + result['operations'][operation].__str__().rjust(16))
+
+
+def main(options):
+    '''Runs the benchmarks and compares them to the baseline'''
+    prefixes = None
+    if options.get('--only') is not None:
+        prefixes = options['--only'].split(',')
+    baseline_path = options.get('--baseline') or BASELINE
+    threshold = float(options.get('--threshold') or THRESHOLD)
+
+    print("Running benchmarks...")
+    results = run_benchmarks(prefixes, report = report,
+                             count = '--count' in options)
+    if options.get('--output') is not None:
+        save_results(results, options['--output'])
+        print("Results are in " + options['--output'])
+    if '--save-baseline' in options:
+        save_results(results, baseline_path)
+        print("Baseline saved in " + baseline_path)
+        sys.exit(0)
+    if not exists(baseline_path):
+        print("No baseline to compare with (see --save-baseline)")
+        sys.exit(0)
+
+    regressions = 0
+    print("Comparison with " + baseline_path + ":")
+    for (name, old, new, ratio, regressed) in \
+            compare(results, load_results(baseline_path), threshold):
+        print(name.ljust(32) + ("%.6f s -> %.6f s" % (old, new)).rjust(28)
+              + ("  x%.2f" % ratio) + ("  REGRESSION" if regressed else ""))
+        regressions += regressed
+    if regressions:
+        print(regressions.__str__() + " regression(s) above "
+              + (threshold * 100).__str__() + "%")
+        sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    parsed = {}
+    while arguments:
+        option = arguments.pop(0)
+        if option in ('--save-baseline', '--count'):
+            parsed[option] = None
+        elif (option in ('--only', '--output', '--baseline', '--threshold')) \
+                and arguments:
+            parsed[option] = arguments.pop(0)
+        else:
+            print(USAGE)
+            sys.exit(1)
+    main(parsed)
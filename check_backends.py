@@ -0,0 +1,98 @@
+#!/usr/bin/python -OO
+# -*- coding: utf-8 -*-
+
+'''
+This tool is part of UlyssesVoting and can be used to compare the optimised
+arithmetic (backends) with the reference classes, on edge cases and random
+inputs, and to check that the pairing is bilinear (see
+NumberTheory/differential.py).
+
+Every divergence is printed with the seed of its case, which --replay runs
+again. The tool fails if a backend diverges or if a pairing is not bilinear.
+
+@author: Richard Mathot
+'''
+
+import sys
+from NumberTheory.differential import run, run_case, check_bilinearity, \
+    BACKENDS
+
+USAGE = "USAGE: ./check_backends.py [--only <prefix>,...] [--backend <name>,...]\
+ [--cases <count>] [--pairing-cases <count>] [--seed <seed>]\
+ [--no-bilinearity] | --replay <case seed>"
+
+
+def report(operation, count, divergences):
+    print(operation.ljust(16) + (count.__str__() + " cases").rjust(12)
+          + ("  " + len(divergences).__str__() + " DIVERGENCE(S)"
+             if divergences else "  ok"))
+    for (name, _, case, inputs, expected, got) in divergences:
+        print("    [" + name + "] " + case.decode())
+        print("        inputs:    " + inputs.__repr__())
+        print("        reference: " + expected.__repr__())
+        print("        " + (name + ":").ljust(11) + got.__repr__())
+
+
+def replay(case):
+    (operation, inputs, outcomes) = run_case(case.encode())
+    print(operation + " " + inputs.__repr__())
+    for name in sorted(outcomes):
+        print("    " + (name + ":").ljust(12) + outcomes[name].__repr__())
+    if len(set(outcomes.values())) > 1:
+        sys.exit(1)
+    sys.exit(0)
+
+
+def main(options):
+    '''Runs the comparisons and the bilinearity checks'''
+    if options.get('--replay') is not None:
+        replay(options['--replay'])
+    prefixes = None
+    if options.get('--only') is not None:
+        prefixes = options['--only'].split(',')
+    backends = None
+    if options.get('--backend') is not None:
+        backends = options['--backend'].split(',')
+        for name in backends:
+            if name not in BACKENDS:
+                print("Unknown backend: " + name + " (registered: "
+                      + ", ".join(sorted(BACKENDS)) + ")")
+                sys.exit(1)
+    seed_value = (options.get('--seed') or 'differential').encode()
+
+    print("Comparing backends with the reference...")
+    divergences = run(backends, prefixes, int(options.get('--cases') or 8),
+                      int(options.get('--pairing-cases') or 1), seed_value,
+                      report = report)
+    failures = len(divergences)
+
+    if '--no-bilinearity' not in options:
+        print("Checking the bilinearity of the pairings...")
+        for name in sorted(backends or BACKENDS):
+            if 'pairing' not in BACKENDS[name]:
+                continue
+            failed = check_bilinearity(name, seed_value + b':bilinearity')
+            print(name.ljust(16) + ("  FAILED: " + "; ".join(failed)
+                                    if failed else "  ok"))
+            failures += len(failed)
+
+    if failures:
+        print(failures.__str__() + " failure(s)")
+        sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    parsed = {}
+    while arguments:
+        option = arguments.pop(0)
+        if option == '--no-bilinearity':
+            parsed[option] = None
+        elif (option in ('--only', '--backend', '--cases', '--pairing-cases',
+                         '--seed', '--replay')) and arguments:
+            parsed[option] = arguments.pop(0)
+        else:
+            print(USAGE)
+            sys.exit(1)
+    main(parsed)
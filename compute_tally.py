@@ -5,19 +5,106 @@
 This tool is part of UlyssesVoting and can be used to compute the final outcome
 of an election.
 
+With --check <totals.json>, the outcome is compared to the plaintext totals
+recorded when the ballots were generated (see Election/bulk.py).
+
+The ballots of a sharded election are not read: the aggregates of the shards
+are merged first (see Election/sharding.py).
+
 @author: Richard Mathot
 '''
 
+import json
 import logging
 import sys
+from Crypto.ccs_va import ccs_tally_vector, ccs_dec_vector
+from Election.context import load_context
+from Election.sharding import shard_count, merge_shards
+from Election.storage import open_storage
+from Election.wire import decode_any, WireError
+from Util.tracing import span
+
+#pylint: disable=R0914
+def main(settings_path, privkey_path, election_folder, expected_path = None):
+    '''Decrypts the homomorphic sum of all the ballots of the secret board'''
+    context = load_context(settings_path)
+    settings = context.settings
+
+    filedes = open(privkey_path, 'r')
+    x1 = json.loads(filedes.read())['crypto']['x1']
+    filedes.close()
+
+    (g, h, h1) = (context.g, context.h, context.h1)
+
+    if shard_count(election_folder) > 0:
+        # The coordinator merges the running aggregates of the shards
+        with span('tally.merge'):
+            (merged, aggregate) = merge_shards(context, election_folder)
+        count = merged['count']
+        for fingerprint in merged['excluded']:
+            print("Excluded (commitments accepted twice): " + fingerprint)
+    else:
+        ballots = []
+        storage = open_storage(election_folder)
+        with span('tally.read'):
+            for (fingerprint, ballot_raw) in storage.sb.scan():
+                try:
+                    (_, (cs, _, _, _)) = decode_any(ballot_raw, context)
+                except WireError:
+                    logging.critical("Unreadable ballot " + fingerprint + "!")
+                    exit(1)
+                ballots.append(cs)
+        storage.close()
+        count = len(ballots)
+
+        # All the components are aggregated and decrypted as one vector
+        with span('tally.aggregate'):
+            aggregate = ccs_tally_vector(ballots)
+
+    print("Number of ballots: " + count.__str__())
+    if count == 0:
+        exit(0)
+
+    with span('tally.decrypt'):
+        totals = ccs_dec_vector(aggregate, g, h, h1, x1,
+                                bound = count, basis = context.basis(),
+                                lines = context.lines(),
+                                dlog_table = context.dlog_table())
+    if None in totals:
+        logging.critical("Tally decryption failed!")
+        exit(1)
+
+    human = settings['human']
+    if 'answers' in human:
+        answers = human['answers']
+    else:
+        answers = [human['answer_0'], human['answer_1']]
+        totals = [count - totals[0], totals[0]]
+
+    print("QUESTION: " + human['question'])
+    for answer, total in zip(answers, totals):
+        print(answer + ": " + total.__str__())
 
-def main():
+    if expected_path is not None:
+        filedes = open(expected_path, 'r')
+        expected = json.loads(filedes.read())
+        filedes.close()
+        if (expected['election'] != context.fingerprint) \
+                | (expected['count'] != count) \
+                | (expected['totals'] != totals):
+            logging.critical("Outcome does not match the expected totals "
+                             + expected['totals'].__str__() + "!")
+            exit(1)
+        print("Outcome matches the expected totals.")
     exit(0)
 
 if __name__ == '__main__':
     logging.basicConfig(level = logging.ERROR)
+    if (sys.argv.__len__() == 6) and (sys.argv[4] == '--check'):
+        main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[5])
     if(sys.argv.__len__() != 4):
         logging.critical("Incorrect argument number! \n    \
-        USAGE: ./compute_tally.py <settings> <privkey> <ballots_folder>")
+        USAGE: ./compute_tally.py <settings> <privkey> <ballots_folder> \
+[--check <totals.json>]")
         exit(1)
-    main()
+    main(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -12,9 +12,14 @@ import sys
 # pylint: disable=E0611
 from hashlib import sha256
 from Crypto.ccs_va import ccsva_gen
+from Election.context import load_context
+from Election.merkle import board_key_folder, create_board_key
+from Election.sharding import create_shards
+from Election.storage import create_storage
+from Util.compat import raw_input, to_bytes
 from Util.folder import create_dir_ifnexists
 
-def main(name):
+def main(name, log = False, precompute = False, shards = 0):
     '''Launch interactive configuration for an election'''
     print("Welcome into the Election Configuration Tool")
 
@@ -28,34 +33,54 @@ def main(name):
     print("Please configure question and answers")
 
     question = raw_input("Question? --> ")
-    answer_0 = raw_input("Answer 0? --> ")
-    answer_1 = raw_input("Answer 1? --> ")
+    ballot_type = None
+    while ballot_type not in ('single', 'approval'):
+        ballot_type = raw_input("Ballot type (single or approval)? --> ")
+    answers_count = 0
+    while answers_count < 2:
+        try:
+            answers_count = int(raw_input("Number of answers? --> "))
+        except(ValueError): # Catch inputs that are not integers
+            continue
+    answers = [raw_input("Answer " + i.__str__() + "? --> ")
+               for i in range(answers_count)]
 
     election_pub = json.dumps({'human' : {'name' : name,
                                           'question' : question,
-                                          'answer_0' : answer_0,
-                                          'answer_1' : answer_1},
-                                'crypto' : {'g' : g.json(),
-                                            'h' : h.json(),
-                                            'g1' : g1.json(),
-                                            'h1' : h1.json(),
+                                          'type' : ballot_type,
+                                          'answers' : answers},
+                                'crypto' : {'g' : g.json(compressed = True),
+                                            'h' : h.json(compressed = True),
+                                            'g1' : g1.json(compressed = True),
+                                            'h1' : h1.json(compressed = True),
                                              }
                                }, indent = 4)
                     # 'indent' parameter enables/disables human-readable format
-    election_fingerprint = sha256(election_pub).hexdigest()
+    election_fingerprint = sha256(to_bytes(election_pub)).hexdigest()
 
     election_priv = json.dumps({'crypto' : {'x1' : x1}}, indent = 4)
                     # 'indent' parameter enables/disables human-readable format
 
     create_dir_ifnexists(name + ".edata/")
-    create_dir_ifnexists(name + ".edata/pb/")
-    create_dir_ifnexists(name + ".edata/sb/")
+    create_storage(name + ".edata/", log).close()
     print("All the election files should be in " + name + ".edata/")
 
     filedes = open(name + ".edata/" + name + ".pub.json", "w")
     filedes.write(election_pub)
     filedes.close()
 
+    create_board_key(load_context(name + ".edata/" + name + ".pub.json"),
+                     name + ".edata/")
+    print("The key signing the board is in "
+          + board_key_folder(name + ".edata/") + "board.key"
+          + " (keep it out of the published files)")
+
+    if shards > 0:
+        create_shards(load_context(name + ".edata/" + name + ".pub.json"),
+                      name + ".edata/", shards, log)
+        print("Ballots will be accepted by " + shards.__str__()
+              + " shards, in " + name + ".edata/shards/")
+
     print("Election settings and public keys are in " + name + ".edata/" \
           + name + ".pub.json")
     print("Election hash (sha256): " + election_fingerprint)
@@ -66,11 +91,32 @@ def main(name):
 
     print("Private keys are in " + name + ".edata/" + name + ".priv.json")
 
+    if precompute:
+        print("Precomputing tables. This may take some time...")
+        load_context(name + ".edata/" + name + ".pub.json").build_artifact()
+        print("Precomputations are in " + name + ".edata/" + name + ".ctx")
+
     exit(0)
 
 if __name__ == '__main__':
-    if(sys.argv.__len__() != 2):
+    options = sys.argv[2:]
+    shard_option = 0
+    if '--shards' in options:
+        i = options.index('--shards')
+        try:
+            shard_option = int(options[i + 1])
+        except (IndexError, ValueError):
+            shard_option = -1
+        options = options[:i] + options[i + 2:]
+    if (sys.argv.__len__() < 2) or (shard_option < 0) \
+            or any(option not in ('--log', '--precompute') for option in options):
         print("Please provide a name for the election \n\
-        USAGE: ./configure_election.py <name>")
+        USAGE: ./configure_election.py <name> [--log] [--precompute] \
+[--shards <count>]")
         sys.exit(1)
-    main(sys.argv[1])#.encode('utf-8', 'ignore'))
+    # --log: boards stored in append-only logs (large elections)
+    # --precompute: precomputation artifact shared by all the tools
+    # --shards: acceptance partitioned between independent acceptors
+    main(sys.argv[1], log = '--log' in options,
+         precompute = '--precompute' in options,
+         shards = shard_option)#.encode('utf-8', 'ignore'))
@@ -4,6 +4,9 @@
 '''
 This tool is part of UlyssesVoting and can be used to generate a valid ballot.
 
+With --bulk, it generates a corpus of ballots without interaction, for load
+tests (see Election/bulk.py).
+
 @author: Richard Mathot
 '''
 
@@ -11,54 +14,98 @@ import json
 import sys
 # pylint: disable=E0611
 from hashlib import sha256
-from Crypto.ccs_va import init_curves, ccsva_enc
+from Crypto.precomputation import PrecomputationPool
+from Election.bulk import generate_ballots, TOTALS, BULK_LOG
+from Election.context import load_context
+from Election.storage import FileBoard
+from Election.wire import encode_ballot, encode_json_ballot
+from Util.compat import raw_input, to_bytes
+from Util.tracing import span
 
 
 #pylint: disable=R0914
-def main(election_folder):
+def main(election_folder, binary = False):
     '''Launch interactive ballot generation'''
     print("Welcome into the Ballot Generation Tool")
 
     raw_input("Press <ENTER> to start loading election settings...")
     print("Loading...")
 
-    filedes = open(election_folder + election_folder[:-7] + ".pub.json", 'r')
-    settings_raw = filedes.read()
-    filedes.close()
+    context = load_context(election_folder + election_folder[:-7]
+                           + ".pub.json", precompute = True)
+    print("Election hash (sha256): " + context.fingerprint)
+    print("Election name: " + context.name())
+
+    print("Loading successful!")
 
-    election_fingerprint = sha256(settings_raw).hexdigest()
-    print("Election hash (sha256): " + election_fingerprint)
+    vector = context.is_vector()
+    if vector:
+        ballot = vector_ballot(context)
+    else:
+        ballot = binary_ballot(context)
 
-    settings = json.loads(settings_raw)
-    print("Election name: " + settings['human']['name'])
+    if binary:
+        ballot_content = encode_ballot(*ballot, vector = vector)
+        suffix = ".bal.bin"
+    else:
+        ballot_content = to_bytes(json.dumps(
+            encode_json_ballot(*ballot, vector = vector), indent = 4))
+        suffix = ".bal.json"
 
-    print("Loading successful!")
+    print("Ballot encrypted!")
+
+    # Compute ballot hash
+    ballot_fingerprint = sha256(ballot_content).hexdigest()
+
+    # Save ballot to a file
+    outbox = FileBoard(election_folder, suffix)
+    outbox.append(ballot_fingerprint, ballot_content)
+    outbox.close()
+
+    print("Ballot hash (sha256): " + ballot_fingerprint)
+    print("This ballot is in " + outbox.path(ballot_fingerprint))
+
+    sys.exit(0)
 
-    (F, F2, C, C2) = init_curves()
-    g_raw = settings['crypto']['g']
-    h_raw = settings['crypto']['h']
-    g1_raw = settings['crypto']['g1']
-    h1_raw = settings['crypto']['h1']
-
-    hx = [int(i) for i in h_raw['coord'][0]]
-    hy = [int(i) for i in h_raw['coord'][1]]
-    h1x = [int(i) for i in h1_raw['coord'][0]]
-    h1y = [int(i) for i in h1_raw['coord'][1]]
-
-    g_coord = [F(int(g_raw['coord'][0])), F(int(g_raw['coord'][1]))]
-    g1_coord = [F(int(g1_raw['coord'][0])), F(int(g1_raw['coord'][1]))]
-    h_coord = [F2(hx), F2(hy)]
-    h1_coord = [F2(h1x), F2(h1y)]
-    g = C(g_coord, representation = g_raw['repr'])
-    g1 = C(g1_coord, representation = g1_raw['repr'])
-    h = C2(h_coord, representation = h_raw['repr'])
-    h1 = C2(h1_coord, representation = h1_raw['repr'])
+
+def bulk(election_folder, count, options):
+    '''Launch non-interactive generation of count ballots'''
+    print("Welcome into the Ballot Generation Tool")
+    weights = None
+    if options.get('--votes') is not None:
+        weights = [float(weight) for weight in options['--votes'].split(',')]
+    print("Generating " + count.__str__() + " ballots...")
+    totals = generate_ballots(election_folder + election_folder[:-7]
+                              + ".pub.json", election_folder, count,
+                              weights = weights, seed = options.get('--seed'),
+                              workers = int(options.get('--workers', 2)),
+                              binary = '--binary' in options,
+                              log = '--log' in options)
+    if '--log' in options:
+        print("Ballots are in " + election_folder + BULK_LOG)
+    else:
+        print("Ballots are in " + election_folder)
+    print("Plaintext totals: " + ", ".join(total.__str__()
+                                           for total in totals))
+    print("Totals of all the generated ballots are in " + election_folder
+          + TOTALS)
+    sys.exit(0)
+
+
+def binary_ballot(context):
+    '''Interactive encryption of a vote for a 0/1 election (answer_0 and
+    answer_1 settings). Returns the ballot as (cs, sigmaccs, sigmaors,
+    sigmasum) (see Election/wire.py).'''
+    human = context.settings['human']
+    # Point multiplications are done while the voter reads and chooses
+    pool = PrecomputationPool(context.g, context.g1, context.h, context.h1,
+                              size = 1)
 
     raw_input("Press <ENTER> to continue...")
 
-    print("QUESTION: " + settings['human']['question'])
-    print("ANSWER 0: " + settings['human']['answer_0'])
-    print("ANSWER 1: " + settings['human']['answer_1'])
+    print("QUESTION: " + human['question'])
+    print("ANSWER 0: " + human['answer_0'])
+    print("ANSWER 1: " + human['answer_1'])
 
     vote = -1
 
@@ -69,37 +116,91 @@ def main(election_folder):
             continue
         vote = v
 
-    print("Encrypting ballot. This may take some time...")
-    ((c0, c1, c2), sigmacc, sigmaor) = ccsva_enc(vote, g, g1, h, h1)
+    print("Encrypting ballot...")
+    with span('generate.encrypt'):
+        ((c0, c1, c2), sigmacc, sigmaor) = pool.encrypt(vote)
+    pool.stop()
 
-    # Encode ballot in JSON
-    ballot_content = json.dumps({'ciphertext' : {'c0' : c0.json(),
-                                               'c1' : c1.json(),
-                                               'c2' : c2.json()},
-                                'proofs' :{'sigmacc' : sigmacc,
-                                           'sigmaor': sigmaor}},
-                                indent = 4)
+    return ([(c0, c1, c2)], [sigmacc], [sigmaor], None)
 
-    print("Ballot encrypted!")
 
-    # Compute ballot hash
-    ballot_fingerprint = sha256(ballot_content).hexdigest()
-
-    # Save ballot to a file
-    filedes = open(election_folder + ballot_fingerprint + ".bal.json", "w")
-    filedes.write(ballot_content)
-    filedes.close()
+def vector_ballot(context):
+    '''Interactive encryption of a vote for a multi-candidate election
+    (answers and type settings). Returns the ballot as (cs, sigmaccs,
+    sigmaors, sigmasum) (see Election/wire.py).'''
+    human = context.settings['human']
+    answers = context.answers()
+    single = context.is_single()
+    # Point multiplications are done while the voter reads and chooses
+    pool = PrecomputationPool(context.g, context.g1, context.h, context.h1,
+                              size = 1, answers = len(answers),
+                              exactly_one = single, tables = context.tables())
 
-    print("Ballot hash (sha256): " + ballot_fingerprint)
-    print("This ballot is in " + election_folder + ballot_fingerprint \
-          + ".pub.json")
+    raw_input("Press <ENTER> to continue...")
 
-    sys.exit(0)
+    print("QUESTION: " + human['question'])
+    for i in range(len(answers)):
+        print("ANSWER " + i.__str__() + ": " + answers[i])
+
+    votes = [0] * len(answers)
+    if single:
+        vote = -1
+        while (vote < 0) | (vote >= len(answers)):
+            try:
+                vote = int(raw_input("Please pick a choice (0 to " \
+                                     + (len(answers) - 1).__str__() \
+                                     + ") and press <ENTER>... "))
+            except(ValueError): # Catch inputs that are not integers
+                continue
+        votes[vote] = 1
+    else:
+        for i in range(len(answers)):
+            choice = None
+            while choice not in ('y', 'n'):
+                choice = raw_input("Approve answer " + i.__str__() \
+                                   + " (y or n)? ")
+            votes[i] = 1 if choice == 'y' else 0
+
+    print("Encrypting ballot...")
+    with span('generate.encrypt'):
+        ballot = pool.encrypt_vector(votes)
+    pool.stop()
+
+    return ballot
+
+
+def parse_bulk_options(arguments):
+    '''Options of --bulk: {option: value} (value None for flags), or None
+    if they are invalid'''
+    options = {}
+    i = 0
+    while i < len(arguments):
+        if arguments[i] in ('--binary', '--log'):
+            options[arguments[i]] = None
+        elif (arguments[i] in ('--votes', '--seed', '--workers')) \
+                and (i + 1 < len(arguments)):
+            options[arguments[i]] = arguments[i + 1]
+            i += 1
+        else:
+            return None
+        i += 1
+    return options
 
 
 if __name__ == '__main__':
+    if (sys.argv.__len__() >= 4) and (sys.argv[1] == '--bulk'):
+        bulk_options = parse_bulk_options(sys.argv[3:-1])
+        if (bulk_options is None) or not sys.argv[2].isdigit():
+            print("USAGE: ./generate_ballot.py --bulk <count> [--binary] \
+[--log] [--votes w0,w1,...] [--seed <seed>] [--workers <n>] \
+<election_folder.edata>")
+            sys.exit(1)
+        bulk(sys.argv[-1], int(sys.argv[2]), bulk_options)
+    if (sys.argv.__len__() == 3) and (sys.argv[1] == '--binary'):
+        main(sys.argv[2], binary = True)
     if(sys.argv.__len__() != 2):
         print("Incorrect argument number! \n    \
-        USAGE: ./generate_ballot.py <election_folder.edata>")
+        USAGE: ./generate_ballot.py [--binary] <election_folder.edata>\n    \
+        ./generate_ballot.py --bulk <count> [options] <election_folder.edata>")
         sys.exit(1)
     main(sys.argv[1])